@@ -26,6 +26,28 @@ PLAYERS_COUNT_LIMIT = 12
 # Время жизни заявки на игру (в секундах). 10 минут = 600 сек.
 REQUEST_OVERDUE_TIME = 2 * 60 
 
+# --- АНТИФЛУД ---
+
+# Скользящее окно (в секундах) и лимиты обновлений в нём.
+# Всё, что сверх лимита, отбрасывается до обработки (без обращения к базе)
+FLOOD_WINDOW = 10
+FLOOD_USER_MESSAGES = 20  # Сообщений от одного пользователя
+FLOOD_USER_CALLBACKS = 15  # Нажатий кнопок одним пользователем
+FLOOD_CHAT_MESSAGES = 60  # Сообщений в одном групповом чате
+
+# --- УДАЛЕНИЕ СООБЩЕНИЙ ---
+
+# Сообщения, которые нельзя писать (ночь, мёртвые игроки), удаляются пачками раз в
+# DELETE_FLUSH_INTERVAL секунд; в чате, куда бот только что писал, — не позже DELETE_MAX_DELAY
+DELETE_FLUSH_INTERVAL = 1
+DELETE_MAX_DELAY = 3
+
+# --- НАСТРОЙКИ РЕЙТИНГА ---
+
+# Движок рейтинга: 'elo' (классический) или 'trueskill' (командная модель с учётом неопределённости).
+# При 'trueskill' отображаемый рейтинг — консервативная оценка навыка (mu - 3*sigma)
+RATING_ENGINE = os.getenv('RATING_ENGINE', 'elo')
+
 # --- ПУТИ К ФАЙЛАМ ---
 
 # Базовый путь проекта
@@ -3,8 +3,9 @@
 Система достижений для игры в мафию
 """
 import database
+from candies import balance_update, ledger_entry, record_entries
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
 # Определение всех достижений
 ACHIEVEMENTS = {
@@ -315,112 +316,169 @@ ACHIEVEMENTS = {
     },
 }
 
+# Порядок редкостей от обычных к легендарным
+RARITY_ORDER = ('common', 'uncommon', 'rare', 'epic', 'legendary')
+
+# Каталог, сгруппированный по редкости (строится один раз при импорте)
+ACHIEVEMENTS_BY_RARITY: Dict[str, List[Dict]] = {rarity: [] for rarity in RARITY_ORDER}
+for _achievement in ACHIEVEMENTS.values():
+    ACHIEVEMENTS_BY_RARITY.setdefault(_achievement.get('rarity', 'common'), []).append(_achievement)
+del _achievement
+
 def get_achievement(achievement_id: str) -> Optional[Dict]:
     """Получить информацию о достижении"""
     return ACHIEVEMENTS.get(achievement_id)
 
-def check_achievements(user_id: int, game_result: Dict, stats: Dict) -> List[Dict]:
+# --- ПРАВИЛА ДОСТИЖЕНИЙ ---
+# Каждое правило описывает условие достижения над показателем из player_stats:
+#   metric    — путь к показателю ('games_played', 'roles_played.mafia', ...)
+#   op        — '>=', '==' или 'covers' (все ключи из threshold имеют значение > 0)
+#   threshold — порог (для 'covers' — набор ключей)
+#   baseline  — значение, от которого считается прогресс (по умолчанию 0)
+#   team/won  — условия по итогу только что сыгранной игры
+ALL_ROLES = ('peace', 'mafia', 'don', 'commissar', 'sergeant', 'doctor', 'maniac',
+             'mistress', 'lawyer', 'suicide', 'bum', 'lucky', 'kamikaze')
+
+ACHIEVEMENT_RULES = [
+    # Первые шаги
+    {'id': 'first_game', 'metric': 'games_played', 'op': '>=', 'threshold': 1},
+    {'id': 'first_win', 'metric': 'games_won', 'op': '>=', 'threshold': 1},
+    {'id': 'first_mafia_win', 'metric': 'wins_by_team.mafia', 'op': '>=', 'threshold': 1, 'team': 'mafia', 'won': True},
+    {'id': 'first_maniac_win', 'metric': 'wins_by_team.maniac', 'op': '>=', 'threshold': 1, 'team': 'maniac', 'won': True},
+    
+    # Количество игр и побед
+    {'id': 'games_10', 'metric': 'games_played', 'op': '>=', 'threshold': 10},
+    {'id': 'games_50', 'metric': 'games_played', 'op': '>=', 'threshold': 50},
+    {'id': 'games_100', 'metric': 'games_played', 'op': '>=', 'threshold': 100},
+    {'id': 'games_500', 'metric': 'games_played', 'op': '>=', 'threshold': 500},
+    {'id': 'wins_10', 'metric': 'games_won', 'op': '>=', 'threshold': 10},
+    {'id': 'wins_50', 'metric': 'games_won', 'op': '>=', 'threshold': 50},
+    {'id': 'wins_100', 'metric': 'games_won', 'op': '>=', 'threshold': 100},
+    
+    # Роли
+    {'id': 'all_roles', 'metric': 'roles_played', 'op': 'covers', 'threshold': ALL_ROLES},
+    {'id': 'role_mafia_10', 'metric': 'roles_played.mafia', 'op': '>=', 'threshold': 10},
+    {'id': 'role_don_10', 'metric': 'roles_played.don', 'op': '>=', 'threshold': 10},
+    {'id': 'role_commissar_10', 'metric': 'roles_played.commissar', 'op': '>=', 'threshold': 10},
+    {'id': 'role_doctor_10', 'metric': 'roles_played.doctor', 'op': '>=', 'threshold': 10},
+    {'id': 'role_maniac_10', 'metric': 'roles_played.maniac', 'op': '>=', 'threshold': 10},
+    
+    # Рейтинг
+    {'id': 'elo_1500', 'metric': 'elo_rating', 'op': '>=', 'threshold': 1500, 'baseline': 1000},
+    {'id': 'elo_1800', 'metric': 'elo_rating', 'op': '>=', 'threshold': 1800, 'baseline': 1000},
+    {'id': 'elo_2000', 'metric': 'elo_rating', 'op': '>=', 'threshold': 2000, 'baseline': 1000},
+    
+    # Победы за все команды
+    {'id': 'win_all_teams', 'metric': 'wins_by_team', 'op': 'covers', 'threshold': ('peaceful', 'mafia', 'maniac')},
+    
+    # Конфеты
+    {'id': 'candies_1000', 'metric': 'candies', 'op': '>=', 'threshold': 1000},
+    {'id': 'candies_5000', 'metric': 'candies', 'op': '>=', 'threshold': 5000},
+]
+
+# Команды ролей для фильтра team (совпадает с game.get_player_team)
+ROLE_TEAMS = {
+    'peace': 'peaceful', 'civilian': 'peaceful', 'commissar': 'peaceful', 'sergeant': 'peaceful',
+    'doctor': 'peaceful', 'lucky': 'peaceful', 'kamikaze': 'peaceful',
+    'mafia': 'mafia', 'don': 'mafia',
+    'maniac': 'maniac',
+}
+
+def _compile_rules(rules: List[Dict]) -> Tuple[Dict[str, List[Dict]], Dict[str, Dict]]:
+    """
+    Построить таблицу правил, проиндексированную по показателю
+
+    Внутри показателя правила '>=' идут по возрастанию порога, поэтому проверка
+    останавливается на первом недостигнутом пороге.
+    """
+    by_metric: Dict[str, List[Dict]] = {}
+    by_id: Dict[str, Dict] = {}
+    for rule in rules:
+        if rule['id'] not in ACHIEVEMENTS:
+            raise ValueError(f"Rule for unknown achievement: {rule['id']}")
+        by_metric.setdefault(rule['metric'], []).append(rule)
+        by_id[rule['id']] = rule
+    for metric_rules in by_metric.values():
+        metric_rules.sort(key=lambda r: (r['op'] == '>=', r['threshold'] if r['op'] == '>=' else 0))
+    return by_metric, by_id
+
+RULES_BY_METRIC, RULES_BY_ID = _compile_rules(ACHIEVEMENT_RULES)
+
+def get_metric_value(stats: Dict, metric: str):
+    """Значение показателя по пути (недостающие числовые показатели равны 0)"""
+    value = stats
+    for key in metric.split('.'):
+        if not isinstance(value, dict):
+            return 0
+        value = value.get(key)
+        if value is None:
+            return 0
+    return value
+
+def _changed_metrics(game_result: Dict) -> List[str]:
+    """Показатели, которые меняются после игры с таким итогом"""
+    role = game_result.get('role', 'peace')
+    metrics = ['games_played', 'elo_rating', 'candies', 'roles_played', f'roles_played.{role}']
+    if game_result.get('won'):
+        metrics.extend(['games_won', 'wins_by_team'])
+        team = ROLE_TEAMS.get(role)
+        if team:
+            metrics.append(f'wins_by_team.{team}')
+    return metrics
+
+def _rule_satisfied(rule: Dict, value, game_result: Optional[Dict]) -> bool:
+    """Проверить условие правила (фильтры по игре — только если известен её итог)"""
+    op = rule['op']
+    if op == '>=':
+        if value < rule['threshold']:
+            return False
+    elif op == '==':
+        if value != rule['threshold']:
+            return False
+    elif op == 'covers':
+        if not isinstance(value, dict) or not all(value.get(key, 0) > 0 for key in rule['threshold']):
+            return False
+    else:
+        return False
+    
+    if game_result is not None:
+        if 'won' in rule and bool(game_result.get('won')) != rule['won']:
+            return False
+        if 'team' in rule and ROLE_TEAMS.get(game_result.get('role', 'peace')) != rule['team']:
+            return False
+    return True
+
+def check_achievements(user_id: int, game_result: Optional[Dict], stats: Dict) -> List[Dict]:
     """
     Проверить и выдать достижения игроку после игры
     
+    Проверяются только правила показателей, изменившихся в этой игре.
+    
     Args:
         user_id: ID игрока
-        game_result: Результат игры (role, won, alive, etc.)
+        game_result: Результат игры (role, won, alive, etc.); None — проверить все правила
         stats: Текущая статистика игрока
     
     Returns:
         Список новых достижений
     """
-    new_achievements = []
-    games_played = stats.get('games_played', 0)
-    games_won = stats.get('games_won', 0)
-    games_lost = stats.get('games_lost', 0)
-    roles_played = stats.get('roles_played', {})
-    wins_by_role = stats.get('wins_by_role', {})
-    wins_by_team = stats.get('wins_by_team', {})
-    elo_rating = stats.get('elo_rating', 1000)
-    candies = stats.get('candies', 0)
-    
-    # Получаем уже полученные достижения
-    player_achievements = stats.get('achievements', [])
-    achieved_ids = set(player_achievements)
-    
-    role = game_result.get('role', 'peace')
-    won = game_result.get('won', False)
-    is_alive = game_result.get('alive', False)
-    
-    # Первая игра
-    if 'first_game' not in achieved_ids and games_played == 1:
-        new_achievements.append(ACHIEVEMENTS['first_game'])
-    
-    # Первая победа
-    if 'first_win' not in achieved_ids and games_won == 1:
-        new_achievements.append(ACHIEVEMENTS['first_win'])
-    
-    # Первая победа за мафию
-    if 'first_mafia_win' not in achieved_ids and won and role in ('mafia', 'don') and wins_by_team.get('mafia', 0) == 1:
-        new_achievements.append(ACHIEVEMENTS['first_mafia_win'])
-    
-    # Первая победа за маньяка
-    if 'first_maniac_win' not in achieved_ids and won and role == 'maniac' and wins_by_team.get('maniac', 0) == 1:
-        new_achievements.append(ACHIEVEMENTS['first_maniac_win'])
-    
-    # Количество игр
-    if 'games_10' not in achieved_ids and games_played >= 10:
-        new_achievements.append(ACHIEVEMENTS['games_10'])
-    if 'games_50' not in achieved_ids and games_played >= 50:
-        new_achievements.append(ACHIEVEMENTS['games_50'])
-    if 'games_100' not in achieved_ids and games_played >= 100:
-        new_achievements.append(ACHIEVEMENTS['games_100'])
-    if 'games_500' not in achieved_ids and games_played >= 500:
-        new_achievements.append(ACHIEVEMENTS['games_500'])
-    
-    # Количество побед
-    if 'wins_10' not in achieved_ids and games_won >= 10:
-        new_achievements.append(ACHIEVEMENTS['wins_10'])
-    if 'wins_50' not in achieved_ids and games_won >= 50:
-        new_achievements.append(ACHIEVEMENTS['wins_50'])
-    if 'wins_100' not in achieved_ids and games_won >= 100:
-        new_achievements.append(ACHIEVEMENTS['wins_100'])
-    
-    # Все роли
-    if 'all_roles' not in achieved_ids:
-        all_roles = {'peace', 'mafia', 'don', 'commissar', 'sergeant', 'doctor', 'maniac', 
-                     'mistress', 'lawyer', 'suicide', 'bum', 'lucky', 'kamikaze'}
-        played_roles = set(roles_played.keys())
-        if all_roles.issubset(played_roles):
-            new_achievements.append(ACHIEVEMENTS['all_roles'])
-    
-    # Роли по 10 раз
-    if 'role_mafia_10' not in achieved_ids and roles_played.get('mafia', 0) >= 10:
-        new_achievements.append(ACHIEVEMENTS['role_mafia_10'])
-    if 'role_don_10' not in achieved_ids and roles_played.get('don', 0) >= 10:
-        new_achievements.append(ACHIEVEMENTS['role_don_10'])
-    if 'role_commissar_10' not in achieved_ids and roles_played.get('commissar', 0) >= 10:
-        new_achievements.append(ACHIEVEMENTS['role_commissar_10'])
-    if 'role_doctor_10' not in achieved_ids and roles_played.get('doctor', 0) >= 10:
-        new_achievements.append(ACHIEVEMENTS['role_doctor_10'])
-    if 'role_maniac_10' not in achieved_ids and roles_played.get('maniac', 0) >= 10:
-        new_achievements.append(ACHIEVEMENTS['role_maniac_10'])
-    
-    # Рейтинг
-    if 'elo_1500' not in achieved_ids and elo_rating >= 1500:
-        new_achievements.append(ACHIEVEMENTS['elo_1500'])
-    if 'elo_1800' not in achieved_ids and elo_rating >= 1800:
-        new_achievements.append(ACHIEVEMENTS['elo_1800'])
-    if 'elo_2000' not in achieved_ids and elo_rating >= 2000:
-        new_achievements.append(ACHIEVEMENTS['elo_2000'])
-    
-    # Победы за все команды
-    if 'win_all_teams' not in achieved_ids:
-        if wins_by_team.get('peaceful', 0) > 0 and wins_by_team.get('mafia', 0) > 0 and wins_by_team.get('maniac', 0) > 0:
-            new_achievements.append(ACHIEVEMENTS['win_all_teams'])
+    achieved_ids = set(stats.get('achievements', []))
+    metrics = RULES_BY_METRIC.keys() if game_result is None else _changed_metrics(game_result)
     
-    # Конфеты
-    if 'candies_1000' not in achieved_ids and candies >= 1000:
-        new_achievements.append(ACHIEVEMENTS['candies_1000'])
-    if 'candies_5000' not in achieved_ids and candies >= 5000:
-        new_achievements.append(ACHIEVEMENTS['candies_5000'])
+    new_achievements = []
+    for metric in metrics:
+        rules = RULES_BY_METRIC.get(metric)
+        if not rules:
+            continue
+        value = get_metric_value(stats, metric)
+        for rule in rules:
+            if rule['op'] == '>=' and value < rule['threshold']:
+                break  # Дальше пороги только выше
+            if rule['id'] in achieved_ids:
+                continue
+            if _rule_satisfied(rule, value, game_result):
+                new_achievements.append(ACHIEVEMENTS[rule['id']])
+                achieved_ids.add(rule['id'])
     
     return new_achievements
 
@@ -450,6 +508,55 @@ def check_special_achievements(user_id: int, game_result: Dict, stats: Dict, gam
     
     return new_achievements
 
+def apply_achievements(stats: Dict, achievements: List[Dict]) -> List[Dict]:
+    """
+    Добавить достижения и награду в документ статистики (без записи в базу)
+
+    Returns:
+        Достижения, которых у игрока ещё не было
+    """
+    owned = stats.setdefault('achievements', [])
+    applied = []
+    for achievement in achievements:
+        if achievement['id'] in owned:
+            continue
+        owned.append(achievement['id'])
+        stats['candies'] = stats.get('candies', 0) + achievement.get('reward_candies', 0)
+        applied.append(achievement)
+    return applied
+
+def award_achievements(user_id: int, achievements: List[Dict]) -> List[Dict]:
+    """
+    Выдать несколько достижений одной записью: список, конфеты и кастомизация
+
+    Returns:
+        Фактически выданные достижения
+    """
+    try:
+        # Чтение тоже под блокировкой: догоняющая выдача (backfill) не успеет выдать то же достижение
+        with balance_update():
+            stats = database.find_one('player_stats', {'user_id': user_id})
+            if not stats:
+                return []
+            
+            candies_before = stats.get('candies', 0)
+            applied = apply_achievements(stats, achievements)
+            if not applied:
+                return []
+            
+            reward = stats['candies'] - candies_before
+            database.update_one('player_stats', {'user_id': user_id}, {
+                '$set': {'achievements': stats['achievements']},
+                '$inc': {'candies': reward}
+            })
+            record_entries([ledger_entry(user_id, reward, 'achievements')])
+        
+        award_achievement_customization(user_id, applied)
+        return applied
+    except Exception as e:
+        print(f"Error awarding achievements: {e}")
+        return []
+
 def award_achievement(user_id: int, achievement: Dict) -> bool:
     """
     Выдать достижение игроку и начислить награду
@@ -457,44 +564,32 @@ def award_achievement(user_id: int, achievement: Dict) -> bool:
     Returns:
         True если достижение успешно выдано
     """
+    return bool(award_achievements(user_id, [achievement]))
+
+def award_achievement_customization(user_id: int, achievements: List[Dict]):
+    """Выдать кастомизацию за достижения одной записью (если модуль доступен)"""
     try:
-        stats = database.find_one('player_stats', {'user_id': user_id})
-        if not stats:
-            return False
-        
-        achievements = stats.get('achievements', [])
-        if achievement['id'] in achievements:
-            return False  # Уже получено
-        
-        # Добавляем достижение
-        achievements.append(achievement['id'])
-        
-        # Начисляем конфеты
-        candies = stats.get('candies', 0) + achievement.get('reward_candies', 0)
-        
-        # Сохраняем
-        database.update_one('player_stats', {'user_id': user_id}, {
-            '$set': {
-                'achievements': achievements,
-                'candies': candies
-            }
-        })
-        
-        # Выдаем кастомизацию за достижение (если есть)
-        try:
-            from customization import award_customization_from_achievement
-            award_customization_from_achievement(user_id, achievement['id'])
-        except ImportError:
-            pass  # Модуль кастомизации не найден, пропускаем
-        
-        return True
-    except Exception as e:
-        print(f"Error awarding achievement: {e}")
-        return False
+        from customization import award_customization_from_achievements
+        award_customization_from_achievements(user_id, [a['id'] for a in achievements])
+    except ImportError:
+        pass  # Модуль кастомизации не найден, пропускаем
 
-def get_player_achievements(user_id: int) -> List[Dict]:
-    """Получить все достижения игрока"""
-    stats = database.find_one('player_stats', {'user_id': user_id})
+def format_achievements_message(achievements: List[Dict]) -> str:
+    """Одно уведомление о всех новых достижениях"""
+    title = "🎉 <b>НОВОЕ ДОСТИЖЕНИЕ!</b>" if len(achievements) == 1 else "🎉 <b>НОВЫЕ ДОСТИЖЕНИЯ!</b>"
+    lines = [title, ""]
+    for achievement in achievements:
+        lines.append(f"{achievement['icon']} <b>{achievement['name']}</b>")
+        lines.append(f"{achievement['description']}")
+        lines.append("")
+    total = sum(a.get('reward_candies', 0) for a in achievements)
+    lines.append(f"🍭 Награда: +{total} конфет")
+    return "\n".join(lines)
+
+def get_player_achievements(user_id: int, stats: Optional[Dict] = None) -> List[Dict]:
+    """Получить все достижения игрока (stats — уже прочитанная статистика, если есть)"""
+    if stats is None:
+        stats = database.find_one('player_stats', {'user_id': user_id})
     if not stats:
         return []
     
@@ -509,48 +604,41 @@ def get_player_achievements(user_id: int) -> List[Dict]:
 def get_achievements_by_rarity(rarity: str = None) -> List[Dict]:
     """Получить все достижения, опционально отфильтрованные по редкости"""
     if rarity:
-        return [ach for ach in ACHIEVEMENTS.values() if ach['rarity'] == rarity]
+        return list(ACHIEVEMENTS_BY_RARITY.get(rarity, []))
     return list(ACHIEVEMENTS.values())
 
+def calculate_progress(stats: Dict, achievement_id: str) -> Dict:
+    """
+    Прогресс по достижению на основе уже прочитанной статистики
+
+    Returns:
+        {'completed': bool, 'progress': 0-100, 'total': 100}
+    """
+    if achievement_id in stats.get('achievements', []):
+        return {'completed': True, 'progress': 100, 'total': 100}
+    
+    rule = RULES_BY_ID.get(achievement_id)
+    if not rule:
+        return {'completed': False, 'progress': 0, 'total': 100}
+    
+    value = get_metric_value(stats, rule['metric'])
+    if rule['op'] == 'covers':
+        covered = sum(1 for key in rule['threshold'] if isinstance(value, dict) and value.get(key, 0) > 0)
+        progress = covered / len(rule['threshold']) * 100
+    else:
+        baseline = rule.get('baseline', 0)
+        span = rule['threshold'] - baseline
+        progress = (value - baseline) / span * 100 if span > 0 else 0
+    
+    return {'completed': False, 'progress': int(max(0, min(100, progress))), 'total': 100}
+
 def get_achievement_progress(user_id: int, achievement_id: str) -> Dict:
     """Получить прогресс игрока по конкретному достижению"""
-    stats = database.find_one('player_stats', {'user_id': user_id})
-    if not stats:
+    if achievement_id not in ACHIEVEMENTS:
         return {'completed': False, 'progress': 0, 'total': 0}
     
-    achievement = ACHIEVEMENTS.get(achievement_id)
-    if not achievement:
+    stats = database.find_one('player_stats', {'user_id': user_id})
+    if not stats:
         return {'completed': False, 'progress': 0, 'total': 0}
     
-    # Проверяем, получено ли достижение
-    achievements = stats.get('achievements', [])
-    if achievement_id in achievements:
-        return {'completed': True, 'progress': 100, 'total': 100}
-    
-    # Рассчитываем прогресс в зависимости от типа достижения
-    progress = 0
-    total = 100
-    
-    if achievement_id == 'games_10':
-        progress = min(100, (stats.get('games_played', 0) / 10) * 100)
-    elif achievement_id == 'games_50':
-        progress = min(100, (stats.get('games_played', 0) / 50) * 100)
-    elif achievement_id == 'games_100':
-        progress = min(100, (stats.get('games_played', 0) / 100) * 100)
-    elif achievement_id == 'wins_10':
-        progress = min(100, (stats.get('games_won', 0) / 10) * 100)
-    elif achievement_id == 'wins_50':
-        progress = min(100, (stats.get('games_won', 0) / 50) * 100)
-    elif achievement_id == 'elo_1500':
-        current_elo = stats.get('elo_rating', 1000)
-        progress = min(100, ((current_elo - 1000) / 500) * 100)
-    elif achievement_id == 'elo_1800':
-        current_elo = stats.get('elo_rating', 1000)
-        progress = min(100, ((current_elo - 1000) / 800) * 100)
-    elif achievement_id == 'elo_2000':
-        current_elo = stats.get('elo_rating', 1000)
-        progress = min(100, ((current_elo - 1000) / 1000) * 100)
-    # Добавить больше типов прогресса по необходимости
-    
-    return {'completed': False, 'progress': int(progress), 'total': total}
-
+    return calculate_progress(stats, achievement_id)
@@ -0,0 +1,167 @@
+# analytics.py
+"""
+Аналитика баланса ролей по завершённым играм.
+
+Итоги игр пишутся в коллекцию game_results при завершении партии (game.stop_game).
+Отчёт можно получить командой /balance (админ) или офлайн:
+
+    python src/analytics.py
+"""
+import math
+import database
+from typing import Dict, List, Optional, Tuple
+
+TEAMS = ('peaceful', 'mafia', 'maniac')
+TEAM_NAMES = {'peaceful': 'мирные', 'mafia': 'мафия', 'maniac': 'маньяк'}
+
+# Коридор честной доли побед мирных/мафии. Размер стола помечается как
+# несбалансированный, если доверительный интервал целиком вне коридора.
+BALANCE_FAIR_RANGE = (0.35, 0.65)
+
+# Минимум игр, чтобы делать выводы о размере стола или раскладе
+BALANCE_MIN_GAMES = 20
+
+# z-квантиль для 95% доверительного интервала
+WILSON_Z = 1.96
+
+def wilson_interval(wins: int, games: int, z: float = WILSON_Z) -> Tuple[float, float]:
+    """
+    Доверительный интервал Уилсона для доли побед
+
+    Args:
+        wins: Количество побед
+        games: Количество игр
+
+    Returns:
+        (нижняя граница, верхняя граница)
+    """
+    if games == 0:
+        return 0.0, 1.0
+    p = wins / games
+    z2 = z * z
+    denom = 1 + z2 / games
+    center = (p + z2 / (2 * games)) / denom
+    margin = z * math.sqrt(p * (1 - p) / games + z2 / (4 * games * games)) / denom
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+def _new_bucket() -> Dict:
+    return {'games': 0, 'wins': {team: 0 for team in TEAMS}}
+
+def _finalize_bucket(bucket: Dict, min_games: int) -> Dict:
+    """Посчитать доли, интервалы и флаг дисбаланса для накопленной группы"""
+    games = bucket['games']
+    rates = {}
+    for team in TEAMS:
+        wins = bucket['wins'][team]
+        low, high = wilson_interval(wins, games)
+        rates[team] = (wins / games if games else 0.0, low, high)
+
+    fair_low, fair_high = BALANCE_FAIR_RANGE
+    unbalanced = None
+    if games >= min_games and any(rates[team][1] > fair_high or rates[team][2] < fair_low
+                                  for team in ('peaceful', 'mafia')):
+        # Перевес у команды с наибольшей фактической долей побед: низкая доля мирных
+        # ещё не значит, что выигрывает мафия, — это может быть маньяк
+        unbalanced = max(TEAMS, key=lambda team: rates[team][0])
+    bucket['rates'] = rates
+    bucket['unbalanced'] = unbalanced
+    return bucket
+
+def build_balance_report(results: Optional[List[Dict]] = None, min_games: int = BALANCE_MIN_GAMES) -> Dict:
+    """
+    Агрегировать итоги игр по размеру стола и раскладу ролей за один проход
+
+    Args:
+        results: Итоги игр (по умолчанию вся коллекция game_results)
+        min_games: Минимум игр для флага дисбаланса
+
+    Returns:
+        {'total': int, 'sizes': [...], 'setups': [...]}, где каждая строка содержит
+        players_count, games, wins, rates {team: (доля, низ, верх)} и unbalanced
+    """
+    if results is None:
+        results = database.find('game_results', {})
+
+    by_size: Dict[int, Dict] = {}
+    by_setup: Dict[Tuple[int, Tuple[str, ...]], Dict] = {}
+    total = 0
+    for result in results:
+        winner = result.get('winner_team')
+        if winner not in TEAMS:
+            continue
+        size = result.get('players_count', 0)
+        setup = (size, tuple(result.get('cards', ())))
+
+        size_bucket = by_size.get(size)
+        if size_bucket is None:
+            size_bucket = by_size[size] = _new_bucket()
+        setup_bucket = by_setup.get(setup)
+        if setup_bucket is None:
+            setup_bucket = by_setup[setup] = _new_bucket()
+
+        size_bucket['games'] += 1
+        size_bucket['wins'][winner] += 1
+        setup_bucket['games'] += 1
+        setup_bucket['wins'][winner] += 1
+        total += 1
+
+    sizes = []
+    for size in sorted(by_size):
+        row = _finalize_bucket(by_size[size], min_games)
+        row['players_count'] = size
+        sizes.append(row)
+
+    setups = []
+    for (size, cards), bucket in by_setup.items():
+        row = _finalize_bucket(bucket, min_games)
+        row['players_count'] = size
+        row['cards'] = list(cards)
+        setups.append(row)
+    setups.sort(key=lambda row: (row['players_count'], -row['games']))
+
+    return {'total': total, 'sizes': sizes, 'setups': setups}
+
+def _format_cards(cards: List[str]) -> str:
+    """Сжать расклад до вида 'mafia×3, doctor, ...' без мирных"""
+    counts: Dict[str, int] = {}
+    for card in cards:
+        if card not in ('peace', 'civilian'):
+            counts[card] = counts.get(card, 0) + 1
+    return ', '.join(f'{card}×{n}' if n > 1 else card for card, n in counts.items())
+
+def format_balance_report(report: Dict, html: bool = True, max_setups: int = 10) -> str:
+    """Текст отчёта о балансе (HTML для бота или простой текст для консоли)"""
+    bold = (lambda t: f'<b>{t}</b>') if html else (lambda t: t)
+    lines = [bold('⚖️ Баланс ролей'), f'Завершённых игр: {report["total"]}', '']
+
+    if not report['sizes']:
+        lines.append('Нет данных о завершённых играх.')
+        return '\n'.join(lines)
+
+    lines.append(bold('По размеру стола:'))
+    for row in report['sizes']:
+        parts = []
+        for team, icon in (('peaceful', '🎅'), ('mafia', '😈'), ('maniac', '💀')):
+            rate, low, high = row['rates'][team]
+            if row['wins'][team] or team != 'maniac':
+                parts.append(f'{icon} {rate:.0%} [{low:.0%}–{high:.0%}]')
+        flag = ''
+        if row['unbalanced']:
+            flag = f' ⚠️ перевес: {TEAM_NAMES[row["unbalanced"]]}'
+        elif row['games'] < BALANCE_MIN_GAMES:
+            flag = ' (мало данных)'
+        lines.append(f'{row["players_count"]} игроков, {row["games"]} игр: ' + ', '.join(parts) + flag)
+
+    lines.append('')
+    lines.append(bold('Частые расклады:'))
+    for row in sorted(report['setups'], key=lambda r: -r['games'])[:max_setups]:
+        rate, low, high = row['rates']['mafia']
+        flag = ' ⚠️' if row['unbalanced'] else ''
+        lines.append(
+            f'{row["players_count"]} игр.: {_format_cards(row["cards"])} — '
+            f'{row["games"]} игр, мафия {rate:.0%} [{low:.0%}–{high:.0%}]{flag}'
+        )
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    print(format_balance_report(build_balance_report(), html=False))
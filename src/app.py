@@ -15,7 +15,10 @@ if current_dir not in sys.path:
 import config
 import database
 from handlers import bot, get_time_str
-from game import stop_game
+from game import stop_game, migrate_time_stats
+from candies import migrate_candy_ledger
+from teams import migrate_team_aggregates
+from moderation import load_bans, sweep_expired_bans
 from stages import go_to_next_stage, update_timer
 import lang
 
@@ -134,6 +137,26 @@ def remove_overtimed_requests():
             logger.error(f"Error in remove_overtimed_requests: {e}")
         sleep(5)
 
+def flush_deletions():
+    """Пакетное удаление сообщений, которые нельзя писать по правилам игры"""
+    while True:
+        try:
+            bot.flush_deletions()
+        except Exception as e:
+            logger.error(f"Error in flush_deletions: {e}")
+        sleep(config.DELETE_FLUSH_INTERVAL)
+
+def sweep_bans():
+    """Снятие истёкших временных банов"""
+    while True:
+        try:
+            swept = sweep_expired_bans()
+            if swept:
+                logger.info(f'Expired bans removed: {swept}')
+        except Exception as e:
+            logger.error(f"Error in sweep_bans: {e}")
+        sleep(30)
+
 def daily_events():
     """Ежедневные случайные события (дроп конфет в группах)"""
     from datetime import datetime
@@ -239,10 +262,24 @@ def webhook():
 
 def main():
     try:
+        # Однократные миграции данных
+        migrated = migrate_time_stats()
+        if migrated:
+            logger.info(f'Migrated time stats in {migrated} player documents')
+        opened = migrate_candy_ledger()
+        if opened:
+            logger.info(f'Recorded {opened} opening candy balances in the ledger')
+        teams_migrated = migrate_team_aggregates()
+        if teams_migrated:
+            logger.info(f'Computed aggregates for {teams_migrated} teams')
+        load_bans()
+        
         print("Starting background threads...")
         start_thread('Stage Cycle', stage_cycle)
         start_thread('Request Cleaner', remove_overtimed_requests)
         start_thread('Daily Events', daily_events)
+        start_thread('Ban Sweeper', sweep_bans)
+        start_thread('Message Deleter', flush_deletions)
         
         print("Bot logic initialized.")
 
@@ -0,0 +1,186 @@
+# backfill.py
+"""
+Догоняющая выдача достижений существующим игрокам.
+
+Нужна после добавления новых правил в ACHIEVEMENT_RULES: игроки, которые уже
+выполнили условие, получат достижение без новой игры. Правила проверяются
+пачками в пуле процессов, награды пишутся пачками через database.bulk_update.
+Прогресс сохраняется в коллекции backfill_jobs, поэтому прерванный запуск
+продолжается с последней записанной пачки.
+
+Запуск из консоли (из корня проекта):
+
+    python src/backfill.py [--restart]
+"""
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from time import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import database
+from achievements import ACHIEVEMENTS, check_achievements
+from candies import balance_update, ledger_entry, record_entries
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_JOB = 'achievements'
+BACKFILL_CHUNK_SIZE = 500
+
+# Одновременно идёт не больше одного запуска: два прохода по одной пачке выдали бы награду дважды
+_run_lock = threading.Lock()
+
+class BackfillRunningError(RuntimeError):
+    """Выдача уже идёт в этом процессе"""
+
+def is_backfill_running() -> bool:
+    """Идёт ли сейчас выдача достижений"""
+    return _run_lock.locked()
+
+def _evaluate_chunk(docs: List[Dict]) -> List[Tuple[str, int, List[str]]]:
+    """Проверить все правила для пачки документов (выполняется в дочернем процессе)"""
+    results = []
+    for stats in docs:
+        new_achievements = check_achievements(stats['user_id'], None, stats)
+        if new_achievements:
+            results.append((stats['_id'], stats['user_id'], [a['id'] for a in new_achievements]))
+    return results
+
+def _apply_chunk(results: List[Tuple[str, int, List[str]]]) -> Tuple[int, int]:
+    """Записать найденные достижения и награды одной пачкой
+
+    Результаты посчитаны по снимку документов, поэтому перед записью документы
+    перечитываются: достижения, уже выданные игрой или прошлым прерванным запуском,
+    пропускаются, и награда считается только за оставшиеся. Чтение и запись идут
+    под balance_update(), как и остальные выдачи наград, поэтому между ними никто
+    не успеет выдать то же достижение.
+
+    Returns:
+        (выдано достижений, награждено игроков)
+    """
+    if not results:
+        return 0, 0
+    awarded = {}
+    with balance_update():
+        owned = {doc['_id']: set(doc.get('achievements', []))
+                 for doc in database.find('player_stats', {'_id': {'$in': [doc_id for doc_id, _, _ in results]}})}
+
+        updates = {}
+        entries = []
+        for doc_id, user_id, achievement_ids in results:
+            new_ids = [a for a in achievement_ids if doc_id in owned and a not in owned[doc_id]]
+            if not new_ids:
+                continue
+            reward = sum(ACHIEVEMENTS[a].get('reward_candies', 0) for a in new_ids)
+            updates[doc_id] = {
+                '$addToSet': {'achievements': {'$each': new_ids}},
+                '$inc': {'candies': reward}
+            }
+            entries.extend(ledger_entry(user_id, ACHIEVEMENTS[a].get('reward_candies', 0), 'achievements_backfill',
+                                        f'achievement:{user_id}:{a}') for a in new_ids)
+            awarded[user_id] = new_ids
+        if not updates:
+            return 0, 0
+        database.bulk_update('player_stats', updates)
+        record_entries(entries)
+
+    try:
+        from customization import award_customization_bulk
+        award_customization_bulk(awarded)
+    except ImportError:
+        pass
+    return sum(len(ids) for ids in awarded.values()), len(awarded)
+
+def run_achievement_backfill(chunk_size: int = BACKFILL_CHUNK_SIZE, workers: Optional[int] = None,
+                             progress: Optional[Callable[[Dict], None]] = None,
+                             restart: bool = False) -> Dict:
+    """
+    Выдать достижения всем игрокам, которые уже выполнили их условия
+
+    Args:
+        chunk_size: Размер пачки документов
+        workers: Число процессов (1 — без пула, в текущем процессе)
+        progress: Колбэк с текущим состоянием задачи после каждой пачки
+        restart: Начать заново, даже если прошлый запуск прерван
+
+    Returns:
+        Состояние задачи: processed, total, awarded, players, rate, finished
+
+    Raises:
+        BackfillRunningError: Другой запуск ещё не закончился
+    """
+    if not _run_lock.acquire(blocking=False):
+        raise BackfillRunningError('Achievement backfill is already running')
+    try:
+        return _run_backfill(chunk_size, workers, progress, restart)
+    finally:
+        _run_lock.release()
+
+def _run_backfill(chunk_size: int, workers: Optional[int], progress: Optional[Callable[[Dict], None]],
+                  restart: bool) -> Dict:
+    """Тело run_achievement_backfill (вызывается под _run_lock)"""
+    job = database.find_one('backfill_jobs', {'job': BACKFILL_JOB})
+    if job and not job.get('finished') and not restart:
+        last_user_id = job.get('last_user_id')
+        state = {'processed': job.get('processed', 0), 'awarded': job.get('awarded', 0), 'players': job.get('players', 0)}
+        logger.info(f'Resuming achievement backfill after user {last_user_id}')
+    else:
+        last_user_id = None
+        state = {'processed': 0, 'awarded': 0, 'players': 0}
+        database.update_one('backfill_jobs', {'job': BACKFILL_JOB}, {'$set': {
+            'started_at': datetime.now().isoformat(), 'finished': False, 'last_user_id': None,
+            'processed': 0, 'awarded': 0, 'players': 0
+        }}, upsert=True)
+
+    # Порядок по user_id даёт стабильную точку продолжения
+    docs = [d for d in database.find('player_stats', {}) if isinstance(d.get('user_id'), int)]
+    docs.sort(key=lambda d: d['user_id'])
+    if last_user_id is not None:
+        docs = [d for d in docs if d['user_id'] > last_user_id]
+    chunks = [docs[i:i + chunk_size] for i in range(0, len(docs), chunk_size)]
+    state['total'] = state['processed'] + len(docs)
+
+    started = time()
+    processed_now = 0
+    pool = None
+    if workers != 1 and len(chunks) > 1:
+        # spawn: команда может запускаться из потока бота, fork в многопоточном процессе небезопасен
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        results_iter = pool.map(_evaluate_chunk, chunks) if pool else map(_evaluate_chunk, chunks)
+        for chunk, results in zip(chunks, results_iter):
+            awarded, players = _apply_chunk(results)
+            state['awarded'] += awarded
+            state['players'] += players
+            state['processed'] += len(chunk)
+            processed_now += len(chunk)
+            state['rate'] = processed_now / max(time() - started, 1e-6)
+
+            database.update_one('backfill_jobs', {'job': BACKFILL_JOB}, {'$set': {
+                'last_user_id': chunk[-1]['user_id'], 'processed': state['processed'],
+                'awarded': state['awarded'], 'players': state['players']
+            }})
+            logger.info(f"Achievement backfill: {state['processed']}/{state['total']} "
+                        f"({state['rate']:.0f} docs/s), awarded {state['awarded']}")
+            if progress:
+                progress(dict(state))
+    finally:
+        if pool:
+            pool.shutdown()
+
+    state.setdefault('rate', 0.0)
+    state['finished'] = True
+    database.update_one('backfill_jobs', {'job': BACKFILL_JOB}, {'$set': {
+        'finished': True, 'finished_at': datetime.now().isoformat()
+    }})
+    return state
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+    result = run_achievement_backfill(restart='--restart' in sys.argv, workers=os.cpu_count())
+    print(f"Done: {result['processed']} players checked, {result['players']} rewarded, "
+          f"{result['awarded']} achievements awarded")
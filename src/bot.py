@@ -1,8 +1,12 @@
 import config
 from logger import logger
 import database
+import json
+import threading
+from collections import deque
+from time import monotonic
 
-from telebot import TeleBot
+from telebot import TeleBot, apihelper
 from telebot.apihelper import ApiException
 
 # Константы стадий (лучше вынести их в config или game, но для наглядности здесь)
@@ -16,7 +20,183 @@ STAGE_ENDING = -4
 def group_only(message):
     return message.chat.type in ('group', 'supergroup')
 
+class SlidingWindowLimiter:
+    """Не больше limit событий за window секунд на ключ (скользящее окно)"""
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.hits = {}  # {ключ: deque(время события)}
+
+    def allow(self, key, now):
+        hits = self.hits.get(key)
+        if hits is None:
+            hits = self.hits[key] = deque()
+        while hits and hits[0] <= now - self.window:
+            hits.popleft()
+        if len(hits) >= self.limit:
+            return False
+        hits.append(now)
+        return True
+
+    def prune(self, now):
+        """Забыть ключи без событий в текущем окне"""
+        for key in [k for k, hits in self.hits.items() if not hits or hits[-1] <= now - self.window]:
+            del self.hits[key]
+
+class FloodGuard:
+    """Антифлуд перед хендлерами: обновления сверх лимита отбрасываются до обращения к базе"""
+
+    # Такие сообщения не отбрасываются никогда (оплата уже списана у пользователя)
+    EXEMPT_CONTENT_TYPES = ('successful_payment',)
+
+    def __init__(self):
+        window = getattr(config, 'FLOOD_WINDOW', 10)
+        self.user_messages = SlidingWindowLimiter(getattr(config, 'FLOOD_USER_MESSAGES', 20), window)
+        self.user_callbacks = SlidingWindowLimiter(getattr(config, 'FLOOD_USER_CALLBACKS', 15), window)
+        self.chat_messages = SlidingWindowLimiter(getattr(config, 'FLOOD_CHAT_MESSAGES', 60), window)
+        self.dropped = {'user_messages': 0, 'user_callbacks': 0, 'chat_messages': 0}
+        self.lock = threading.Lock()
+        self.last_prune = monotonic()
+
+    def _drop(self, kind, key):
+        self.dropped[kind] += 1
+        if self.dropped[kind] % 100 == 1:
+            logger.info(f'Антифлуд: отброшено обновление ({kind}, {key}), всего {self.dropped[kind]}')
+        return False
+
+    def _maybe_prune(self, now):
+        if now - self.last_prune >= 60:
+            self.last_prune = now
+            for limiter in (self.user_messages, self.user_callbacks, self.chat_messages):
+                limiter.prune(now)
+
+    def allow_message(self, message):
+        if message.content_type in self.EXEMPT_CONTENT_TYPES or not message.from_user:
+            return True
+        now = monotonic()
+        with self.lock:
+            self._maybe_prune(now)
+            if not self.user_messages.allow(message.from_user.id, now):
+                return self._drop('user_messages', message.from_user.id)
+            if group_only(message) and not self.chat_messages.allow(message.chat.id, now):
+                return self._drop('chat_messages', message.chat.id)
+            return True
+
+    def allow_callback(self, call):
+        now = monotonic()
+        with self.lock:
+            self._maybe_prune(now)
+            if not self.user_callbacks.allow(call.from_user.id, now):
+                return self._drop('user_callbacks', call.from_user.id)
+            return True
+
+    def stats(self):
+        """Счётчики отброшенных обновлений"""
+        with self.lock:
+            return dict(self.dropped)
+
+class DeletionQueue:
+    """Сообщения на удаление, накопленные по чатам"""
+
+    BATCH_SIZE = 100  # Максимум message_ids в одном deleteMessages
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}  # {chat_id: [message_id]}
+        self.first_at = {}  # {chat_id: время первого сообщения в очереди}
+
+    def add(self, chat_id, message_id):
+        with self.lock:
+            self.pending.setdefault(chat_id, []).append(message_id)
+            self.first_at.setdefault(chat_id, monotonic())
+
+    def requeue(self, chat_id, message_ids):
+        """Вернуть пачку в начало очереди чата (удаление не удалось)"""
+        with self.lock:
+            self.pending[chat_id] = message_ids + self.pending.get(chat_id, [])
+            self.first_at.setdefault(chat_id, monotonic())
+
+    def take_ready(self, now, busy_chats):
+        """Забрать пачки, готовые к удалению
+
+        Чат, куда бот только что писал, ждёт до DELETE_MAX_DELAY секунд, чтобы
+        удаление не занимало лимит запросов в момент игровых сообщений.
+        """
+        max_delay = getattr(config, 'DELETE_MAX_DELAY', 3)
+        batches = []
+        with self.lock:
+            for chat_id in list(self.pending):
+                ids = self.pending[chat_id]
+                if chat_id in busy_chats and len(ids) < self.BATCH_SIZE and now - self.first_at[chat_id] < max_delay:
+                    continue
+                batches.append((chat_id, ids[:self.BATCH_SIZE]))
+                if len(ids) > self.BATCH_SIZE:
+                    self.pending[chat_id] = ids[self.BATCH_SIZE:]
+                    self.first_at[chat_id] = now
+                else:
+                    del self.pending[chat_id]
+                    del self.first_at[chat_id]
+        return batches
+
+class ActiveGameChats:
+    """Чаты с идущей мафией (не лобби и не конец) — для антифлуда без чтения базы
+
+    Загружается одним чтением games, дальше обновляется по записям в коллекцию.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.chats = {}  # {_id игры: chat_id}
+        database.on_write('games', self._on_write)
+        database.on_delete('games', self._on_delete)
+        for game in database.find('games', {}):
+            self._on_write(game)
+
+    def _on_write(self, game):
+        with self.lock:
+            if game.get('game') == 'mafia' and game.get('stage', 0) not in (STAGE_LOBBY, STAGE_ENDING):
+                self.chats[game['_id']] = game.get('chat')
+            else:
+                self.chats.pop(game['_id'], None)
+
+    def _on_delete(self, game):
+        with self.lock:
+            self.chats.pop(game['_id'], None)
+
+    def __contains__(self, chat_id):
+        with self.lock:
+            return chat_id in self.chats.values()
+
 class MafiaHostBot(TeleBot):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.flood_guard = FloodGuard()
+        self.deletion_queue = DeletionQueue()
+        self.active_games = ActiveGameChats()
+        self.last_send = {}  # {chat_id: время последней отправки ботом}
+
+    def send_message(self, chat_id, *args, **kwargs):
+        self.last_send[chat_id] = monotonic()
+        return super().send_message(chat_id, *args, **kwargs)
+
+    def process_new_messages(self, new_messages):
+        allowed = []
+        for message in new_messages:
+            if self.flood_guard.allow_message(message):
+                allowed.append(message)
+            elif group_only(message) and message.chat.id in self.active_games:
+                # Во время игры лишние сообщения удаляются, а не пропускаются:
+                # иначе флуд мертвых и ночью обходил бы правила молчания (_game_handler)
+                self.deletion_queue.add(message.chat.id, message.message_id)
+        if allowed:
+            super().process_new_messages(allowed)
+
+    def process_new_callback_query(self, new_callback_querys):
+        new_callback_querys = [c for c in new_callback_querys if self.flood_guard.allow_callback(c)]
+        if new_callback_querys:
+            super().process_new_callback_query(new_callback_querys)
+
     def try_to_send_message(self, *args, **kwargs):
         try:
             return self.send_message(*args, **kwargs)
@@ -73,7 +253,8 @@ class MafiaHostBot(TeleBot):
 
             # --- ИТОГ ---
             if should_delete:
-                self.safely_delete_message(chat_id=message.chat.id, message_id=message.message_id)
+                # Удаляется пачкой фоновым потоком (flush_deletions)
+                self.deletion_queue.add(message.chat.id, message.message_id)
                 return
 
             return handler(message, game, *args, **kwargs)
@@ -103,4 +284,46 @@ class MafiaHostBot(TeleBot):
             if "message to delete not found" not in str(e).lower():
                 logger.debug(f'Не удалось удалить сообщение: {e}')
 
-bot = MafiaHostBot(config.TOKEN, skip_pending=config.SKIP_PENDING)
\ No newline at end of file
+    def delete_messages(self, chat_id, message_ids):
+        """Удалить несколько сообщений одним запросом deleteMessages
+
+        Если API отклонил запрос, удаляет по одному. Сетевые ошибки пробрасываются:
+        flush_deletions вернёт пачку в очередь.
+        """
+        try:
+            apihelper._make_request(self.token, 'deleteMessages', params={
+                'chat_id': chat_id,
+                'message_ids': json.dumps(message_ids)
+            }, method='post')
+        except ApiException as e:
+            logger.debug(f'deleteMessages не сработал, удаляю по одному: {e}')
+            for message_id in message_ids:
+                self.safely_delete_message(chat_id=chat_id, message_id=message_id)
+
+    def flush_deletions(self):
+        """Удалить накопленные сообщения (чаты с недавними отправками бота ждут)
+
+        Returns:
+            Количество удалённых сообщений
+        """
+        now = monotonic()
+        grace = getattr(config, 'DELETE_FLUSH_INTERVAL', 1)
+        busy_chats = {chat_id for chat_id, sent_at in list(self.last_send.items()) if now - sent_at < grace}
+        batches = self.deletion_queue.take_ready(now, busy_chats)
+        deleted = 0
+        for i, (chat_id, message_ids) in enumerate(batches):
+            try:
+                self.delete_messages(chat_id, message_ids)
+            except Exception as e:
+                # Сеть недоступна: эта и оставшиеся пачки удалятся при следующем проходе
+                logger.warning(f'Не удалось удалить сообщения, пачки возвращены в очередь: {e}')
+                for chat_id, message_ids in batches[i:]:
+                    self.deletion_queue.requeue(chat_id, message_ids)
+                break
+            deleted += len(message_ids)
+        # Старые отметки об отправке больше не влияют на очередь
+        for chat_id in [c for c, sent_at in list(self.last_send.items()) if now - sent_at >= grace]:
+            self.last_send.pop(chat_id, None)
+        return deleted
+
+bot = MafiaHostBot(config.TOKEN, skip_pending=config.SKIP_PENDING)
@@ -0,0 +1,229 @@
+# candies.py
+"""
+Конфеты: атомарные начисления и списания через журнал операций.
+
+Баланс хранится в player_stats.candies и меняется только через $inc, поэтому
+параллельные начисления не теряются. Каждая операция записывается в коллекцию
+candy_ledger; операции с ключом идемпотентности (id платежа Telegram, id дропа
+и т.п.) применяются не больше одного раза. Сверка журнала с балансами —
+reconcile_balances() (команда /reconcile_candies или офлайн):
+
+    python src/candies.py [--fix]
+"""
+import sys
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+
+import database
+
+LEDGER = 'candy_ledger'
+
+# Операции с журналом и балансом выполняются последовательно: проверка ключа
+# идемпотентности и запись операции не должны перемежаться между потоками, а
+# сверка не должна видеть изменённый баланс без его записи в журнале
+_ledger_lock = threading.Lock()
+
+# {user_id: баланс} — копия player_stats.candies, обновляется при каждой записи
+_balances: Dict[int, int] = {}
+
+# Использованные ключи идемпотентности: журнал только дополняется, поэтому множество
+# строится одним чтением при первой проверке и дальше пополняется при записи в журнал
+_used_keys: Set[str] = set()
+_keys_loaded = False
+
+def _on_stats_write(doc: Dict):
+    user_id = doc.get('user_id')
+    if user_id is not None:
+        _balances[user_id] = doc.get('candies', 0)
+
+def get_balance(user_id: int) -> int:
+    """Текущий баланс конфет игрока"""
+    balance = _balances.get(user_id)
+    if balance is None:
+        stats = database.find_one('player_stats', {'user_id': user_id})
+        balance = stats.get('candies', 0) if stats else 0
+        _balances.setdefault(user_id, balance)
+    return balance
+
+def ledger_entry(user_id: int, amount: int, reason: str, key: Optional[str] = None) -> Dict:
+    """Запись журнала для операции, применённой вызывающим кодом в своей записи статистики"""
+    return {
+        'user_id': user_id,
+        'amount': amount,
+        'reason': reason,
+        'key': key,
+        'created_at': datetime.now().isoformat()
+    }
+
+@contextmanager
+def balance_update():
+    """
+    Блокировка для кода, который сам меняет баланс в своей записи статистики
+
+    Запись с $inc по candies и record_entries() с её операциями выполняются внутри
+    одного блока, как это делают credit() и debit():
+
+        with balance_update():
+            database.update_one('player_stats', ..., {'$inc': {'candies': reward}})
+            record_entries([ledger_entry(user_id, reward, 'reason')])
+    """
+    with _ledger_lock:
+        yield
+
+def record_entries(entries: List[Dict]):
+    """Записать в журнал операции, уже применённые к балансу через $inc (внутри balance_update)"""
+    entries = [e for e in entries if e['amount']]
+    if entries:
+        database.insert_many(LEDGER, entries)
+
+def _on_ledger_write(entry: Dict):
+    if entry.get('key') is not None:
+        _used_keys.add(entry['key'])
+
+def _key_used(key: Optional[str]) -> bool:
+    """Проверка ключа (вызывается под _ledger_lock)"""
+    global _keys_loaded
+    if not _keys_loaded:
+        _used_keys.update(e['key'] for e in database.find(LEDGER, {}) if e.get('key') is not None)
+        _keys_loaded = True
+    return key is not None and key in _used_keys
+
+def credit(user_id: int, amount: int, reason: str, key: Optional[str] = None) -> bool:
+    """
+    Начислить конфеты игроку
+
+    Args:
+        user_id: ID пользователя
+        amount: Количество конфет
+        reason: Причина (для журнала)
+        key: Ключ идемпотентности; повторная операция с тем же ключом игнорируется
+
+    Returns:
+        True если начисление применено, False если ключ уже использован
+    """
+    with _ledger_lock:
+        if _key_used(key):
+            return False
+        # Сначала баланс, как в debit(): если запись не удалась, ключ не сгорает
+        database.update_one('player_stats', {'user_id': user_id}, {'$inc': {'candies': amount}}, upsert=True)
+        database.insert_one(LEDGER, ledger_entry(user_id, amount, reason, key))
+        return True
+
+def debit(user_id: int, amount: int, reason: str, key: Optional[str] = None) -> bool:
+    """
+    Списать конфеты, если их хватает
+
+    Returns:
+        True если списание применено, False если конфет недостаточно или ключ уже использован
+    """
+    with _ledger_lock:
+        if _key_used(key):
+            return False
+        # Проверка баланса и списание — одна атомарная операция над документом
+        updated = database.find_one_and_update(
+            'player_stats',
+            {'user_id': user_id, 'candies': {'$gte': amount}},
+            {'$inc': {'candies': -amount}}
+        )
+        if updated is None:
+            return False
+        database.insert_one(LEDGER, ledger_entry(user_id, -amount, reason, key))
+        return True
+
+def credit_many(amounts: Dict[int, int], reason: str, key: Optional[str] = None) -> int:
+    """
+    Начислить конфеты многим игрокам одним $inc по коллекции
+
+    Игроки без статистики пропускаются.
+
+    Args:
+        amounts: {user_id: количество}
+        reason: Причина (для журнала)
+        key: Общий ключ операции; ключ каждого игрока — '<key>:<user_id>'
+
+    Returns:
+        Количество игроков, которым начислены конфеты
+    """
+    amounts = {user_id: amount for user_id, amount in amounts.items() if amount}
+    if not amounts:
+        return 0
+    with _ledger_lock:
+        if key is not None:
+            amounts = {uid: amount for uid, amount in amounts.items() if not _key_used(f'{key}:{uid}')}
+        existing = {d['user_id'] for d in database.find('player_stats', {'user_id': {'$in': list(amounts)}})}
+        amounts = {uid: amount for uid, amount in amounts.items() if uid in existing}
+        if not amounts:
+            return 0
+        credited = database.bulk_update('player_stats', {uid: {'$inc': {'candies': amount}} for uid, amount in amounts.items()},
+                                        key='user_id')
+        database.insert_many(LEDGER, [
+            ledger_entry(uid, amount, reason, f'{key}:{uid}' if key is not None else None)
+            for uid, amount in amounts.items()
+        ])
+        return credited
+
+def migrate_candy_ledger() -> int:
+    """Однократно записать текущие балансы в журнал как начальные остатки
+
+    Returns:
+        Количество записанных остатков (0, если миграция уже применялась)
+    """
+    if database.find_one('migrations', {'name': 'candy_ledger_opening'}):
+        return 0
+    with _ledger_lock:
+        entries = [
+            ledger_entry(stats['user_id'], stats.get('candies', 0), 'opening_balance')
+            for stats in database.find('player_stats', {})
+            if stats.get('user_id') is not None and stats.get('candies')
+        ]
+        record_entries(entries)
+        database.insert_one('migrations', {'name': 'candy_ledger_opening', 'applied_at': datetime.now().isoformat(),
+                                           'documents': len(entries)})
+    return len(entries)
+
+def reconcile_balances(fix: bool = False) -> Dict:
+    """
+    Сверить балансы с журналом за одно чтение каждой коллекции
+
+    Args:
+        fix: Привести балансы к сумме журнала (журнал считается источником истины)
+
+    Returns:
+        {'checked': int, 'mismatches': [{'user_id', 'balance', 'ledger'}], 'fixed': int}
+    """
+    with _ledger_lock:
+        totals: Dict[int, int] = {}
+        for entry in database.find(LEDGER, {}):
+            totals[entry['user_id']] = totals.get(entry['user_id'], 0) + entry.get('amount', 0)
+
+        mismatches = []
+        updates = {}
+        checked = 0
+        for stats in database.find('player_stats', {}):
+            user_id = stats.get('user_id')
+            if user_id is None:
+                continue
+            checked += 1
+            balance = stats.get('candies', 0)
+            expected = totals.pop(user_id, 0)
+            if balance != expected:
+                mismatches.append({'user_id': user_id, 'balance': balance, 'ledger': expected})
+                updates[stats['_id']] = {'$inc': {'candies': expected - balance}}
+        # Операции в журнале у игроков без статистики
+        for user_id, expected in totals.items():
+            if expected:
+                mismatches.append({'user_id': user_id, 'balance': None, 'ledger': expected})
+
+        fixed = database.bulk_update('player_stats', updates) if fix and updates else 0
+    return {'checked': checked, 'mismatches': mismatches, 'fixed': fixed}
+
+database.on_write('player_stats', _on_stats_write)
+database.on_write(LEDGER, _on_ledger_write)
+
+if __name__ == '__main__':
+    result = reconcile_balances(fix='--fix' in sys.argv)
+    for row in result['mismatches']:
+        print(f"user {row['user_id']}: balance {row['balance']}, ledger {row['ledger']}")
+    print(f"Checked {result['checked']} balances, {len(result['mismatches'])} mismatches, {result['fixed']} fixed")
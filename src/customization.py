@@ -1,16 +1,47 @@
 # customization.py
 import database
 import logging
+import threading
 
 logger = logging.getLogger(__name__)
 
-def get_customization(user_id, chat_id=None):
-    """Получить кастомизацию для пользователя"""
-    query = {'user_id': user_id}
-    if chat_id:
-        query['chat_id'] = chat_id
+# Кэш кастомизаций: {user_id: {chat_id или None (общая): документ или None (нет записи)}}.
+# Любая запись в customizations сбрасывает кэш пользователя; версия не даёт
+# положить в кэш документ, прочитанный до параллельной записи.
+_cache = {}
+_versions = {}
+_cache_lock = threading.Lock()
+
+def _on_customization_write(doc):
+    user_id = doc.get('user_id')
+    with _cache_lock:
+        _cache.pop(user_id, None)
+        _versions[user_id] = _versions.get(user_id, 0) + 1
+
+def _customization_query(user_id, chat_id):
+    """Запрос записи для чата; без chat_id — только общая запись (chat_id не задан)"""
+    return {'user_id': user_id, 'chat_id': chat_id or None}
+
+def _lookup(user_id, chat_id):
+    """Документ кастомизации через кэш (chat_id None — общая запись пользователя)"""
+    with _cache_lock:
+        entries = _cache.get(user_id)
+        if entries is not None and chat_id in entries:
+            return entries[chat_id]
+        version = _versions.get(user_id, 0)
     
-    customization = database.find_one('customizations', query)
+    customization = database.find_one('customizations', _customization_query(user_id, chat_id))
+    
+    with _cache_lock:
+        if _versions.get(user_id, 0) == version:
+            _cache.setdefault(user_id, {})[chat_id or None] = customization
+    return customization
+
+def get_customization(user_id, chat_id=None):
+    """Получить кастомизацию для пользователя (в чате без своей — общую)"""
+    customization = _lookup(user_id, chat_id) if chat_id else None
+    if not customization:
+        customization = _lookup(user_id, None)
     if not customization:
         # Возвращаем дефолтную кастомизацию
         return {
@@ -20,15 +51,11 @@ def get_customization(user_id, chat_id=None):
             'role_suffix': '',
             'name_formatting': 'normal'  # normal, bold, italic
         }
-    return customization
+    return dict(customization)
 
 def set_role_prefix(user_id, prefix, chat_id=None):
     """Установить префикс для роли"""
-    query = {'user_id': user_id}
-    if chat_id:
-        query['chat_id'] = chat_id
-    
-    customization = database.find_one('customizations', query)
+    customization = database.find_one('customizations', _customization_query(user_id, chat_id))
     if customization:
         database.update_one('customizations', {'_id': customization['_id']}, {
             '$set': {'role_prefix': prefix}
@@ -46,11 +73,7 @@ def set_role_prefix(user_id, prefix, chat_id=None):
 
 def set_role_suffix(user_id, suffix, chat_id=None):
     """Установить суффикс для роли"""
-    query = {'user_id': user_id}
-    if chat_id:
-        query['chat_id'] = chat_id
-    
-    customization = database.find_one('customizations', query)
+    customization = database.find_one('customizations', _customization_query(user_id, chat_id))
     if customization:
         database.update_one('customizations', {'_id': customization['_id']}, {
             '$set': {'role_suffix': suffix}
@@ -71,11 +94,7 @@ def set_name_formatting(user_id, formatting, chat_id=None):
     if formatting not in ('normal', 'bold', 'italic'):
         return False
     
-    query = {'user_id': user_id}
-    if chat_id:
-        query['chat_id'] = chat_id
-    
-    customization = database.find_one('customizations', query)
+    customization = database.find_one('customizations', _customization_query(user_id, chat_id))
     if customization:
         database.update_one('customizations', {'_id': customization['_id']}, {
             '$set': {'name_formatting': formatting}
@@ -113,41 +132,92 @@ def format_role_name(role_name, user_id, chat_id=None):
     
     return role_name
 
-def award_customization_from_achievement(user_id, achievement_id):
-    """Выдать кастомизацию за достижение"""
-    # Определяем, какая кастомизация выдается за достижение
-    achievement_rewards = {
-        'first_win': {'prefix': '🏆', 'suffix': ''},
-        'win_streak_5': {'prefix': '🔥', 'suffix': ''},
-        'win_streak_10': {'prefix': '💎', 'suffix': ''},
-        'games_100': {'prefix': '⭐', 'suffix': ''},
-        'games_500': {'prefix': '👑', 'suffix': ''},
-        'elo_2000': {'prefix': '', 'suffix': '👑'},
-        'elo_1800': {'prefix': '', 'suffix': '💎'},
-        'elo_1600': {'prefix': '', 'suffix': '⭐'},
-        'perfect_game': {'prefix': '✨', 'suffix': '✨'},
-        'mafia_master': {'prefix': '😈', 'suffix': ''},
-        'peaceful_guardian': {'prefix': '🛡️', 'suffix': ''},
+# Кастомизация, которая выдается за достижения
+ACHIEVEMENT_REWARDS = {
+    'first_win': {'prefix': '🏆', 'suffix': ''},
+    'win_streak_5': {'prefix': '🔥', 'suffix': ''},
+    'win_streak_10': {'prefix': '💎', 'suffix': ''},
+    'games_100': {'prefix': '⭐', 'suffix': ''},
+    'games_500': {'prefix': '👑', 'suffix': ''},
+    'elo_2000': {'prefix': '', 'suffix': '👑'},
+    'elo_1800': {'prefix': '', 'suffix': '💎'},
+    'elo_1600': {'prefix': '', 'suffix': '⭐'},
+    'perfect_game': {'prefix': '✨', 'suffix': '✨'},
+    'mafia_master': {'prefix': '😈', 'suffix': ''},
+    'peaceful_guardian': {'prefix': '🛡️', 'suffix': ''},
+}
+
+def _reward_fields(achievement_ids):
+    """Поля кастомизации за набор достижений (поздние перекрывают ранние, как при выдаче по одному)"""
+    fields = {}
+    for achievement_id in achievement_ids:
+        reward = ACHIEVEMENT_REWARDS.get(achievement_id)
+        if not reward:
+            continue
+        if reward.get('prefix'):
+            fields['role_prefix'] = reward['prefix']
+        if reward.get('suffix'):
+            fields['role_suffix'] = reward['suffix']
+    return fields
+
+def _default_customization(user_id, fields):
+    customization = {
+        'user_id': user_id,
+        'chat_id': None,
+        'role_prefix': '',
+        'role_suffix': '',
+        'name_formatting': 'normal'
     }
+    customization.update(fields)
+    return customization
+
+def award_customization_bulk(rewards):
+    """Выдать кастомизацию многим игрокам за одно чтение и две записи коллекции
+
+    Args:
+        rewards: {user_id: [achievement_id, ...]}
+    """
+    fields_by_user = {}
+    for user_id, achievement_ids in rewards.items():
+        fields = _reward_fields(achievement_ids)
+        if fields:
+            fields_by_user[user_id] = fields
+    if not fields_by_user:
+        return 0
     
-    reward = achievement_rewards.get(achievement_id)
-    if not reward:
-        return False
+    # Общая кастомизация пользователя (как в set_role_prefix без chat_id)
+    existing = {}
+    for doc in database.find('customizations', {'user_id': {'$in': list(fields_by_user)}, 'chat_id': None}):
+        existing.setdefault(doc['user_id'], doc['_id'])
     
-    # Применяем награду
-    if reward.get('prefix'):
-        set_role_prefix(user_id, reward['prefix'])
-    if reward.get('suffix'):
-        set_role_suffix(user_id, reward['suffix'])
+    updates = {existing[uid]: {'$set': fields} for uid, fields in fields_by_user.items() if uid in existing}
+    inserts = [_default_customization(uid, fields) for uid, fields in fields_by_user.items() if uid not in existing]
+    if updates:
+        database.bulk_update('customizations', updates)
+    if inserts:
+        database.insert_many('customizations', inserts)
+    return len(fields_by_user)
+
+def award_customization_from_achievements(user_id, achievement_ids):
+    """Выдать кастомизацию сразу за несколько достижений одной записью"""
+    fields = _reward_fields(achievement_ids)
+    if not fields:
+        return False
     
+    customization = database.find_one('customizations', _customization_query(user_id, None))
+    if customization:
+        database.update_one('customizations', {'_id': customization['_id']}, {'$set': fields})
+    else:
+        database.insert_one('customizations', _default_customization(user_id, fields))
     return True
 
+def award_customization_from_achievement(user_id, achievement_id):
+    """Выдать кастомизацию за достижение"""
+    return award_customization_from_achievements(user_id, [achievement_id])
+
 def clear_customization(user_id, chat_id=None):
-    """Очистить кастомизацию"""
-    query = {'user_id': user_id}
-    if chat_id:
-        query['chat_id'] = chat_id
-    
-    database.delete_one('customizations', query)
+    """Очистить кастомизацию (в чате — только запись этого чата)"""
+    database.delete_one('customizations', _customization_query(user_id, chat_id))
     return True
 
+database.on_write('customizations', _on_customization_write)
@@ -1,6 +1,6 @@
 import os
 from pathlib import Path
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, Callable, List, Optional
 import json
 import uuid
 import threading
@@ -12,6 +12,34 @@ class Database:
         self.db_path.mkdir(exist_ok=True)
         self._locks: Dict[str, threading.Lock] = {}
         self._global_lock = threading.Lock()
+        self._write_listeners: Dict[str, List[Callable[[Dict[str, Any]], None]]] = {}
+        self._delete_listeners: Dict[str, List[Callable[[Dict[str, Any]], None]]] = {}
+
+    def on_write(self, collection_name: str, callback: Callable[[Dict[str, Any]], None]):
+        """Подписаться на изменения коллекции (вставка, обновление, удаление).
+
+        callback получает затронутый документ с '_id' и вызывается под блокировкой
+        коллекции, поэтому не должен обращаться к базе — только обновлять память.
+        """
+        self._write_listeners.setdefault(collection_name, []).append(callback)
+
+    def on_delete(self, collection_name: str, callback: Callable[[Dict[str, Any]], None]):
+        """Подписаться на удаление документов коллекции.
+
+        Вызывается после подписчиков on_write с удалённым документом и с теми же
+        ограничениями: под блокировкой коллекции, без обращений к базе.
+        """
+        self._delete_listeners.setdefault(collection_name, []).append(callback)
+
+    def _notify_write(self, collection_name: str, doc_id: str, doc: Dict[str, Any], deleted: bool = False):
+        listeners = list(self._write_listeners.get(collection_name, ()))
+        if deleted:
+            listeners += self._delete_listeners.get(collection_name, ())
+        for callback in listeners:
+            try:
+                callback({**doc, '_id': doc_id})
+            except Exception:
+                pass
 
     def _get_lock(self, collection_name: str) -> threading.Lock:
         with self._global_lock:
@@ -186,8 +214,79 @@ class Database:
             doc_id = str(uuid.uuid4())
             collection[doc_id] = document
             self._write_collection(collection_name, collection)
+            self._notify_write(collection_name, doc_id, document)
             return doc_id
     
+    def insert_many(self, collection_name: str, documents: List[Dict[str, Any]]) -> List[str]:
+        """Вставить несколько документов одной записью коллекции"""
+        with self._get_lock(collection_name):
+            collection = self._read_collection(collection_name)
+            doc_ids = []
+            for document in documents:
+                doc_id = str(uuid.uuid4())
+                collection[doc_id] = document
+                doc_ids.append(doc_id)
+            if doc_ids:
+                self._write_collection(collection_name, collection)
+                for doc_id, document in zip(doc_ids, documents):
+                    self._notify_write(collection_name, doc_id, document)
+            return doc_ids
+    
+    def _apply_update(self, doc: Dict[str, Any], update: Dict[str, Any]):
+        """Применить операторы обновления ($set, $inc, $push, ...) к документу"""
+        if '$set' in update:
+            for k, v in update['$set'].items(): self._set_path(doc, k, v)
+        if '$inc' in update:
+            for k, v in update['$inc'].items():
+                current_val = self._get_path(doc, k) or 0
+                self._set_path(doc, k, current_val + v)
+        if '$push' in update:
+            for k, v in update['$push'].items():
+                target_list = self._get_path(doc, k)
+                if target_list is None:
+                    target_list = []
+                    self._set_path(doc, k, target_list)
+                if isinstance(target_list, list): target_list.append(v)
+        if '$addToSet' in update:
+            for k, v in update['$addToSet'].items():
+                target_list = self._get_path(doc, k)
+                if target_list is None:
+                    target_list = []
+                    self._set_path(doc, k, target_list)
+                if isinstance(target_list, list):
+                    # {'$each': [...]} добавляет несколько значений за раз
+                    values = v['$each'] if isinstance(v, dict) and '$each' in v else [v]
+                    for value in values:
+                        if value not in target_list: target_list.append(value)
+        
+        # ИСПРАВЛЕННАЯ ЛОГИКА $pull
+        if '$pull' in update:
+            for k, v in update['$pull'].items():
+                target_list = self._get_path(doc, k)
+                if isinstance(target_list, list):
+                    new_list = []
+                    for item in target_list:
+                        should_remove = False
+                        # Проверка удаления по словарю (например {id: 123})
+                        if isinstance(v, dict):
+                            # Если критерий - словарь, проверяем соответствие полей
+                            match = True
+                            for sub_k, sub_v in v.items():
+                                if not isinstance(item, dict) or item.get(sub_k) != sub_v:
+                                    match = False
+                                    break
+                            if match: should_remove = True
+                        # Проверка удаления по значению
+                        elif item == v:
+                            should_remove = True
+                        
+                        if not should_remove:
+                            new_list.append(item)
+                    self._set_path(doc, k, new_list)
+
+        if '$unset' in update:
+            for k in update['$unset']: self._unset_path(doc, k)
+
     def update_one(self, collection_name: str, query: Dict[str, Any], update: Dict[str, Any], upsert: bool = False) -> bool:
         with self._get_lock(collection_name):
             collection = self._read_collection(collection_name)
@@ -196,58 +295,11 @@ class Database:
             for doc_id, doc in collection.items():
                 full_doc = {**doc, '_id': doc_id}
                 if self._matches_query(full_doc, query):
-                    if '$set' in update:
-                        for k, v in update['$set'].items(): self._set_path(doc, k, v)
-                    if '$inc' in update:
-                        for k, v in update['$inc'].items():
-                            current_val = self._get_path(doc, k) or 0
-                            self._set_path(doc, k, current_val + v)
-                    if '$push' in update:
-                        for k, v in update['$push'].items():
-                            target_list = self._get_path(doc, k)
-                            if target_list is None:
-                                target_list = []
-                                self._set_path(doc, k, target_list)
-                            if isinstance(target_list, list): target_list.append(v)
-                    if '$addToSet' in update:
-                        for k, v in update['$addToSet'].items():
-                            target_list = self._get_path(doc, k)
-                            if target_list is None:
-                                target_list = []
-                                self._set_path(doc, k, target_list)
-                            if isinstance(target_list, list):
-                                if v not in target_list: target_list.append(v)
-                    
-                    # ИСПРАВЛЕННАЯ ЛОГИКА $pull
-                    if '$pull' in update:
-                        for k, v in update['$pull'].items():
-                            target_list = self._get_path(doc, k)
-                            if isinstance(target_list, list):
-                                new_list = []
-                                for item in target_list:
-                                    should_remove = False
-                                    # Проверка удаления по словарю (например {id: 123})
-                                    if isinstance(v, dict):
-                                        # Если критерий - словарь, проверяем соответствие полей
-                                        match = True
-                                        for sub_k, sub_v in v.items():
-                                            if not isinstance(item, dict) or item.get(sub_k) != sub_v:
-                                                match = False
-                                                break
-                                        if match: should_remove = True
-                                    # Проверка удаления по значению
-                                    elif item == v:
-                                        should_remove = True
-                                    
-                                    if not should_remove:
-                                        new_list.append(item)
-                                self._set_path(doc, k, new_list)
-
-                    if '$unset' in update:
-                        for k in update['$unset']: self._unset_path(doc, k)
+                    self._apply_update(doc, update)
 
                     collection[doc_id] = doc
                     self._write_collection(collection_name, collection)
+                    self._notify_write(collection_name, doc_id, doc)
                     return True
             
             if not updated and upsert:
@@ -259,10 +311,46 @@ class Database:
                 doc_id = str(uuid.uuid4())
                 collection[doc_id] = new_doc
                 self._write_collection(collection_name, collection)
+                self._notify_write(collection_name, doc_id, new_doc)
                 return True
 
             return False
             
+    def bulk_update(self, collection_name: str, updates: Dict[Any, Dict[str, Any]], key: str = '_id') -> int:
+        """Применить много обновлений за одно чтение и одну запись коллекции
+
+        Args:
+            updates: {значение ключа: операторы обновления}
+            key: Поле, по которому ищутся документы ('_id' или, например, 'user_id').
+                Для полей, отличных от '_id', обновляется первый подходящий документ.
+
+        Returns:
+            Количество обновлённых документов
+        """
+        with self._get_lock(collection_name):
+            collection = self._read_collection(collection_name)
+            if key == '_id':
+                targets = [(doc_id, collection.get(doc_id), update) for doc_id, update in updates.items()]
+            else:
+                doc_ids = {}
+                for doc_id, doc in collection.items():
+                    value = doc.get(key)
+                    if value in updates and value not in doc_ids:
+                        doc_ids[value] = doc_id
+                targets = [(doc_ids[value], collection[doc_ids[value]], update)
+                           for value, update in updates.items() if value in doc_ids]
+            updated = []
+            for doc_id, doc, update in targets:
+                if doc is None:
+                    continue
+                self._apply_update(doc, update)
+                updated.append((doc_id, doc))
+            if updated:
+                self._write_collection(collection_name, collection)
+                for doc_id, doc in updated:
+                    self._notify_write(collection_name, doc_id, doc)
+            return len(updated)
+
     def delete_one(self, collection_name: str, query: Dict[str, Any]) -> bool:
         with self._get_lock(collection_name):
             collection = self._read_collection(collection_name)
@@ -271,6 +359,7 @@ class Database:
                 if self._matches_query(full_doc, query):
                     del collection[doc_id]
                     self._write_collection(collection_name, collection)
+                    self._notify_write(collection_name, doc_id, doc, deleted=True)
                     return True
             return False
 
@@ -284,9 +373,10 @@ class Database:
                     to_delete.append(doc_id)
             
             if to_delete:
-                for doc_id in to_delete:
-                    del collection[doc_id]
+                deleted = [(doc_id, collection.pop(doc_id)) for doc_id in to_delete]
                 self._write_collection(collection_name, collection)
+                for doc_id, doc in deleted:
+                    self._notify_write(collection_name, doc_id, doc, deleted=True)
             
             return len(to_delete)
 
@@ -361,6 +451,7 @@ class Database:
             
             # Сохраняем изменения
             self._write_collection(collection_name, collection)
+            self._notify_write(collection_name, found_id, found_doc)
             
             # Возвращаем обновленный документ
             return_document = kwargs.get('return_document', False)
@@ -378,4 +469,8 @@ insert_one = db_instance.insert_one
 update_one = db_instance.update_one
 delete_one = db_instance.delete_one
 delete_many = db_instance.delete_many
-find_one_and_update = db_instance.find_one_and_update
\ No newline at end of file
+find_one_and_update = db_instance.find_one_and_update
+insert_many = db_instance.insert_many
+bulk_update = db_instance.bulk_update
+on_write = db_instance.on_write
+on_delete = db_instance.on_delete
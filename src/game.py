@@ -1,6 +1,9 @@
+import config
 from bot import bot
 import database
+from candies import balance_update, get_balance, ledger_entry, record_entries
 from html import escape 
+import math
 import random
 
 role_titles = {
@@ -24,6 +27,41 @@ role_titles = {
 def get_role_name(role_code):
     return role_titles.get(role_code, f'❓ Роль ({role_code})')
 
+# --- РЕЙТИНГ ---
+
+# Состав команд по ролям (роли вне команд считаются проигравшими всегда)
+PEACEFUL_ROLES = ('peace', 'civilian', 'commissar', 'sergeant', 'doctor', 'lucky', 'kamikaze')
+MAFIA_ROLES = ('mafia', 'don')
+MANIAC_ROLES = ('maniac',)
+
+# Параметры командной байесовской модели (TrueSkill).
+# Масштаб подобран так, чтобы консервативная оценка новичка (mu - 3*sigma) была равна 1000,
+# как стартовый ELO: тогда ранги, достижения и лидерборд работают без изменений.
+TRUESKILL_SIGMA = 500.0 / 3
+TRUESKILL_BETA = TRUESKILL_SIGMA / 2  # Разброс результата одной игры
+TRUESKILL_TAU = TRUESKILL_SIGMA / 100  # Динамика навыка между играми
+TRUESKILL_MIN_SIGMA = 1.0
+
+def get_winner_team(reason):
+    """Определить победившую команду по тексту причины завершения игры"""
+    if 'Мирные победили' in reason or 'Победа Добра' in reason:
+        return 'peaceful'
+    elif 'Мафия победила' in reason or 'Победа Зла' in reason:
+        return 'mafia'
+    elif 'Маньяк победил' in reason:
+        return 'maniac'
+    return None
+
+def get_player_team(role):
+    """Команда, к которой относится роль (None для ролей вне команд)"""
+    if role in PEACEFUL_ROLES:
+        return 'peaceful'
+    elif role in MAFIA_ROLES:
+        return 'mafia'
+    elif role in MANIAC_ROLES:
+        return 'maniac'
+    return None
+
 def calculate_expected_score(player_rating, opponent_rating):
     """Рассчитать ожидаемый результат (0-1) на основе рейтингов"""
     return 1 / (1 + 10 ** ((opponent_rating - player_rating) / 400))
@@ -37,55 +75,75 @@ def get_k_factor(games_played):
     else:
         return 16  # Опытные игроки - меньше изменений
 
-def update_elo_rating(game, reason):
-    """Обновить ELO рейтинг игроков после завершения игры"""
-    # Определяем победившую команду
-    winner_team = None
-    if 'Мирные победили' in reason or 'Победа Добра' in reason:
-        winner_team = 'peaceful'
-    elif 'Мафия победила' in reason or 'Победа Зла' in reason:
-        winner_team = 'mafia'
-    elif 'Маньяк победил' in reason:
-        winner_team = 'maniac'
-    
-    if not winner_team:
-        return  # Неизвестный результат, пропускаем
-    
-    # Получаем статистику всех игроков для расчета среднего рейтинга
-    players_stats = {}
+def _load_players_stats(game):
+    """Прочитать статистику всех игроков партии одним запросом"""
+    user_ids = [p['id'] for p in game['players']]
+    found = database.find('player_stats', {'user_id': {'$in': user_ids}})
+    return {stats['user_id']: stats for stats in found}
+
+def _new_rating_stats(player, fields):
+    """Запись статистики нового игрока с полями рейтинга"""
+    new_stats = {
+        'user_id': player['id'],
+        'name': player.get('name', 'Игрок'),
+        'games_played': 0,
+        'games_won': 0,
+        'games_lost': 0,
+        'roles_played': {},
+        'wins_by_role': {},
+        'wins_by_team': {'peaceful': 0, 'mafia': 0, 'maniac': 0},
+        'candies': 0
+    }
+    new_stats.update(fields)
+    return new_stats
+
+def _save_ratings(game, players_stats, fields_by_user):
+    """Сохранить поля рейтинга всей партии: одна запись для известных игроков, одна вставка для новых
+
+    players_stats обновляется на месте (новые игроки добавляются в него), чтобы
+    update_player_stats продолжил работу с ним без повторного чтения.
+    """
+    updates = {}
+    new_docs = []
     for player in game['players']:
         user_id = player['id']
-        stats = database.find_one('player_stats', {'user_id': user_id})
-        if not stats:
-            # Инициализируем рейтинг для новых игроков
-            elo_rating = 1000  # Начальный рейтинг
+        fields = fields_by_user[user_id]
+        stats = players_stats.get(user_id)
+        if stats:
+            updates[user_id] = {'$set': fields}
+            stats.update(fields)
         else:
-            elo_rating = stats.get('elo_rating', 1000)
-        players_stats[user_id] = {
-            'stats': stats,
-            'rating': elo_rating,
-            'player': player
-        }
+            new_docs.append(_new_rating_stats(player, fields))
+            players_stats[user_id] = _new_rating_stats(player, fields)
+    if updates:
+        database.bulk_update('player_stats', updates, key='user_id')
+    if new_docs:
+        database.insert_many('player_stats', new_docs)
+
+def update_elo_rating(game, reason, players_stats=None):
+    """Обновить ELO рейтинг игроков после завершения игры
+
+    players_stats - уже прочитанная статистика партии (см. _load_players_stats)
+
+    Returns:
+        {user_id: (новый рейтинг, изменение)}
+    """
+    winner_team = get_winner_team(reason)
+    if not winner_team:
+        return {}  # Неизвестный результат, пропускаем
+    
+    if players_stats is None:
+        players_stats = _load_players_stats(game)
     
     # Рассчитываем средний рейтинг всех игроков
-    all_ratings = [p['rating'] for p in players_stats.values()]
+    all_ratings = [players_stats.get(p['id'], {}).get('elo_rating', 1000) for p in game['players']]
     average_rating = sum(all_ratings) / len(all_ratings) if all_ratings else 1000
     
-    # Обновляем рейтинг для каждого игрока
-    for user_id, player_data in players_stats.items():
-        player = player_data['player']
-        role = player.get('role', 'peace')
-        stats = player_data['stats']
-        current_rating = player_data['rating']
-        
-        # Определяем, выиграл ли игрок
-        won = False
-        if winner_team == 'peaceful' and role in ('peace', 'civilian', 'commissar', 'sergeant', 'doctor', 'lucky', 'kamikaze'):
-            won = True
-        elif winner_team == 'mafia' and role in ('mafia', 'don'):
-            won = True
-        elif winner_team == 'maniac' and role == 'maniac':
-            won = True
+    changes = {}
+    fields = {}
+    for player, current_rating in zip(game['players'], all_ratings):
+        stats = players_stats.get(player['id'])
+        won = get_player_team(player.get('role', 'peace')) == winner_team
         
         # Фактический результат (1.0 за победу, 0.0 за поражение)
         actual_score = 1.0 if won else 0.0
@@ -101,43 +159,247 @@ def update_elo_rating(game, reason):
         rating_change = k_factor * (actual_score - expected_score)
         new_rating = max(0, int(current_rating + rating_change))  # Рейтинг не может быть отрицательным
         
-        # Сохраняем новый рейтинг
-        if stats:
-            stats['elo_rating'] = new_rating
-            stats['elo_change'] = int(rating_change)  # Изменение рейтинга для отображения
-            database.update_one('player_stats', {'user_id': user_id}, {'$set': stats}, upsert=True)
-        else:
-            # Создаем новую запись
-            new_stats = {
-                'user_id': user_id,
-                'name': player.get('name', 'Игрок'),
-                'elo_rating': new_rating,
-                'elo_change': int(rating_change),
-                'games_played': 0,
-                'games_won': 0,
-                'games_lost': 0,
-                'roles_played': {},
-                'wins_by_role': {},
-                'wins_by_team': {'peaceful': 0, 'mafia': 0, 'maniac': 0},
-                'candies': 0
-            }
-            database.insert_one('player_stats', new_stats)
+        fields[player['id']] = {
+            'elo_rating': new_rating,
+            'elo_change': int(rating_change)  # Изменение рейтинга для отображения
+        }
+        changes[player['id']] = (new_rating, int(rating_change))
+    _save_ratings(game, players_stats, fields)
+    return changes
+
+def _norm_pdf(x):
+    return math.exp(-x * x / 2) / math.sqrt(2 * math.pi)
+
+def _norm_cdf(x):
+    return 0.5 * (1 + math.erf(x / math.sqrt(2)))
+
+def _trueskill_v_w(t):
+    """Поправочные функции TrueSkill для победы без ничьих"""
+    denom = _norm_cdf(t)
+    if denom < 1e-12:
+        # Асимптотика для очень неожиданного результата
+        v = -t
+    else:
+        v = _norm_pdf(t) / denom
+    return v, v * (v + t)
+
+def get_conservative_rating(mu, sigma):
+    """Консервативная оценка навыка: с вероятностью ~99.7% навык не ниже"""
+    return mu - 3 * sigma
+
+def update_trueskill_rating(game, reason, players_stats=None):
+    """Командное обновление рейтинга (TrueSkill) для всей партии за один проход
+
+    Каждая команда выступает со средним навыком своих игроков, поэтому разный
+    размер команд (мафия меньше мирных) не даёт преимущества большинству.
+    Победившая команда сравнивается с каждой проигравшей; поправки считаются
+    от состояния до игры и суммируются, затем сохраняются разом.
+
+    players_stats - уже прочитанная статистика партии (см. _load_players_stats)
+
+    Returns:
+        {user_id: (новый рейтинг, изменение)}
+    """
+    winner_team = get_winner_team(reason)
+    if not winner_team:
+        return {}
+    
+    if players_stats is None:
+        players_stats = _load_players_stats(game)
+    players = game['players']
+    
+    # Векторы состояния партии: mu, sigma^2 (с динамикой tau) и команда
+    mus, variances, teams, old_ratings = [], [], [], []
+    for player in players:
+        stats = players_stats.get(player['id']) or {}
+        sigma = stats.get('rating_sigma', TRUESKILL_SIGMA)
+        # Переход с ELO: сохраняем текущий рейтинг как консервативную оценку
+        mu = stats.get('rating_mu', stats.get('elo_rating', 1000) + 3 * sigma)
+        mus.append(mu)
+        variances.append(sigma ** 2 + TRUESKILL_TAU ** 2)
+        teams.append(get_player_team(player.get('role', 'peace')) or 'neutral')
+        old_ratings.append(stats.get('elo_rating', 1000))
+    
+    # Агрегаты по командам за один проход
+    team_size, team_mu, team_var = {}, {}, {}
+    for mu, var, team in zip(mus, variances, teams):
+        team_size[team] = team_size.get(team, 0) + 1
+        team_mu[team] = team_mu.get(team, 0.0) + mu
+        team_var[team] = team_var.get(team, 0.0) + var + TRUESKILL_BETA ** 2
+    for team, size in team_size.items():
+        team_mu[team] /= size
+        team_var[team] /= size * size
+    
+    if winner_team not in team_size:
+        return {}
+    
+    # Поправки для каждой пары (победитель, проигравший)
+    mu_shift = {team: 0.0 for team in team_size}
+    var_factor = {team: [] for team in team_size}
+    for loser in team_size:
+        if loser == winner_team:
+            continue
+        c2 = team_var[winner_team] + team_var[loser]
+        c = math.sqrt(c2)
+        v, w = _trueskill_v_w((team_mu[winner_team] - team_mu[loser]) / c)
+        for team, sign in ((winner_team, 1), (loser, -1)):
+            mu_shift[team] += sign * v / (c * team_size[team])
+            var_factor[team].append(w / (c2 * team_size[team] ** 2))
+    
+    changes = {}
+    fields = {}
+    for i, player in enumerate(players):
+        team, var = teams[i], variances[i]
+        new_mu = mus[i] + var * mu_shift[team]
+        for factor in var_factor[team]:
+            var *= max(1 - var * factor, 1e-4)
+        new_sigma = max(math.sqrt(var), TRUESKILL_MIN_SIGMA)
+        new_rating = max(0, int(round(get_conservative_rating(new_mu, new_sigma))))
+        rating_change = new_rating - old_ratings[i]
+        
+        fields[player['id']] = {
+            'rating_mu': round(new_mu, 3),
+            'rating_sigma': round(new_sigma, 3),
+            'elo_rating': new_rating,  # Отображаемый рейтинг = консервативная оценка
+            'elo_change': rating_change
+        }
+        changes[player['id']] = (new_rating, rating_change)
+    _save_ratings(game, players_stats, fields)
+    return changes
+
+# Доступные движки рейтинга (выбирается через config.RATING_ENGINE)
+RATING_ENGINES = {
+    'elo': update_elo_rating,
+    'trueskill': update_trueskill_rating,
+}
+
+def update_rating(game, reason, players_stats=None):
+    """Обновить рейтинг игроков выбранным в конфиге движком"""
+    engine = RATING_ENGINES.get(getattr(config, 'RATING_ENGINE', 'elo'), update_elo_rating)
+    return engine(game, reason, players_stats)
+
+# --- СТАТИСТИКА ПО ВРЕМЕНИ ---
+
+# Поля статистики по времени и длины их массивов (индекс = час 0-23 / день недели 0-6)
+TIME_STATS_FIELDS = {
+    'games_by_hour': 24,
+    'wins_by_hour': 24,
+    'games_by_day': 7,
+    'wins_by_day': 7,
+}
+
+def normalize_time_stats(value, size):
+    """Привести статистику по времени к массиву фиксированной длины
+
+    Старые документы хранят dict, ключи которого после JSON стали строками
+    (иногда вперемешку с int) — значения по одному индексу суммируются.
+    """
+    if isinstance(value, list) and len(value) == size:
+        return value
+    result = [0] * size
+    if isinstance(value, dict):
+        for key, count in value.items():
+            try:
+                idx = int(key)
+            except (TypeError, ValueError):
+                continue
+            if 0 <= idx < size:
+                result[idx] += count
+    elif isinstance(value, list):
+        for idx, count in enumerate(value[:size]):
+            result[idx] = count
+    return result
+
+def migrate_time_stats():
+    """Однократная миграция статистики по времени из dict в массивы
+
+    Returns:
+        Количество обновлённых документов (0, если миграция уже применялась)
+    """
+    from datetime import datetime
+    
+    if database.find_one('migrations', {'name': 'time_stats_arrays'}):
+        return 0
+    
+    migrated = 0
+    for stats in database.find('player_stats', {}):
+        fields = {}
+        for field, size in TIME_STATS_FIELDS.items():
+            value = stats.get(field)
+            if value is not None and not (isinstance(value, list) and len(value) == size):
+                fields[field] = normalize_time_stats(value, size)
+        if fields:
+            database.update_one('player_stats', {'_id': stats['_id']}, {'$set': fields})
+            migrated += 1
+    
+    database.insert_one('migrations', {'name': 'time_stats_arrays', 'applied_at': datetime.now().isoformat(), 'documents': migrated})
+    return migrated
+
+# --- ИСТОРИЯ РЕЙТИНГА ---
+
+# Сколько последних игр хранится в истории рейтинга
+ELO_HISTORY_SIZE = 50
+
+def new_elo_history():
+    """Пустой кольцевой буфер истории рейтинга: параллельные массивы + указатель записи"""
+    return {'rating': [], 'time': [], 'game': [], 'head': 0}
+
+def _legacy_elo_history(entries):
+    """Перевести старую историю (список dict с ISO-датами) в кольцевой буфер"""
+    from datetime import datetime
+    
+    history = new_elo_history()
+    for entry in entries[-ELO_HISTORY_SIZE:]:
+        try:
+            timestamp = int(datetime.fromisoformat(entry.get('timestamp')).timestamp())
+        except (TypeError, ValueError):
+            timestamp = 0
+        elo_history_append(history, entry.get('rating', 1000), timestamp, entry.get('game_id'))
+    return history
+
+def elo_history_append(history, rating, timestamp, game_ref):
+    """Записать игру в кольцевой буфер на место head (без копирования массивов)"""
+    head = history['head']
+    if len(history['rating']) < ELO_HISTORY_SIZE:
+        history['rating'].append(rating)
+        history['time'].append(timestamp)
+        history['game'].append(game_ref)
+    else:
+        history['rating'][head] = rating
+        history['time'][head] = timestamp
+        history['game'][head] = game_ref
+    history['head'] = (head + 1) % ELO_HISTORY_SIZE
+    return history
+
+def get_elo_history(stats):
+    """История рейтинга игрока в хронологическом порядке
+
+    Returns:
+        Список кортежей (рейтинг, время в секундах epoch, id игры) от старых к новым
+    """
+    history = stats.get('elo_history')
+    if not history:
+        return []
+    if isinstance(history, list):
+        history = _legacy_elo_history(history)
+    entries = list(zip(history['rating'], history['time'], history['game']))
+    if len(entries) < ELO_HISTORY_SIZE:
+        return entries
+    head = history['head']
+    return entries[head:] + entries[:head]
 
 def update_player_stats(game, reason):
     """Обновить статистику игроков после завершения игры"""
     from datetime import datetime
     
-    # Сначала обновляем ELO рейтинг
-    update_elo_rating(game, reason)
+    # Статистика партии читается один раз: движок рейтинга обновляет её на месте
+    players_stats = _load_players_stats(game)
+    
+    # Сначала обновляем рейтинг выбранным движком
+    rating_changes = update_rating(game, reason, players_stats)
     
     # Определяем победившую команду
-    winner_team = None
-    if 'Мирные победили' in reason or 'Победа Добра' in reason:
-        winner_team = 'peaceful'
-    elif 'Мафия победила' in reason or 'Победа Зла' in reason:
-        winner_team = 'mafia'
-    elif 'Маньяк победил' in reason:
-        winner_team = 'maniac'
+    winner_team = get_winner_team(reason)
     
     # Получаем текущее время
     now = datetime.now()
@@ -145,28 +407,31 @@ def update_player_stats(game, reason):
     game_day = now.weekday()  # 0=Monday, 6=Sunday
     
     # Вычисляем средний рейтинг всех игроков в игре
-    all_ratings = []
-    for p in game['players']:
-        p_stats = database.find_one('player_stats', {'user_id': p['id']})
-        p_rating = p_stats.get('elo_rating', 1000) if p_stats else 1000
-        all_ratings.append(p_rating)
+    all_ratings = [players_stats.get(p['id'], {}).get('elo_rating', 1000) for p in game['players']]
     avg_opponent_rating = sum(all_ratings) / len(all_ratings) if all_ratings else 1000
     
     # Импортируем модуль достижений
     try:
-        from achievements import check_achievements, award_achievement
+        from achievements import (
+            check_achievements, apply_achievements,
+            award_achievement_customization, format_achievements_message
+        )
     except ImportError:
         check_achievements = None
-        award_achievement = None
     
     # Обновляем статистику для каждого игрока
+    writes = []
+    ledger = []
+    team_results = {}
+    achieved = {}
     for player in game['players']:
         user_id = player['id']
         role = player.get('role', 'peace')
         is_alive = player.get('alive', False)
         
-        # Получаем текущую статистику
-        stats = database.find_one('player_stats', {'user_id': user_id})
+        # Текущая статистика (с уже обновлённым рейтингом)
+        stats = players_stats.get(user_id)
+        candies_before = stats.get('candies', 0) if stats else 0
         if not stats:
             stats = {
                 'user_id': user_id,
@@ -180,39 +445,29 @@ def update_player_stats(game, reason):
                 'elo_rating': 1000,  # Начальный рейтинг
                 'candies': 0,
                 'achievements': [],  # Список полученных достижений
-                'elo_history': [],  # История рейтинга
+                'elo_history': new_elo_history(),  # История рейтинга (кольцевой буфер)
                 'avg_opponent_rating': 0,  # Средний рейтинг соперников
-                'games_by_hour': {},  # Статистика по часам (0-23)
-                'games_by_day': {},  # Статистика по дням недели (0-6)
-                'wins_by_hour': {},  # Победы по часам
-                'wins_by_day': {}  # Победы по дням недели
+                'games_by_hour': [0] * 24,  # Статистика по часам (0-23)
+                'games_by_day': [0] * 7,  # Статистика по дням недели (0-6)
+                'wins_by_hour': [0] * 24,  # Победы по часам
+                'wins_by_day': [0] * 7  # Победы по дням недели
             }
         
         # Инициализируем новые поля, если их нет
-        if 'elo_history' not in stats:
-            stats['elo_history'] = []
+        if not stats.get('elo_history'):
+            stats['elo_history'] = new_elo_history()
+        elif isinstance(stats['elo_history'], list):
+            stats['elo_history'] = _legacy_elo_history(stats['elo_history'])
         if 'avg_opponent_rating' not in stats:
             stats['avg_opponent_rating'] = 0
-        if 'games_by_hour' not in stats:
-            stats['games_by_hour'] = {}
-        if 'games_by_day' not in stats:
-            stats['games_by_day'] = {}
-        if 'wins_by_hour' not in stats:
-            stats['wins_by_hour'] = {}
-        if 'wins_by_day' not in stats:
-            stats['wins_by_day'] = {}
+        for field, size in TIME_STATS_FIELDS.items():
+            stats[field] = normalize_time_stats(stats.get(field), size)
         
         # Обновляем статистику
         stats['games_played'] = stats.get('games_played', 0) + 1
         
         # Определяем, выиграл ли игрок
-        won = False
-        if winner_team == 'peaceful' and role in ('peace', 'civilian', 'commissar', 'sergeant', 'doctor', 'lucky', 'kamikaze'):
-            won = True
-        elif winner_team == 'mafia' and role in ('mafia', 'don'):
-            won = True
-        elif winner_team == 'maniac' and role == 'maniac':
-            won = True
+        won = winner_team is not None and get_player_team(role) == winner_team
         
         if won:
             stats['games_won'] = stats.get('games_won', 0) + 1
@@ -228,14 +483,7 @@ def update_player_stats(game, reason):
         
         # Сохраняем текущий рейтинг в историю (последние 50 игр)
         current_elo = stats.get('elo_rating', 1000)
-        stats['elo_history'].append({
-            'rating': current_elo,
-            'timestamp': now.isoformat(),
-            'game_id': game.get('id', 'unknown')
-        })
-        # Оставляем только последние 50 записей
-        if len(stats['elo_history']) > 50:
-            stats['elo_history'] = stats['elo_history'][-50:]
+        elo_history_append(stats['elo_history'], current_elo, int(now.timestamp()), game.get('_id'))
         
         # Обновляем средний рейтинг соперников (скользящее среднее)
         current_avg = stats.get('avg_opponent_rating', 1000)
@@ -244,14 +492,14 @@ def update_player_stats(game, reason):
         stats['avg_opponent_rating'] = (current_avg * (games_count - 1) + avg_opponent_rating) / games_count
         
         # Обновляем статистику по времени суток
-        stats['games_by_hour'][game_hour] = stats['games_by_hour'].get(game_hour, 0) + 1
+        stats['games_by_hour'][game_hour] += 1
         if won:
-            stats['wins_by_hour'][game_hour] = stats['wins_by_hour'].get(game_hour, 0) + 1
+            stats['wins_by_hour'][game_hour] += 1
         
         # Обновляем статистику по дням недели
-        stats['games_by_day'][game_day] = stats['games_by_day'].get(game_day, 0) + 1
+        stats['games_by_day'][game_day] += 1
         if won:
-            stats['wins_by_day'][game_day] = stats['wins_by_day'].get(game_day, 0) + 1
+            stats['wins_by_day'][game_day] += 1
         
         # Обновляем имя, если изменилось
         stats['name'] = player.get('name', stats.get('name', 'Игрок'))
@@ -268,10 +516,8 @@ def update_player_stats(game, reason):
         if 'achievements' not in stats:
             stats['achievements'] = []
         
-        # Сохраняем статистику перед проверкой достижений
-        database.update_one('player_stats', {'user_id': user_id}, {'$set': stats}, upsert=True)
-        
-        # Проверяем достижения
+        # Проверяем достижения и добавляем их в ту же запись статистики
+        new_achievements = []
         if check_achievements:
             try:
                 game_result = {
@@ -279,23 +525,65 @@ def update_player_stats(game, reason):
                     'won': won,
                     'alive': is_alive
                 }
-                new_achievements = check_achievements(user_id, game_result, stats)
-                
-                # Выдаем новые достижения
-                for achievement in new_achievements:
-                    if award_achievement:
-                        if award_achievement(user_id, achievement):
-                            # Отправляем уведомление игроку
-                            try:
-                                reward_text = f"🎉 <b>НОВОЕ ДОСТИЖЕНИЕ!</b>\n\n"
-                                reward_text += f"{achievement['icon']} <b>{achievement['name']}</b>\n"
-                                reward_text += f"{achievement['description']}\n\n"
-                                reward_text += f"🍭 Награда: +{achievement.get('reward_candies', 0)} конфет"
-                                bot.send_message(user_id, reward_text, parse_mode='HTML')
-                            except:
-                                pass
+                new_achievements = apply_achievements(stats, check_achievements(user_id, game_result, stats))
             except Exception as e:
+                new_achievements = []
                 print(f"Error checking achievements for user {user_id}: {e}")
+        
+        # Одна запись на игрока: статистика, достижения и награда за них.
+        # Конфеты меняются через $inc, чтобы не затереть параллельные начисления
+        reward = stats.get('candies', 0) - candies_before
+        fields = {k: v for k, v in stats.items() if k != 'candies'}
+        writes.append((user_id, {'$set': fields, '$inc': {'candies': reward}}))
+        ledger.append(ledger_entry(user_id, reward, 'game', f"game:{game.get('_id')}:{user_id}"))
+        team_results[user_id] = {'won': won, 'elo': stats['elo_rating']}
+        if new_achievements:
+            achieved[user_id] = new_achievements
+    
+    # Записи статистики и журнал конфет за игру (одной записью на всех игроков) —
+    # под общей блокировкой балансов, чтобы сверка не застала награду без журнала
+    with balance_update():
+        for user_id, update in writes:
+            database.update_one('player_stats', {'user_id': user_id}, update, upsert=True)
+        record_entries(ledger)
+    for user_id, result in team_results.items():
+        result['candies'] = get_balance(user_id)
+    
+    for user_id, new_achievements in achieved.items():
+        try:
+            award_achievement_customization(user_id, new_achievements)
+        except Exception as e:
+            print(f"Error awarding customization for user {user_id}: {e}")
+        # Одно уведомление обо всех новых достижениях
+        try:
+            bot.send_message(user_id, format_achievements_message(new_achievements), parse_mode='HTML')
+        except:
+            pass
+    
+    # Агрегаты команд игроков — одной записью на все команды
+    try:
+        from teams import apply_game_results
+        apply_game_results(team_results)
+    except Exception as e:
+        print(f"Error updating team stats: {e}")
+    return rating_changes
+
+def record_game_result(game, reason):
+    """Сохранить итог игры для аналитики баланса (сама игра удаляется при завершении)"""
+    from datetime import datetime
+    
+    winner_team = get_winner_team(reason)
+    if not winner_team:
+        return  # Принудительное завершение или ничья — для баланса не учитываем
+    cards = game.get('cards') or [p.get('role', 'peace') for p in game['players']]
+    database.insert_one('game_results', {
+        'chat': game.get('chat'),
+        'players_count': len(game['players']),
+        'cards': sorted(cards),
+        'winner_team': winner_team,
+        'day_count': game.get('day_count', 0),
+        'finished_at': datetime.now().isoformat()
+    })
 
 def stop_game(game, reason):
     winner_text = reason
@@ -310,25 +598,25 @@ def stop_game(game, reason):
     full_text = f'🎄 <b>Игра завершена!</b>\n\n{winner_text}\n\n🎭 <b>Маски сброшены:</b>\n' + '\n'.join(roles_list)
     bot.try_to_send_message(game['chat'], full_text, parse_mode='HTML')
     
+    try:
+        record_game_result(game, reason)
+    except Exception as e:
+        print(f"Error recording game result: {e}")
+    
     # Обновляем статистику игроков (включая ELO рейтинг)
     try:
-        update_player_stats(game, reason)
+        rating_changes = update_player_stats(game, reason)
         
         # Отправляем личные сообщения с изменением рейтинга
-        for player in game['players']:
-            user_id = player['id']
-            stats = database.find_one('player_stats', {'user_id': user_id})
-            if stats and 'elo_change' in stats:
-                elo_change = stats.get('elo_change', 0)
-                elo_rating = stats.get('elo_rating', 1000)
-                if elo_change != 0:
-                    change_emoji = "📈" if elo_change > 0 else "📉"
-                    change_text = f"{change_emoji} <b>Изменение рейтинга: {elo_change:+d}</b>\n"
-                    change_text += f"🏆 <b>Новый рейтинг: {elo_rating}</b>"
-                    try:
-                        bot.send_message(user_id, change_text, parse_mode='HTML')
-                    except:
-                        pass  # Игрок заблокировал бота или не может получать сообщения
+        for user_id, (elo_rating, elo_change) in rating_changes.items():
+            if elo_change != 0:
+                change_emoji = "📈" if elo_change > 0 else "📉"
+                change_text = f"{change_emoji} <b>Изменение рейтинга: {elo_change:+d}</b>\n"
+                change_text += f"🏆 <b>Новый рейтинг: {elo_rating}</b>"
+                try:
+                    bot.send_message(user_id, change_text, parse_mode='HTML')
+                except:
+                    pass  # Игрок заблокировал бота или не может получать сообщения
     except Exception as e:
         print(f"Error updating player stats: {e}")
     
@@ -1,27 +1,105 @@
 # game_events.py
 import random
+from bisect import bisect_right
 import logging
 from datetime import datetime, timedelta
 import traceback
+from time import perf_counter
+from typing import Any, Dict, List
 import database
+from candies import credit_many
+from metrics import metrics
 
 logger = logging.getLogger(__name__)
 
+def new_patch():
+    """Пустой патч эффекта: поля игры для $set и начисления конфет {user_id: количество}"""
+    return {'$set': {}, 'candies': {}}
+
+def merge_patch(target, patch):
+    """Добавить патч к другому (поздние значения полей перекрывают ранние)"""
+    target['$set'].update(patch.get('$set', {}))
+    for user_id, amount in patch.get('candies', {}).items():
+        target['candies'][user_id] = target['candies'].get(user_id, 0) + amount
+    return target
+
+def grant_candies(amounts):
+    """Начислить конфеты многим игрокам одним атомарным $inc по коллекции
+    
+    Игроки без статистики пропускаются, как и раньше.
+    """
+    return credit_many(amounts, 'event')
+
+def commit_patch(game, patch, extra_set=None, extra_push=None):
+    """Записать патч эффекта одной записью игры и одним начислением конфет
+    
+    extra_set - собственные изменения вызывающего кода, которые пишутся той же записью.
+    extra_push - значения, добавляемые в списки игры ($push) той же записью.
+    """
+    fields = dict(patch.get('$set', {}))
+    if extra_set:
+        fields.update(extra_set)
+    update = {}
+    if fields:
+        update['$set'] = fields
+    if extra_push:
+        update['$push'] = extra_push
+    if update:
+        database.update_one('games', {'_id': game['_id']}, update)
+    grant_candies(patch.get('candies', {}))
+
 class GameEvent:
-    def __init__(self, name, description, duration=1, is_positive=True, rarity='common', seasonal=None, cost=30):
-        self.name = name
-        self.description = description
-        self.duration = duration
+    """Базовое событие. Метаданные объявляются атрибутами класса и попадают в EVENT_REGISTRY"""
+    NAME = None
+    DESCRIPTION = ''
+    SHOP_DESCRIPTION = None  # Короткое описание для магазина (по умолчанию DESCRIPTION)
+    DURATION = 1
+    IS_POSITIVE = True
+    RARITY = 'common'  # common, rare, legendary
+    SEASONAL = None  # 'winter', 'summer', 'spring', 'autumn', None
+    COST = 30
+
+    # Хуки стадий (см. HOOK_POINTS): classmethod(game, ctx) -> dict полей игры для $set.
+    # Срабатывают один раз — на ближайшей подходящей стадии после покупки.
+    on_night_start = None
+    on_day_start = None
+    on_vote_tally = None
+    on_night_resolve = None
+
+    def __init__(self):
+        self.name = self.NAME
+        self.description = self.DESCRIPTION
+        self.duration = self.DURATION
         self.activation_time = datetime.utcnow()
-        self.is_positive = is_positive
+        self.is_positive = self.IS_POSITIVE
         self.applied_effects = []
-        self.rarity = rarity  # common, rare, legendary
-        self.seasonal = seasonal  # 'winter', 'summer', 'spring', 'autumn', None
-        self.cost = cost
+        self.rarity = self.RARITY
+        self.seasonal = self.SEASONAL
+        self.cost = self.COST
+        self.patch = new_patch()
+
+    @classmethod
+    def shop_info(cls):
+        """Описание события для магазина"""
+        return {
+            'name': cls.NAME,
+            'class': cls,
+            'cost': cls.COST,
+            'description': cls.SHOP_DESCRIPTION or cls.DESCRIPTION,
+            'rarity': cls.RARITY,
+            'seasonal': cls.SEASONAL
+        }
 
     def apply_effect(self, game):
+        """Применить эффект к игре в памяти и собрать патч в self.patch
+        
+        В базу ничего не пишется: патч записывает вызывающий код через commit_patch
+        (вместе со своими изменениями игры, одной записью).
+        """
+        self.patch = new_patch()
         try:
             effect_result = self._apply_effect(game)
+            self._register_hooks(game)
             self.applied_effects.append({
                 'timestamp': datetime.utcnow().isoformat(),
                 'effect': effect_result
@@ -31,495 +109,430 @@ class GameEvent:
         except Exception as e:
             logger.error(f"Error applying event {self.name}: {str(e)}")
             logger.error(traceback.format_exc())
+            self.patch = new_patch()
             return None
 
     def _apply_effect(self, game):
         return {"status": "no_effect"}
 
+    def _set(self, game, field, value):
+        """Изменить поле игры и записать его в патч"""
+        game[field] = value
+        self.patch['$set'][field] = value
+
+    def _set_player(self, game, index, field, value):
+        """Изменить поле игрока и записать его в патч"""
+        game['players'][index][field] = value
+        self.patch['$set'][f'players.{index}.{field}'] = value
+
+    def _register_hooks(self, game):
+        """Добавить хуки события в списки игры и записать их в патч"""
+        hooks = get_game_hooks(game)
+        changed = False
+        for point in HOOK_POINTS:
+            names = hooks.setdefault(point, [])
+            # Повторная покупка до срабатывания не должна удваивать эффект
+            if getattr(type(self), point) is not None and self.NAME not in names:
+                names.append(self.NAME)
+                changed = True
+        if changed:
+            self._set(game, 'event_hooks', {point: list(names) for point, names in hooks.items()})
+
+    def _grant(self, user_id, amount):
+        """Начислить игроку конфеты (запишутся вместе с патчем)"""
+        self.patch['candies'][user_id] = self.patch['candies'].get(user_id, 0) + amount
+
     def is_active(self):
         return (datetime.utcnow() - self.activation_time) < timedelta(hours=self.duration)
 
 # Обычные события (common)
 class TimeFreezeEvent(GameEvent):
+    NAME = 'time_freeze'
+    DESCRIPTION = '⏱️ Замедление времени! Следующий день длится в 2 раза дольше.'
+    DURATION = 1
+    RARITY = 'common'
     COST = 30
-    def __init__(self):
-        super().__init__(
-            "time_freeze",
-            "⏱️ Замедление времени! Следующий день длится в 2 раза дольше.",
-            duration=1,
-            is_positive=True,
-            rarity='common',
-            cost=30
-        )
+
     def _apply_effect(self, game):
-        if 'day_duration_multiplier' not in game:
-            game['day_duration_multiplier'] = 1
-        game['day_duration_multiplier'] = 2
-        database.update_one('games', {'_id': game['_id']}, {'$set': {'day_duration_multiplier': 2}})
+        self._set(game, 'day_duration_multiplier', 2)
         return {"effect": "day_duration_doubled", "turns": 1}
 
+    @classmethod
+    def on_day_start(cls, game, ctx):
+        ctx['duration'] = int(ctx['duration'] * game.get('day_duration_multiplier', 2))
+        return {'day_duration_multiplier': 1}
+
 class BlizzardEvent(GameEvent):
+    NAME = 'blizzard'
+    DESCRIPTION = '❄️ Метель! Случайный живой игрок заблокирован на следующую ночь.'
+    DURATION = 0
+    IS_POSITIVE = False
+    RARITY = 'common'
+    SEASONAL = 'winter'
     COST = 30
-    def __init__(self):
-        super().__init__(
-            "blizzard",
-            "❄️ Метель! Случайный живой игрок заблокирован на следующую ночь.",
-            duration=0,
-            is_positive=False,
-            rarity='common',
-            seasonal='winter',
-            cost=30
-        )
+
     def _apply_effect(self, game):
         alive_players = [(i, p) for i, p in enumerate(game['players']) if p.get('alive')]
         if not alive_players:
             return {"effect": "no_targets", "affected_players": []}
         target_idx, target = random.choice(alive_players)
-        if 'blizzard_blocked' not in game:
-            game['blizzard_blocked'] = []
-        if target['id'] not in game['blizzard_blocked']:
-            game['blizzard_blocked'].append(target['id'])
-            database.update_one('games', {'_id': game['_id']}, {'$set': {'blizzard_blocked': game['blizzard_blocked']}})
+        blocked = game.get('blizzard_blocked', [])
+        if target['id'] not in blocked:
+            self._set(game, 'blizzard_blocked', blocked + [target['id']])
         return {"effect": "block_player", "target": target['name'], "target_idx": target_idx}
 
+    @classmethod
+    def on_night_start(cls, game, ctx):
+        blocks = ctx.setdefault('blocks', [])
+        for blocked_id in game.get('blizzard_blocked', []):
+            if blocked_id not in blocks:
+                blocks.append(blocked_id)
+        return {'blizzard_blocked': []}
+
 class DoubleVoteEvent(GameEvent):
+    NAME = 'double_vote'
+    DESCRIPTION = '🗳️ Двойное голосование! Следующее голосование будет проведено дважды.'
+    DURATION = 0
+    RARITY = 'common'
     COST = 25
-    def __init__(self):
-        super().__init__(
-            "double_vote",
-            "🗳️ Двойное голосование! Следующее голосование будет проведено дважды.",
-            duration=0,
-            is_positive=True,
-            rarity='common',
-            cost=25
-        )
+
     def _apply_effect(self, game):
-        game['double_vote'] = True
-        database.update_one('games', {'_id': game['_id']}, {'$set': {'double_vote': True}})
+        self._set(game, 'double_vote', True)
         return {"effect": "double_vote_enabled"}
 
 class NightVisionEvent(GameEvent):
+    NAME = 'night_vision'
+    DESCRIPTION = '🌙 Ночное зрение! Комиссар может проверить двух игроков вместо одного в следующую ночь.'
+    SHOP_DESCRIPTION = '🌙 Ночное зрение! Комиссар может проверить двух игроков вместо одного.'
+    DURATION = 0
+    RARITY = 'common'
     COST = 35
-    def __init__(self):
-        super().__init__(
-            "night_vision",
-            "🌙 Ночное зрение! Комиссар может проверить двух игроков вместо одного в следующую ночь.",
-            duration=0,
-            is_positive=True,
-            rarity='common',
-            cost=35
-        )
+
     def _apply_effect(self, game):
-        game['commissar_double_check'] = True
-        database.update_one('games', {'_id': game['_id']}, {'$set': {'commissar_double_check': True}})
+        self._set(game, 'commissar_double_check', True)
         return {"effect": "commissar_double_check"}
 
 class ProtectionEvent(GameEvent):
+    NAME = 'protection'
+    DESCRIPTION = '🛡️ Защита! Случайный живой игрок защищен от следующего убийства.'
+    DURATION = 0
+    RARITY = 'common'
     COST = 40
-    def __init__(self):
-        super().__init__(
-            "protection",
-            "🛡️ Защита! Случайный живой игрок защищен от следующего убийства.",
-            duration=0,
-            is_positive=True,
-            rarity='common',
-            cost=40
-        )
+
     def _apply_effect(self, game):
         alive_players = [(i, p) for i, p in enumerate(game['players']) if p.get('alive')]
         if alive_players:
             target_idx, target = random.choice(alive_players)
-            if 'protected_players' not in game:
-                game['protected_players'] = []
-            game['protected_players'].append(target['id'])
-            database.update_one('games', {'_id': game['_id']}, {'$set': {'protected_players': game['protected_players']}})
+            self._set(game, 'protected_players', game.get('protected_players', []) + [target['id']])
             return {"effect": "player_protected", "target": target['name']}
         return {"effect": "no_targets"}
 
+    @classmethod
+    def on_night_resolve(cls, game, ctx):
+        protected = set(game.get('protected_players', []))
+        ctx['dead'][:] = [idx for idx in ctx['dead'] if game['players'][idx]['id'] not in protected]
+        return {'protected_players': []}
+
 class ConfusionEvent(GameEvent):
+    NAME = 'confusion'
+    DESCRIPTION = '🌀 Путаница! Все роли перемешаны - игроки видят чужие роли в следующую ночь.'
+    SHOP_DESCRIPTION = '🌀 Путаница! Все роли перемешаны - игроки видят чужие роли.'
+    DURATION = 0
+    IS_POSITIVE = False
+    RARITY = 'common'
     COST = 30
-    def __init__(self):
-        super().__init__(
-            "confusion",
-            "🌀 Путаница! Все роли перемешаны - игроки видят чужие роли в следующую ночь.",
-            duration=0,
-            is_positive=False,
-            rarity='common',
-            cost=30
-        )
+
     def _apply_effect(self, game):
-        game['roles_confused'] = True
-        database.update_one('games', {'_id': game['_id']}, {'$set': {'roles_confused': True}})
+        self._set(game, 'roles_confused', True)
         return {"effect": "roles_confused"}
 
 class ExtraTimeEvent(GameEvent):
+    NAME = 'extra_time'
+    DESCRIPTION = '⏰ Дополнительное время! Следующая фаза длится на 30 секунд дольше.'
+    DURATION = 0
+    RARITY = 'common'
     COST = 20
-    def __init__(self):
-        super().__init__(
-            "extra_time",
-            "⏰ Дополнительное время! Следующая фаза длится на 30 секунд дольше.",
-            duration=0,
-            is_positive=True,
-            rarity='common',
-            cost=20
-        )
+
     def _apply_effect(self, game):
-        game['extra_time'] = 30
-        database.update_one('games', {'_id': game['_id']}, {'$set': {'extra_time': 30}})
+        self._set(game, 'extra_time', 30)
         return {"effect": "extra_time_added", "seconds": 30}
 
+    @classmethod
+    def on_day_start(cls, game, ctx):
+        ctx['duration'] += game.get('extra_time', 30)
+        return {'extra_time': 0}
+
 # Редкие события (rare)
 class SantaWorkshopEvent(GameEvent):
+    NAME = 'santa_workshop'
+    DESCRIPTION = '🎅 Мастерская Санты! Доктор может снова использовать самолечение, если уже использовал.'
+    SHOP_DESCRIPTION = '🎅 Мастерская Санты! Доктор может снова использовать самолечение.'
+    DURATION = 0
+    RARITY = 'rare'
+    SEASONAL = 'winter'
     COST = 50
-    def __init__(self):
-        super().__init__(
-            "santa_workshop",
-            "🎅 Мастерская Санты! Доктор может снова использовать самолечение, если уже использовал.",
-            duration=0,
-            is_positive=True,
-            rarity='rare',
-            seasonal='winter',
-            cost=50
-        )
+
     def _apply_effect(self, game):
         reset_players = []
         for i, player in enumerate(game['players']):
             if player.get('alive') and player.get('role') == 'doctor' and player.get('self_heal_used', False):
-                game['players'][i]['self_heal_used'] = False
-                database.update_one('games', {'_id': game['_id']}, {
-                    '$set': {f'players.{i}.self_heal_used': False}
-                })
+                self._set_player(game, i, 'self_heal_used', False)
                 reset_players.append(i)
         return {"effect": "reset_self_heal", "players_affected": reset_players}
 
 class ResurrectionEvent(GameEvent):
+    NAME = 'resurrection'
+    DESCRIPTION = '💀 Воскрешение! Последний убитый игрок возвращается в игру.'
+    DURATION = 0
+    RARITY = 'rare'
     COST = 80
-    def __init__(self):
-        super().__init__(
-            "resurrection",
-            "💀 Воскрешение! Последний убитый игрок возвращается в игру.",
-            duration=0,
-            is_positive=True,
-            rarity='rare',
-            cost=80
-        )
+
     def _apply_effect(self, game):
         dead_players = [(i, p) for i, p in enumerate(game['players']) if not p.get('alive')]
         if dead_players:
             target_idx, target = dead_players[-1]
-            game['players'][target_idx]['alive'] = True
-            database.update_one('games', {'_id': game['_id']}, {'$set': {f'players.{target_idx}.alive': True}})
+            self._set_player(game, target_idx, 'alive', True)
             return {"effect": "player_resurrected", "target": target['name']}
         return {"effect": "no_dead_players"}
 
 class RoleRevealEvent(GameEvent):
+    NAME = 'role_reveal'
+    DESCRIPTION = '🔍 Раскрытие роли! Роль случайного живого игрока раскрывается всем.'
+    DURATION = 0
+    RARITY = 'rare'
     COST = 60
-    def __init__(self):
-        super().__init__(
-            "role_reveal",
-            "🔍 Раскрытие роли! Роль случайного живого игрока раскрывается всем.",
-            duration=0,
-            is_positive=True,
-            rarity='rare',
-            cost=60
-        )
+
     def _apply_effect(self, game):
         alive_players = [(i, p) for i, p in enumerate(game['players']) if p.get('alive')]
         if alive_players:
             target_idx, target = random.choice(alive_players)
-            game['revealed_roles'] = game.get('revealed_roles', [])
-            game['revealed_roles'].append({'player_id': target['id'], 'role': target.get('role')})
-            database.update_one('games', {'_id': game['_id']}, {'$set': {'revealed_roles': game['revealed_roles']}})
+            self._set(game, 'revealed_roles', game.get('revealed_roles', []) + [{'player_id': target['id'], 'role': target.get('role')}])
             return {"effect": "role_revealed", "target": target['name'], "role": target.get('role')}
         return {"effect": "no_targets"}
 
 class MafiaRevealEvent(GameEvent):
+    NAME = 'mafia_reveal'
+    DESCRIPTION = '😈 Раскрытие мафии! Все мафиози раскрываются мирным игрокам.'
+    DURATION = 0
+    RARITY = 'rare'
     COST = 70
-    def __init__(self):
-        super().__init__(
-            "mafia_reveal",
-            "😈 Раскрытие мафии! Все мафиози раскрываются мирным игрокам.",
-            duration=0,
-            is_positive=True,
-            rarity='rare',
-            cost=70
-        )
+
     def _apply_effect(self, game):
         mafia_players = [(i, p) for i, p in enumerate(game['players']) if p.get('role') in ('mafia', 'don') and p.get('alive')]
         if mafia_players:
-            game['mafia_revealed'] = True
-            database.update_one('games', {'_id': game['_id']}, {'$set': {'mafia_revealed': True}})
+            self._set(game, 'mafia_revealed', True)
             return {"effect": "mafia_revealed", "count": len(mafia_players)}
         return {"effect": "no_mafia"}
 
 class ImmunityEvent(GameEvent):
+    NAME = 'immunity'
+    DESCRIPTION = '✨ Иммунитет! Случайный живой игрок получает иммунитет от голосования на следующий день.'
+    SHOP_DESCRIPTION = '✨ Иммунитет! Случайный живой игрок получает иммунитет от голосования.'
+    DURATION = 0
+    RARITY = 'rare'
     COST = 75
-    def __init__(self):
-        super().__init__(
-            "immunity",
-            "✨ Иммунитет! Случайный живой игрок получает иммунитет от голосования на следующий день.",
-            duration=0,
-            is_positive=True,
-            rarity='rare',
-            cost=75
-        )
+
     def _apply_effect(self, game):
         alive_players = [(i, p) for i, p in enumerate(game['players']) if p.get('alive')]
         if alive_players:
             target_idx, target = random.choice(alive_players)
-            if 'immune_players' not in game:
-                game['immune_players'] = []
-            game['immune_players'].append(target['id'])
-            database.update_one('games', {'_id': game['_id']}, {'$set': {'immune_players': game['immune_players']}})
+            self._set(game, 'immune_players', game.get('immune_players', []) + [target['id']])
             return {"effect": "player_immune", "target": target['name']}
         return {"effect": "no_targets"}
 
+    @classmethod
+    def on_vote_tally(cls, game, ctx):
+        immune = set(game.get('immune_players', []))
+        for idx in list(ctx['vote_counts']):
+            if game['players'][idx]['id'] in immune:
+                del ctx['vote_counts'][idx]
+        return {'immune_players': []}
+
 class DoubleKillEvent(GameEvent):
+    NAME = 'double_kill'
+    DESCRIPTION = '⚔️ Двойное убийство! Мафия может убить двух игроков вместо одного в следующую ночь.'
+    SHOP_DESCRIPTION = '⚔️ Двойное убийство! Мафия может убить двух игроков вместо одного.'
+    DURATION = 0
+    IS_POSITIVE = False
+    RARITY = 'rare'
     COST = 90
-    def __init__(self):
-        super().__init__(
-            "double_kill",
-            "⚔️ Двойное убийство! Мафия может убить двух игроков вместо одного в следующую ночь.",
-            duration=0,
-            is_positive=False,
-            rarity='rare',
-            cost=90
-        )
+
     def _apply_effect(self, game):
-        game['mafia_double_kill'] = True
-        database.update_one('games', {'_id': game['_id']}, {'$set': {'mafia_double_kill': True}})
+        self._set(game, 'mafia_double_kill', True)
         return {"effect": "mafia_double_kill_enabled"}
 
 class LuckyDayEvent(GameEvent):
+    NAME = 'lucky_day'
+    DESCRIPTION = '🍀 Счастливый день! Все живые игроки получают случайный бонус.'
+    DURATION = 0
+    RARITY = 'rare'
     COST = 55
-    def __init__(self):
-        super().__init__(
-            "lucky_day",
-            "🍀 Счастливый день! Все живые игроки получают случайный бонус.",
-            duration=0,
-            is_positive=True,
-            rarity='rare',
-            cost=55
-        )
+
     def _apply_effect(self, game):
         alive_players = [p for p in game['players'] if p.get('alive')]
         bonuses = []
         for player in alive_players:
             bonus_type = random.choice(['candies', 'elo_boost'])
             if bonus_type == 'candies':
-                stats = database.find_one('player_stats', {'user_id': player['id']})
-                if stats:
-                    bonus_amount = random.randint(3, 10)
-                    new_candies = stats.get('candies', 0) + bonus_amount
-                    database.update_one('player_stats', {'user_id': player['id']}, {'$set': {'candies': new_candies}})
-                    bonuses.append({'player': player['name'], 'bonus': f"{bonus_amount} конфет"})
+                bonus_amount = random.randint(3, 10)
+                self._grant(player['id'], bonus_amount)
+                bonuses.append({'player': player['name'], 'bonus': f"{bonus_amount} конфет"})
         return {"effect": "lucky_bonuses", "bonuses": bonuses}
 
 # Легендарные события (legendary)
 class TimeRewindEvent(GameEvent):
+    NAME = 'time_rewind'
+    DESCRIPTION = '⏪ Откат времени! Игра возвращается на предыдущую стадию.'
+    DURATION = 0
+    RARITY = 'legendary'
     COST = 150
-    def __init__(self):
-        super().__init__(
-            "time_rewind",
-            "⏪ Откат времени! Игра возвращается на предыдущую стадию.",
-            duration=0,
-            is_positive=True,
-            rarity='legendary',
-            cost=150
-        )
+
     def _apply_effect(self, game):
-        game['time_rewind'] = True
-        database.update_one('games', {'_id': game['_id']}, {'$set': {'time_rewind': True}})
+        self._set(game, 'time_rewind', True)
         return {"effect": "time_rewind_enabled"}
 
 class AllRolesRevealEvent(GameEvent):
+    NAME = 'all_roles_reveal'
+    DESCRIPTION = '👁️ Всевидение! Все роли всех живых игроков раскрываются.'
+    DURATION = 0
+    RARITY = 'legendary'
     COST = 200
-    def __init__(self):
-        super().__init__(
-            "all_roles_reveal",
-            "👁️ Всевидение! Все роли всех живых игроков раскрываются.",
-            duration=0,
-            is_positive=True,
-            rarity='legendary',
-            cost=200
-        )
+
     def _apply_effect(self, game):
         alive_players = [(i, p) for i, p in enumerate(game['players']) if p.get('alive')]
         revealed = []
         for idx, player in alive_players:
             revealed.append({'player_id': player['id'], 'role': player.get('role')})
-        game['all_roles_revealed'] = True
-        game['revealed_roles'] = game.get('revealed_roles', []) + revealed
-        database.update_one('games', {'_id': game['_id']}, {'$set': {'all_roles_revealed': True, 'revealed_roles': game['revealed_roles']}})
+        self._set(game, 'all_roles_revealed', True)
+        self._set(game, 'revealed_roles', game.get('revealed_roles', []) + revealed)
         return {"effect": "all_roles_revealed", "count": len(revealed)}
 
 # Сезонные события - Зима
 class SnowstormEvent(GameEvent):
+    NAME = 'snowstorm'
+    DESCRIPTION = '🌨️ Снежная буря! Все ночные действия отменяются в следующую ночь.'
+    DURATION = 0
+    IS_POSITIVE = False
+    RARITY = 'rare'
+    SEASONAL = 'winter'
     COST = 40
-    def __init__(self):
-        super().__init__(
-            "snowstorm",
-            "🌨️ Снежная буря! Все ночные действия отменяются в следующую ночь.",
-            duration=0,
-            is_positive=False,
-            rarity='rare',
-            seasonal='winter',
-            cost=40
-        )
+
     def _apply_effect(self, game):
-        game['snowstorm'] = True
-        database.update_one('games', {'_id': game['_id']}, {'$set': {'snowstorm': True}})
+        self._set(game, 'snowstorm', True)
         return {"effect": "snowstorm_active"}
 
 class GiftExchangeEvent(GameEvent):
+    NAME = 'gift_exchange'
+    DESCRIPTION = '🎁 Обмен подарками! Все живые игроки получают по 5 конфет.'
+    DURATION = 0
+    RARITY = 'rare'
+    SEASONAL = 'winter'
     COST = 50
-    def __init__(self):
-        super().__init__(
-            "gift_exchange",
-            "🎁 Обмен подарками! Все живые игроки получают по 5 конфет.",
-            duration=0,
-            is_positive=True,
-            rarity='rare',
-            seasonal='winter',
-            cost=50
-        )
+
     def _apply_effect(self, game):
         alive_players = [p for p in game['players'] if p.get('alive')]
         for player in alive_players:
-            stats = database.find_one('player_stats', {'user_id': player['id']})
-            if stats:
-                new_candies = stats.get('candies', 0) + 5
-                database.update_one('player_stats', {'user_id': player['id']}, {'$set': {'candies': new_candies}})
+            self._grant(player['id'], 5)
         return {"effect": "gifts_given", "count": len(alive_players), "candies_per_player": 5}
 
 class SilentNightEvent(GameEvent):
+    NAME = 'silent_night'
+    DESCRIPTION = '🤫 Тихая ночь! Все ночные способности работают в два раза медленнее.'
+    SHOP_DESCRIPTION = '🤫 Тихая ночь! Все ночные способности работают медленнее.'
+    DURATION = 0
+    IS_POSITIVE = False
+    RARITY = 'common'
+    SEASONAL = 'winter'
     COST = 40
-    def __init__(self):
-        super().__init__(
-            "silent_night",
-            "🤫 Тихая ночь! Все ночные способности работают в два раза медленнее.",
-            duration=0,
-            is_positive=False,
-            rarity='common',
-            seasonal='winter',
-            cost=40
-        )
+
     def _apply_effect(self, game):
-        game['silent_night'] = True
-        database.update_one('games', {'_id': game['_id']}, {'$set': {'silent_night': True}})
+        self._set(game, 'silent_night', True)
         return {"effect": "silent_night_active"}
 
 # Сезонные события - Лето
 class HeatWaveEvent(GameEvent):
+    NAME = 'heat_wave'
+    DESCRIPTION = '☀️ Волна жары! Все игроки теряют концентрацию - время на действия сокращается.'
+    SHOP_DESCRIPTION = '☀️ Волна жары! Время на действия сокращается.'
+    DURATION = 0
+    IS_POSITIVE = False
+    RARITY = 'common'
+    SEASONAL = 'summer'
     COST = 35
-    def __init__(self):
-        super().__init__(
-            "heat_wave",
-            "☀️ Волна жары! Все игроки теряют концентрацию - время на действия сокращается.",
-            duration=0,
-            is_positive=False,
-            rarity='common',
-            seasonal='summer',
-            cost=35
-        )
+
     def _apply_effect(self, game):
-        game['heat_wave'] = True
-        database.update_one('games', {'_id': game['_id']}, {'$set': {'heat_wave': True}})
+        self._set(game, 'heat_wave', True)
         return {"effect": "heat_wave_active"}
 
 class SummerFestivalEvent(GameEvent):
+    NAME = 'summer_festival'
+    DESCRIPTION = '🎉 Летний фестиваль! Все игроки получают бонус к ELO рейтингу за эту игру.'
+    SHOP_DESCRIPTION = '🎉 Летний фестиваль! Все игроки получают бонус к ELO рейтингу.'
+    DURATION = 0
+    RARITY = 'rare'
+    SEASONAL = 'summer'
     COST = 45
-    def __init__(self):
-        super().__init__(
-            "summer_festival",
-            "🎉 Летний фестиваль! Все игроки получают бонус к ELO рейтингу за эту игру.",
-            duration=0,
-            is_positive=True,
-            rarity='rare',
-            seasonal='summer',
-            cost=45
-        )
+
     def _apply_effect(self, game):
-        game['summer_festival'] = True
-        database.update_one('games', {'_id': game['_id']}, {'$set': {'summer_festival': True}})
+        self._set(game, 'summer_festival', True)
         return {"effect": "summer_festival_active"}
 
 # Сезонные события - Весна
 class SpringRainEvent(GameEvent):
+    NAME = 'spring_rain'
+    DESCRIPTION = '🌧️ Весенний дождь! Все способности работают с задержкой в следующую ночь.'
+    SHOP_DESCRIPTION = '🌧️ Весенний дождь! Все способности работают с задержкой.'
+    DURATION = 0
+    IS_POSITIVE = False
+    RARITY = 'common'
+    SEASONAL = 'spring'
     COST = 30
-    def __init__(self):
-        super().__init__(
-            "spring_rain",
-            "🌧️ Весенний дождь! Все способности работают с задержкой в следующую ночь.",
-            duration=0,
-            is_positive=False,
-            rarity='common',
-            seasonal='spring',
-            cost=30
-        )
+
     def _apply_effect(self, game):
-        game['spring_rain'] = True
-        database.update_one('games', {'_id': game['_id']}, {'$set': {'spring_rain': True}})
+        self._set(game, 'spring_rain', True)
         return {"effect": "spring_rain_active"}
 
 class BloomEvent(GameEvent):
+    NAME = 'bloom'
+    DESCRIPTION = '🌸 Цветение! Все живые игроки получают по 3 конфеты.'
+    DURATION = 0
+    RARITY = 'common'
+    SEASONAL = 'spring'
     COST = 40
-    def __init__(self):
-        super().__init__(
-            "bloom",
-            "🌸 Цветение! Все живые игроки получают по 3 конфеты.",
-            duration=0,
-            is_positive=True,
-            rarity='common',
-            seasonal='spring',
-            cost=40
-        )
+
     def _apply_effect(self, game):
         alive_players = [p for p in game['players'] if p.get('alive')]
         for player in alive_players:
-            stats = database.find_one('player_stats', {'user_id': player['id']})
-            if stats:
-                new_candies = stats.get('candies', 0) + 3
-                database.update_one('player_stats', {'user_id': player['id']}, {'$set': {'candies': new_candies}})
+            self._grant(player['id'], 3)
         return {"effect": "bloom_bonus", "count": len(alive_players), "candies_per_player": 3}
 
 # Сезонные события - Осень
 class AutumnFogEvent(GameEvent):
+    NAME = 'autumn_fog'
+    DESCRIPTION = '🌫️ Осенний туман! Все проверки дают неверный результат в следующую ночь.'
+    SHOP_DESCRIPTION = '🌫️ Осенний туман! Все проверки дают неверный результат.'
+    DURATION = 0
+    IS_POSITIVE = False
+    RARITY = 'common'
+    SEASONAL = 'autumn'
     COST = 35
-    def __init__(self):
-        super().__init__(
-            "autumn_fog",
-            "🌫️ Осенний туман! Все проверки дают неверный результат в следующую ночь.",
-            duration=0,
-            is_positive=False,
-            rarity='common',
-            seasonal='autumn',
-            cost=35
-        )
+
     def _apply_effect(self, game):
-        game['autumn_fog'] = True
-        database.update_one('games', {'_id': game['_id']}, {'$set': {'autumn_fog': True}})
+        self._set(game, 'autumn_fog', True)
         return {"effect": "autumn_fog_active"}
 
 class HarvestEvent(GameEvent):
+    NAME = 'harvest'
+    DESCRIPTION = '🌾 Урожай! Все живые игроки получают по 4 конфеты.'
+    DURATION = 0
+    RARITY = 'common'
+    SEASONAL = 'autumn'
     COST = 45
-    def __init__(self):
-        super().__init__(
-            "harvest",
-            "🌾 Урожай! Все живые игроки получают по 4 конфеты.",
-            duration=0,
-            is_positive=True,
-            rarity='common',
-            seasonal='autumn',
-            cost=45
-        )
+
     def _apply_effect(self, game):
         alive_players = [p for p in game['players'] if p.get('alive')]
         for player in alive_players:
-            stats = database.find_one('player_stats', {'user_id': player['id']})
-            if stats:
-                new_candies = stats.get('candies', 0) + 4
-                database.update_one('player_stats', {'user_id': player['id']}, {'$set': {'candies': new_candies}})
+            self._grant(player['id'], 4)
         return {"effect": "harvest_bonus", "count": len(alive_players), "candies_per_player": 4}
 
 def get_current_season():
@@ -534,123 +547,165 @@ def get_current_season():
     else:
         return 'autumn'
 
+
+# Все события в порядке показа в магазине
+EVENT_CLASSES = (
+    TimeFreezeEvent, BlizzardEvent, SantaWorkshopEvent,
+    DoubleVoteEvent, NightVisionEvent, ProtectionEvent, ConfusionEvent, ExtraTimeEvent,
+    ResurrectionEvent, RoleRevealEvent, MafiaRevealEvent, ImmunityEvent,
+    TimeRewindEvent, AllRolesRevealEvent,
+    SnowstormEvent, GiftExchangeEvent, SilentNightEvent,
+    HeatWaveEvent, SummerFestivalEvent,
+    SpringRainEvent, BloomEvent,
+    AutumnFogEvent, HarvestEvent,
+    DoubleKillEvent, LuckyDayEvent
+)
+
+# {имя события: класс}
+EVENT_REGISTRY = {event_class.NAME: event_class for event_class in EVENT_CLASSES}
+
+SEASONS = ('winter', 'spring', 'summer', 'autumn')
+
+# Вероятности редкостей при случайном выборе: 60% common, 30% rare, 10% legendary
+RARITY_WEIGHTS = {'common': 0.6, 'rare': 0.3, 'legendary': 0.1}
+
+# {сезон: [описания событий для магазина]} и {(сезон, редкость): [...]}
+_AVAILABLE_BY_SEASON = {}
+_AVAILABLE_BY_SEASON_RARITY = {}
+for _season in SEASONS:
+    _AVAILABLE_BY_SEASON[_season] = [
+        event_class.shop_info() for event_class in EVENT_CLASSES
+        if event_class.SEASONAL is None or event_class.SEASONAL == _season
+    ]
+    for _rarity in RARITY_WEIGHTS:
+        _AVAILABLE_BY_SEASON_RARITY[(_season, _rarity)] = [
+            info for info in _AVAILABLE_BY_SEASON[_season] if info['rarity'] == _rarity
+        ]
+
+# Таблица случайного выбора для текущего сезона: накопленные веса и классы
+_selection_table = {'season': None, 'cumulative': (), 'classes': ()}
+
+def _build_selection_table(season):
+    """Построить таблицу взвешенного выбора событий для сезона
+    
+    Вес редкости делится поровну между её событиями. Если событий какой-то
+    редкости в сезоне нет, её доля распределяется между остальными.
+    """
+    cumulative = []
+    classes = []
+    total = 0.0
+    for rarity, weight in RARITY_WEIGHTS.items():
+        bucket = _AVAILABLE_BY_SEASON_RARITY[(season, rarity)]
+        for info in bucket:
+            total += weight / len(bucket)
+            cumulative.append(total)
+            classes.append(info['class'])
+    _selection_table['cumulative'] = tuple(cumulative)
+    _selection_table['classes'] = tuple(classes)
+    _selection_table['season'] = season
+
 def get_random_event():
     """Получить случайное событие с учетом сезона и редкости"""
     current_season = get_current_season()
+    if _selection_table['season'] != current_season:
+        _build_selection_table(current_season)
     
-    # Все события
-    all_events = [
-        TimeFreezeEvent, BlizzardEvent, SantaWorkshopEvent,
-        DoubleVoteEvent, NightVisionEvent, ProtectionEvent, ConfusionEvent, ExtraTimeEvent,
-        ResurrectionEvent, RoleRevealEvent, MafiaRevealEvent, ImmunityEvent,
-        TimeRewindEvent, AllRolesRevealEvent,
-        SnowstormEvent, GiftExchangeEvent, SilentNightEvent,
-        HeatWaveEvent, SummerFestivalEvent,
-        SpringRainEvent, BloomEvent,
-        AutumnFogEvent, HarvestEvent,
-        DoubleKillEvent, LuckyDayEvent
-    ]
-    
-    # Фильтруем по сезону
-    seasonal_events = []
-    for event_class in all_events:
-        event_instance = event_class()
-        if event_instance.seasonal is None or event_instance.seasonal == current_season:
-            seasonal_events.append(event_class)
-    
-    # Взвешенный выбор по редкости
-    common_events = []
-    rare_events = []
-    legendary_events = []
-    
-    for event_class in seasonal_events:
-        event_instance = event_class()
-        if event_instance.rarity == 'common':
-            common_events.append(event_class)
-        elif event_instance.rarity == 'rare':
-            rare_events.append(event_class)
-        elif event_instance.rarity == 'legendary':
-            legendary_events.append(event_class)
-    
-    # Вероятности: 60% common, 30% rare, 10% legendary
-    rand = random.random()
-    if rand < 0.6 and common_events:
-        return random.choice(common_events)()
-    elif rand < 0.9 and rare_events:
-        return random.choice(rare_events)()
-    elif legendary_events:
-        return random.choice(legendary_events)()
-    else:
-        # Fallback на любое событие
-        return random.choice(seasonal_events)()
+    cumulative = _selection_table['cumulative']
+    index = bisect_right(cumulative, random.random() * cumulative[-1])
+    return _selection_table['classes'][min(index, len(cumulative) - 1)]()
 
 def get_event_by_name(event_name):
-    """Получить класс события по имени"""
-    events_map = {
-        'time_freeze': TimeFreezeEvent,
-        'blizzard': BlizzardEvent,
-        'santa_workshop': SantaWorkshopEvent,
-        'double_vote': DoubleVoteEvent,
-        'night_vision': NightVisionEvent,
-        'protection': ProtectionEvent,
-        'confusion': ConfusionEvent,
-        'extra_time': ExtraTimeEvent,
-        'resurrection': ResurrectionEvent,
-        'role_reveal': RoleRevealEvent,
-        'mafia_reveal': MafiaRevealEvent,
-        'immunity': ImmunityEvent,
-        'time_rewind': TimeRewindEvent,
-        'all_roles_reveal': AllRolesRevealEvent,
-        'snowstorm': SnowstormEvent,
-        'gift_exchange': GiftExchangeEvent,
-        'silent_night': SilentNightEvent,
-        'heat_wave': HeatWaveEvent,
-        'summer_festival': SummerFestivalEvent,
-        'spring_rain': SpringRainEvent,
-        'bloom': BloomEvent,
-        'autumn_fog': AutumnFogEvent,
-        'harvest': HarvestEvent,
-        'double_kill': DoubleKillEvent,
-        'lucky_day': LuckyDayEvent
-    }
-    event_class = events_map.get(event_name)
+    """Получить событие по имени"""
+    event_class = EVENT_REGISTRY.get(event_name)
     if event_class:
         return event_class()
     return None
 
-def get_available_events():
-    """Получить список доступных событий с ценами и редкостью"""
+def get_available_events(rarity=None):
+    """Получить список доступных событий с ценами и редкостью (опционально одной редкости)"""
     current_season = get_current_season()
+    if rarity is None:
+        return list(_AVAILABLE_BY_SEASON[current_season])
+    return list(_AVAILABLE_BY_SEASON_RARITY.get((current_season, rarity), ()))
+
+# --- ХУКИ СОБЫТИЙ ---
+
+# Точки, в которых движок стадий вызывает хуки событий, и контекст каждой:
+#   on_day_start     {'duration': секунды обсуждения}
+#   on_night_start   обновления перехода в ночь ($set стадии 3)
+#   on_vote_tally    {'vote_counts': {индекс игрока: голоса}}
+#   on_night_resolve {'dead': [индексы убитых этой ночью]}
+# Хуки меняют контекст на месте.
+HOOK_POINTS = ('on_night_start', 'on_day_start', 'on_vote_tally', 'on_night_resolve')
+
+# {id игры: {точка: [имена событий]}} — копия game['event_hooks'] в памяти
+_game_hooks: Dict[str, Dict[str, List[str]]] = {}
+
+# Хук дольше этого пишется в лог предупреждением (полная статистика — hook_cost_report)
+SLOW_HOOK_SECONDS = 0.05
+
+def get_game_hooks(game: Dict[str, Any]) -> Dict[str, List[str]]:
+    """Списки хуков игры (после перезапуска восстанавливаются из документа один раз)"""
+    hooks = _game_hooks.get(game['_id'])
+    if hooks is None:
+        hooks = {point: list(names) for point, names in game.get('event_hooks', {}).items()}
+        _game_hooks[game['_id']] = hooks
+    return hooks
+
+def clear_game_hooks(game_id: str):
+    """Забыть хуки завершённой игры (вызывается при любом удалении игры из базы)"""
+    _game_hooks.pop(game_id, None)
+
+def run_hooks(game: Dict[str, Any], point: str, ctx: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Вызвать хуки событий игры для точки и снять их (хуки одноразовые)
     
-    all_events = [
-        {'name': 'time_freeze', 'class': TimeFreezeEvent, 'cost': 30, 'description': '⏱️ Замедление времени! Следующий день длится в 2 раза дольше.', 'rarity': 'common', 'seasonal': None},
-        {'name': 'blizzard', 'class': BlizzardEvent, 'cost': 30, 'description': '❄️ Метель! Случайный живой игрок заблокирован на следующую ночь.', 'rarity': 'common', 'seasonal': 'winter'},
-        {'name': 'santa_workshop', 'class': SantaWorkshopEvent, 'cost': 50, 'description': '🎅 Мастерская Санты! Доктор может снова использовать самолечение.', 'rarity': 'rare', 'seasonal': 'winter'},
-        {'name': 'double_vote', 'class': DoubleVoteEvent, 'cost': 25, 'description': '🗳️ Двойное голосование! Следующее голосование будет проведено дважды.', 'rarity': 'common', 'seasonal': None},
-        {'name': 'night_vision', 'class': NightVisionEvent, 'cost': 35, 'description': '🌙 Ночное зрение! Комиссар может проверить двух игроков вместо одного.', 'rarity': 'common', 'seasonal': None},
-        {'name': 'protection', 'class': ProtectionEvent, 'cost': 40, 'description': '🛡️ Защита! Случайный живой игрок защищен от следующего убийства.', 'rarity': 'common', 'seasonal': None},
-        {'name': 'confusion', 'class': ConfusionEvent, 'cost': 30, 'description': '🌀 Путаница! Все роли перемешаны - игроки видят чужие роли.', 'rarity': 'common', 'seasonal': None},
-        {'name': 'extra_time', 'class': ExtraTimeEvent, 'cost': 20, 'description': '⏰ Дополнительное время! Следующая фаза длится на 30 секунд дольше.', 'rarity': 'common', 'seasonal': None},
-        {'name': 'resurrection', 'class': ResurrectionEvent, 'cost': 80, 'description': '💀 Воскрешение! Последний убитый игрок возвращается в игру.', 'rarity': 'rare', 'seasonal': None},
-        {'name': 'role_reveal', 'class': RoleRevealEvent, 'cost': 60, 'description': '🔍 Раскрытие роли! Роль случайного живого игрока раскрывается всем.', 'rarity': 'rare', 'seasonal': None},
-        {'name': 'mafia_reveal', 'class': MafiaRevealEvent, 'cost': 70, 'description': '😈 Раскрытие мафии! Все мафиози раскрываются мирным игрокам.', 'rarity': 'rare', 'seasonal': None},
-        {'name': 'immunity', 'class': ImmunityEvent, 'cost': 75, 'description': '✨ Иммунитет! Случайный живой игрок получает иммунитет от голосования.', 'rarity': 'rare', 'seasonal': None},
-        {'name': 'time_rewind', 'class': TimeRewindEvent, 'cost': 150, 'description': '⏪ Откат времени! Игра возвращается на предыдущую стадию.', 'rarity': 'legendary', 'seasonal': None},
-        {'name': 'all_roles_reveal', 'class': AllRolesRevealEvent, 'cost': 200, 'description': '👁️ Всевидение! Все роли всех живых игроков раскрываются.', 'rarity': 'legendary', 'seasonal': None},
-        {'name': 'snowstorm', 'class': SnowstormEvent, 'cost': 40, 'description': '🌨️ Снежная буря! Все ночные действия отменяются в следующую ночь.', 'rarity': 'rare', 'seasonal': 'winter'},
-        {'name': 'gift_exchange', 'class': GiftExchangeEvent, 'cost': 50, 'description': '🎁 Обмен подарками! Все живые игроки получают по 5 конфет.', 'rarity': 'rare', 'seasonal': 'winter'},
-        {'name': 'silent_night', 'class': SilentNightEvent, 'cost': 40, 'description': '🤫 Тихая ночь! Все ночные способности работают медленнее.', 'rarity': 'common', 'seasonal': 'winter'},
-        {'name': 'heat_wave', 'class': HeatWaveEvent, 'cost': 35, 'description': '☀️ Волна жары! Время на действия сокращается.', 'rarity': 'common', 'seasonal': 'summer'},
-        {'name': 'summer_festival', 'class': SummerFestivalEvent, 'cost': 45, 'description': '🎉 Летний фестиваль! Все игроки получают бонус к ELO рейтингу.', 'rarity': 'rare', 'seasonal': 'summer'},
-        {'name': 'spring_rain', 'class': SpringRainEvent, 'cost': 30, 'description': '🌧️ Весенний дождь! Все способности работают с задержкой.', 'rarity': 'common', 'seasonal': 'spring'},
-        {'name': 'bloom', 'class': BloomEvent, 'cost': 40, 'description': '🌸 Цветение! Все живые игроки получают по 3 конфеты.', 'rarity': 'common', 'seasonal': 'spring'},
-        {'name': 'autumn_fog', 'class': AutumnFogEvent, 'cost': 35, 'description': '🌫️ Осенний туман! Все проверки дают неверный результат.', 'rarity': 'common', 'seasonal': 'autumn'},
-        {'name': 'harvest', 'class': HarvestEvent, 'cost': 45, 'description': '🌾 Урожай! Все живые игроки получают по 4 конфеты.', 'rarity': 'common', 'seasonal': 'autumn'},
-        {'name': 'double_kill', 'class': DoubleKillEvent, 'cost': 90, 'description': '⚔️ Двойное убийство! Мафия может убить двух игроков вместо одного.', 'rarity': 'rare', 'seasonal': None},
-        {'name': 'lucky_day', 'class': LuckyDayEvent, 'cost': 55, 'description': '🍀 Счастливый день! Все живые игроки получают случайный бонус.', 'rarity': 'rare', 'seasonal': None}
-    ]
+    Args:
+        game: Документ игры
+        point: Одна из HOOK_POINTS
+        ctx: Контекст точки, хуки меняют его на месте
+    
+    Returns:
+        Поля игры для $set, которые вызывающий код пишет вместе со своей записью
+    """
+    names = get_game_hooks(game).get(point)
+    if not names:
+        return {}
     
-    # Фильтруем по сезону
-    available = [e for e in all_events if e['seasonal'] is None or e['seasonal'] == current_season]
+    updates: Dict[str, Any] = {}
+    for name in names:
+        hook = getattr(EVENT_REGISTRY.get(name), point, None)
+        if hook is None:
+            continue
+        started = perf_counter()
+        try:
+            updates.update(hook(game, ctx) or {})
+        except Exception as e:
+            logger.error(f"Error in {point} hook of event {name}: {str(e)}")
+            logger.error(traceback.format_exc())
+        cost = perf_counter() - started
+        metrics.observe('event_hook_seconds', cost, {'hook': point, 'event': name})
+        if cost >= SLOW_HOOK_SECONDS:
+            logger.warning(f"Slow event hook {name}.{point}: {cost * 1000:.2f} ms")
+        else:
+            logger.debug(f"Event hook {name}.{point} took {cost * 1000:.2f} ms")
     
-    return available
+    names.clear()
+    updates[f'event_hooks.{point}'] = []
+    return updates
+
+def hook_cost_report() -> str:
+    """Текст для админа: время хуков событий по точкам (вызовы, среднее, максимум)"""
+    series = metrics.series('event_hook_seconds')
+    lines = ['<b>⏱ Хуки событий</b>', '']
+    if not series:
+        lines.append('Хуки ещё не вызывались.')
+        return '\n'.join(lines)
+    for tags, stats in sorted(series, key=lambda item: -item[1]['total']):
+        average = stats['total'] / stats['count'] * 1000
+        lines.append(f"{tags.get('event')}.{tags.get('hook')}: {stats['count']} раз, "
+                     f"среднее {average:.2f} мс, максимум {stats['max'] * 1000:.2f} мс")
+    return '\n'.join(lines)
+
+# Удалённая игра (конец игры, /reset) больше не держит хуки в памяти
+database.on_delete('games', lambda game: clear_game_hooks(game['_id']))
@@ -4,9 +4,12 @@ import lang
 import logging
 import os
 from logging.handlers import RotatingFileHandler
-from game import role_titles, stop_game, start_game
+from game import role_titles, stop_game, start_game, get_elo_history
 from stages import stages, go_to_next_stage, format_roles, get_votes, send_player_message
 from bot import bot
+from stats_cache import cached_render
+from candies import credit, debit, get_balance
+from users import remember_user, resolve_user
 
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, LabeledPrice
 from telebot.apihelper import ApiException
@@ -62,8 +65,15 @@ def get_full_name(user):
     return html.escape(result)
 
 def user_object(user):
+    remember_user(user.id, user.username, get_full_name(user))
     return {'id': user.id, 'name': get_name(user), 'full_name': get_full_name(user)}
 
+def resolve_target(message, target):
+    """ID игрока, указанного ответом на его сообщение или как @username / ID / имя"""
+    if message.reply_to_message:
+        return user_object(message.reply_to_message.from_user)['id']
+    return resolve_user(target)
+
 # Кэшируем username бота, чтобы не делать запрос каждый раз
 _bot_username = None
 
@@ -192,7 +202,11 @@ def start_command(message, *args, **kwargs):
         bot.send_message(message.chat.id, help_text, parse_mode='HTML', reply_markup=kb)
 
 def get_user_stats(user_id, user=None, detailed=False):
-    """Получить статистику пользователя"""
+    """Получить статистику пользователя (из кэша, пока статистика не менялась)"""
+    return cached_render(user_id, ('stats', detailed), lambda: _render_user_stats(user_id, user, detailed))
+
+def _render_user_stats(user_id, user=None, detailed=False):
+    """Построить текст статистики пользователя"""
         
     stats = database.find_one('player_stats', {'user_id': user_id})
     
@@ -303,19 +317,19 @@ def get_user_stats(user_id, user=None, detailed=False):
     
     # Детальная статистика по времени
     if detailed:
-        games_by_hour = stats.get('games_by_hour', {})
-        wins_by_hour = stats.get('wins_by_hour', {})
-        games_by_day = stats.get('games_by_day', {})
-        wins_by_day = stats.get('wins_by_day', {})
+        games_by_hour = stats.get('games_by_hour') or [0] * 24
+        wins_by_hour = stats.get('wins_by_hour') or [0] * 24
+        games_by_day = stats.get('games_by_day') or [0] * 7
+        wins_by_day = stats.get('wins_by_day') or [0] * 7
         
-        if games_by_hour:
+        if any(games_by_hour):
             text += '⏰ <b>Статистика по времени суток:</b>\n'
             # Находим лучший час
             best_hour = None
             best_wr = 0
             for hour in range(24):
-                games = games_by_hour.get(hour, 0)
-                wins = wins_by_hour.get(hour, 0)
+                games = games_by_hour[hour]
+                wins = wins_by_hour[hour]
                 if games > 0:
                     wr = (wins / games * 100)
                     if wr > best_wr and games >= 3:  # Минимум 3 игры для статистики
@@ -326,21 +340,21 @@ def get_user_stats(user_id, user=None, detailed=False):
                 text += f'  🕐 Лучший час: {best_hour}:00 ({best_wr:.1f}% побед, {games_by_hour[best_hour]} игр)\n'
             
             # Находим самый активный час
-            most_active_hour = max(games_by_hour.items(), key=lambda x: x[1])[0] if games_by_hour else None
-            if most_active_hour is not None:
+            most_active_hour = max(range(24), key=lambda hour: games_by_hour[hour])
+            if games_by_hour[most_active_hour] > 0:
                 active_games = games_by_hour[most_active_hour]
-                active_wins = wins_by_hour.get(most_active_hour, 0)
+                active_wins = wins_by_hour[most_active_hour]
                 active_wr = (active_wins / active_games * 100) if active_games > 0 else 0
                 text += f'  📊 Самый активный: {most_active_hour}:00 ({active_games} игр, {active_wr:.1f}% побед)\n'
             text += '\n'
         
-        if games_by_day:
+        if any(games_by_day):
             text += '📅 <b>Статистика по дням недели:</b>\n'
             day_names = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
             day_stats = []
             for day in range(7):
-                games = games_by_day.get(day, 0)
-                wins = wins_by_day.get(day, 0)
+                games = games_by_day[day]
+                wins = wins_by_day[day]
                 if games > 0:
                     wr = (wins / games * 100)
                     day_stats.append((day, games, wins, wr))
@@ -352,19 +366,19 @@ def get_user_stats(user_id, user=None, detailed=False):
             text += '\n'
         
         # История рейтинга (последние изменения)
-        elo_history = stats.get('elo_history', [])
+        elo_history = get_elo_history(stats)
         if len(elo_history) >= 2:
             text += '📈 <b>Динамика рейтинга:</b>\n'
-            recent = elo_history[-5:]  # Последние 5 игр
-            first_rating = recent[0]['rating']
-            last_rating = recent[-1]['rating']
+            recent = [rating for rating, _, _ in elo_history[-5:]]  # Последние 5 игр
+            first_rating = recent[0]
+            last_rating = recent[-1]
             change = last_rating - first_rating
             change_str = f"+{change}" if change >= 0 else str(change)
             text += f'  За последние {len(recent)} игр: {change_str} ({first_rating} → {last_rating})\n'
             
             # Показываем тренд
             if len(recent) >= 3:
-                mid_rating = recent[len(recent)//2]['rating']
+                mid_rating = recent[len(recent)//2]
                 if last_rating > mid_rating > first_rating:
                     text += '  📈 Тренд: Растет\n'
                 elif last_rating < mid_rating < first_rating:
@@ -417,16 +431,14 @@ def stats_toggle_handler(call):
 @bot.message_handler(commands=['achievements', 'ach'])
 def show_achievements(message, *args, **kwargs):
     """Показать достижения игрока"""
+    user_id = message.from_user.id
     try:
-        from achievements import get_player_achievements, get_achievements_by_rarity, get_achievement_progress, ACHIEVEMENTS
+        text = cached_render(user_id, ('achievements', None), lambda: _render_achievements_overview(user_id))
     except ImportError:
         bot.send_message(message.chat.id, "❌ Система достижений временно недоступна.")
         return
     
-    user_id = message.from_user.id
-    stats = database.find_one('player_stats', {'user_id': user_id})
-    
-    if not stats:
+    if not text:
         bot.send_message(message.chat.id, 
             "📊 <b>Достижения</b>\n\n"
             "У вас пока нет достижений.\n"
@@ -434,52 +446,64 @@ def show_achievements(message, *args, **kwargs):
             parse_mode='HTML')
         return
     
-    # Получаем достижения игрока
-    player_achievements = get_player_achievements(user_id)
-    all_achievements = list(ACHIEVEMENTS.values())
-    total_count = len(all_achievements)
-    unlocked_count = len(player_achievements)
+    bot.send_message(message.chat.id, text, parse_mode='HTML', reply_markup=achievements_filter_keyboard())
+
+ACHIEVEMENT_RARITY_NAMES = {
+    'common': '🟢 Обычные',
+    'uncommon': '🔵 Необычные',
+    'rare': '🟣 Редкие',
+    'epic': '🟠 Эпические',
+    'legendary': '🟡 Легендарные',
+    'all': '📊 Все достижения'
+}
+
+def achievements_filter_keyboard():
+    """Кнопки фильтра достижений по редкости"""
+    kb = InlineKeyboardMarkup(row_width=2)
+    kb.add(
+        InlineKeyboardButton("🟢 Обычные", callback_data='ach_filter common'),
+        InlineKeyboardButton("🔵 Необычные", callback_data='ach_filter uncommon')
+    )
+    kb.add(
+        InlineKeyboardButton("🟣 Редкие", callback_data='ach_filter rare'),
+        InlineKeyboardButton("🟠 Эпические", callback_data='ach_filter epic')
+    )
+    kb.add(
+        InlineKeyboardButton("🟡 Легендарные", callback_data='ach_filter legendary'),
+        InlineKeyboardButton("📊 Все", callback_data='ach_filter all')
+    )
+    return kb
+
+def _render_achievements_overview(user_id):
+    """Обзор достижений по редкости (None, если игрок ещё не играл)"""
+    from achievements import ACHIEVEMENTS, ACHIEVEMENTS_BY_RARITY, get_player_achievements
     
-    # Группируем по редкости
-    rarity_groups = {
-        'common': [],
-        'uncommon': [],
-        'rare': [],
-        'epic': [],
-        'legendary': []
-    }
+    stats = database.find_one('player_stats', {'user_id': user_id})
+    if not stats:
+        return None
     
-    for ach in all_achievements:
-        rarity = ach.get('rarity', 'common')
-        if rarity in rarity_groups:
-            rarity_groups[rarity].append(ach)
+    # Получаем достижения игрока
+    player_achievements = get_player_achievements(user_id, stats)
+    unlocked_ids = {a['id'] for a in player_achievements}
+    total_count = len(ACHIEVEMENTS)
+    unlocked_count = len(player_achievements)
     
     # Формируем текст
     text = f"🏆 <b>ДОСТИЖЕНИЯ</b> 🏆\n\n"
     text += f"📊 Прогресс: {unlocked_count}/{total_count} ({unlocked_count*100//total_count}%)\n\n"
     
     # Показываем по редкости
-    rarity_names = {
-        'common': '🟢 Обычные',
-        'uncommon': '🔵 Необычные',
-        'rare': '🟣 Редкие',
-        'epic': '🟠 Эпические',
-        'legendary': '🟡 Легендарные'
-    }
-    
-    for rarity, name in rarity_names.items():
-        achievements = rarity_groups[rarity]
+    for rarity, achievements in ACHIEVEMENTS_BY_RARITY.items():
         if not achievements:
             continue
         
-        text += f"{name}:\n"
+        text += f"{ACHIEVEMENT_RARITY_NAMES.get(rarity, rarity)}:\n"
         for ach in achievements[:5]:  # Показываем первые 5 каждого типа
-            is_unlocked = ach['id'] in [a['id'] for a in player_achievements]
-            icon = "✅" if is_unlocked else "🔒"
+            icon = "✅" if ach['id'] in unlocked_ids else "🔒"
             text += f"  {icon} {ach['icon']} {ach['name']}\n"
         
         if len(achievements) > 5:
-            unlocked_in_group = sum(1 for a in achievements if a['id'] in [p['id'] for p in player_achievements])
+            unlocked_in_group = sum(1 for a in achievements if a['id'] in unlocked_ids)
             text += f"  ... и еще {len(achievements) - 5} ({unlocked_in_group}/{len(achievements)} разблокировано)\n"
         text += "\n"
     
@@ -488,23 +512,46 @@ def show_achievements(message, *args, **kwargs):
         text += f"🎉 <b>Последние достижения:</b>\n"
         for ach in player_achievements[-5:]:  # Последние 5
             text += f"  {ach['icon']} {ach['name']}\n"
+    return text
+
+def _render_achievements_page(user_id, filter_type):
+    """Страница достижений с фильтром по редкости и прогрессом (None без статистики)"""
+    from achievements import ACHIEVEMENTS, get_achievements_by_rarity, calculate_progress
     
-    # Кнопки для фильтрации
-    kb = InlineKeyboardMarkup(row_width=2)
-    kb.add(
-        InlineKeyboardButton("🟢 Обычные", callback_data='ach_filter common'),
-        InlineKeyboardButton("🔵 Необычные", callback_data='ach_filter uncommon')
-    )
-    kb.add(
-        InlineKeyboardButton("🟣 Редкие", callback_data='ach_filter rare'),
-        InlineKeyboardButton("🟠 Эпические", callback_data='ach_filter epic')
-    )
-    kb.add(
-        InlineKeyboardButton("🟡 Легендарные", callback_data='ach_filter legendary'),
-        InlineKeyboardButton("📊 Все", callback_data='ach_filter all')
-    )
+    stats = database.find_one('player_stats', {'user_id': user_id})
+    if not stats:
+        return None
     
-    bot.send_message(message.chat.id, text, parse_mode='HTML', reply_markup=kb)
+    player_ach_ids = set(stats.get('achievements', []))
+    
+    # Фильтруем достижения
+    if filter_type == 'all':
+        achievements_to_show = list(ACHIEVEMENTS.values())
+    else:
+        achievements_to_show = get_achievements_by_rarity(filter_type)
+    
+    # Сортируем: сначала разблокированные, потом заблокированные
+    achievements_to_show.sort(key=lambda x: (x['id'] not in player_ach_ids, x['rarity']))
+    
+    text = f"🏆 <b>{ACHIEVEMENT_RARITY_NAMES.get(filter_type, 'Достижения')}</b>\n\n"
+    
+    for ach in achievements_to_show[:20]:  # Показываем до 20
+        is_unlocked = ach['id'] in player_ach_ids
+        icon = "✅" if is_unlocked else "🔒"
+        reward = f" (+{ach.get('reward_candies', 0)}🍭)" if not is_unlocked else ""
+        text += f"{icon} {ach['icon']} <b>{ach['name']}</b>{reward}\n"
+        text += f"   {ach['description']}\n"
+        if not is_unlocked:
+            # Прогресс считается из той же прочитанной статистики
+            progress = calculate_progress(stats, ach['id'])['progress']
+            if progress > 0:
+                filled = progress // 20
+                text += f"   {'▰' * filled}{'▱' * (5 - filled)} {progress}%\n"
+        text += "\n"
+    
+    if len(achievements_to_show) > 20:
+        text += f"\n... и еще {len(achievements_to_show) - 20} достижений"
+    return text
 
 @bot.message_handler(commands=['leaderboard', 'top', 'lb'])
 def show_leaderboard(message, *args, **kwargs):
@@ -649,23 +696,20 @@ def show_leaderboard(message, *args, **kwargs):
     
     bot.send_message(message.chat.id, text, parse_mode='HTML')
 
-@bot.message_handler(commands=['customize', 'custom'])
-def customize_command(message, *args, **kwargs):
-    """Команда для настройки кастомизации"""
-    try:
-        from customization import get_customization, set_name_formatting, clear_customization
-        from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
-    except ImportError:
-        bot.send_message(message.chat.id, "❌ Система кастомизации недоступна.")
-        return
-    
-    user_id = message.from_user.id
-    chat_id = message.chat.id if message.chat.type in ('group', 'supergroup') else None
-    
-    customization = get_customization(user_id, chat_id)
+def _customize_view(customization, chat_id):
+    """Текст и клавиатура /customize с указанием, какая запись показана и редактируется"""
+    if not chat_id:
+        scope = 'Общая запись (действует во всех чатах без своей)'
+    elif not customization.get('_id'):
+        scope = 'В этом чате своей записи нет'
+    elif customization.get('chat_id') == chat_id:
+        scope = 'Запись этого чата (кнопки меняют её)'
+    else:
+        scope = 'В этом чате своей записи нет, показана общая (кнопки создадут запись чата)'
     
     text = (
-        '🎨 <b>Кастомизация роли</b>\n\n'
+        '🎨 <b>Кастомизация роли</b>\n'
+        f'<i>{scope}</i>\n\n'
         f'Префикс: {customization.get("role_prefix", "") or "нет"}\n'
         f'Суффикс: {customization.get("role_suffix", "") or "нет"}\n'
         f'Форматирование: {customization.get("name_formatting", "normal")}\n\n'
@@ -680,9 +724,23 @@ def customize_command(message, *args, **kwargs):
     )
     kb.add(
         InlineKeyboardButton("📝 Курсив", callback_data='custom_format italic'),
-        InlineKeyboardButton("🗑️ Очистить", callback_data='custom_clear')
+        InlineKeyboardButton("🗑️ Очистить" if not chat_id else "🗑️ Очистить запись чата", callback_data='custom_clear')
     )
+    return text, kb
+
+@bot.message_handler(commands=['customize', 'custom'])
+def customize_command(message, *args, **kwargs):
+    """Команда для настройки кастомизации"""
+    try:
+        from customization import get_customization
+    except ImportError:
+        bot.send_message(message.chat.id, "❌ Система кастомизации недоступна.")
+        return
     
+    user_id = message.from_user.id
+    chat_id = message.chat.id if message.chat.type in ('group', 'supergroup') else None
+    
+    text, kb = _customize_view(get_customization(user_id, chat_id), chat_id)
     bot.send_message(message.chat.id, text, parse_mode='HTML', reply_markup=kb)
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('custom_'))
@@ -690,7 +748,6 @@ def customize_callback(call):
     """Обработчик кастомизации"""
     try:
         from customization import get_customization, set_name_formatting, clear_customization
-        from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
     except ImportError:
         safe_answer_callback(call.id, "Система кастомизации недоступна", show_alert=True)
         return
@@ -704,26 +761,7 @@ def customize_callback(call):
         safe_answer_callback(call.id, f"✅ Форматирование установлено: {formatting}")
         
         # Обновляем сообщение
-        customization = get_customization(user_id, chat_id)
-        text = (
-            '🎨 <b>Кастомизация роли</b>\n\n'
-            f'Префикс: {customization.get("role_prefix", "") or "нет"}\n'
-            f'Суффикс: {customization.get("role_suffix", "") or "нет"}\n'
-            f'Форматирование: {customization.get("name_formatting", "normal")}\n\n'
-            '💡 Префиксы и суффиксы выдаются за достижения!\n'
-            '💡 Используйте кнопки ниже для настройки форматирования.'
-        )
-        
-        kb = InlineKeyboardMarkup(row_width=2)
-        kb.add(
-            InlineKeyboardButton("📝 Обычный", callback_data='custom_format normal'),
-            InlineKeyboardButton("📝 Жирный", callback_data='custom_format bold')
-        )
-        kb.add(
-            InlineKeyboardButton("📝 Курсив", callback_data='custom_format italic'),
-            InlineKeyboardButton("🗑️ Очистить", callback_data='custom_clear')
-        )
-        
+        text, kb = _customize_view(get_customization(user_id, chat_id), chat_id)
         try:
             bot.edit_message_text(text, call.message.chat.id, call.message.message_id, parse_mode='HTML', reply_markup=kb)
         except:
@@ -731,29 +769,10 @@ def customize_callback(call):
     
     elif call.data == 'custom_clear':
         clear_customization(user_id, chat_id)
-        safe_answer_callback(call.id, "✅ Кастомизация очищена")
+        safe_answer_callback(call.id, "✅ Запись этого чата очищена" if chat_id else "✅ Кастомизация очищена")
         
         # Обновляем сообщение
-        customization = get_customization(user_id, chat_id)
-        text = (
-            '🎨 <b>Кастомизация роли</b>\n\n'
-            f'Префикс: {customization.get("role_prefix", "") or "нет"}\n'
-            f'Суффикс: {customization.get("role_suffix", "") or "нет"}\n'
-            f'Форматирование: {customization.get("name_formatting", "normal")}\n\n'
-            '💡 Префиксы и суффиксы выдаются за достижения!\n'
-            '💡 Используйте кнопки ниже для настройки форматирования.'
-        )
-        
-        kb = InlineKeyboardMarkup(row_width=2)
-        kb.add(
-            InlineKeyboardButton("📝 Обычный", callback_data='custom_format normal'),
-            InlineKeyboardButton("📝 Жирный", callback_data='custom_format bold')
-        )
-        kb.add(
-            InlineKeyboardButton("📝 Курсив", callback_data='custom_format italic'),
-            InlineKeyboardButton("🗑️ Очистить", callback_data='custom_clear')
-        )
-        
+        text, kb = _customize_view(get_customization(user_id, chat_id), chat_id)
         try:
             bot.edit_message_text(text, call.message.chat.id, call.message.message_id, parse_mode='HTML', reply_markup=kb)
         except:
@@ -795,9 +814,11 @@ def claim_daily_drop_callback(call):
         database.insert_one('player_stats', stats)
     
     candies_amount = drop.get('candies', 0)
-    new_candies = stats.get('candies', 0) + candies_amount
-    
-    database.update_one('player_stats', {'user_id': user_id}, {'$set': {'candies': new_candies}})
+    # Ключ дропа: даже при одновременных нажатиях конфеты получит только один игрок
+    if not credit(user_id, candies_amount, 'daily_drop', key=f"drop:{drop['_id']}"):
+        safe_answer_callback(call.id, "❌ Эти конфеты уже кто-то забрал!", show_alert=True)
+        return
+    new_candies = get_balance(user_id)
     
     # Помечаем дроп как забранный
     database.update_one('daily_drops', {'_id': drop['_id']}, {
@@ -906,14 +927,318 @@ def mafia_chat_command(message, *args, **kwargs):
     else:
         safe_send_message(message.chat.id, "❌ Не удалось отправить сообщение. Возможно, все члены мафии заблокировали бота.")
 
+# --- СТРАНИЦЫ МАГАЗИНОВ ---
+
+# Заготовки страниц магазина и магазина событий: {ключ: заготовка}.
+# Заготовка — {'parts': [...], 'buttons': [...]}, где часть страницы — строка,
+# None (место для баланса) или (цена, строка товара) для отметки ✅/❌;
+# кнопка — (цена, текст, callback_data) и показывается, если хватает конфет.
+# Ключи строятся только из известных фильтров и существующих номеров страниц
+# (callback_data приходит от клиента), поэтому кэш не растёт без предела.
+_shop_page_cache = {}
+
+SHOP_PAGE_SIZE = 15
+SHOP_FILTERS = ('badge', 'title', 'case', 'candies', 'all')
+
+SEASON_NAMES = {'winter': '❄️ Зима', 'spring': '🌸 Весна', 'summer': '☀️ Лето', 'autumn': '🍂 Осень'}
+EVENT_RARITY_ICONS = {'common': '🟢', 'rare': '🟣', 'legendary': '🟡'}
+EVENT_RARITY_NAMES = {'common': 'Обычные', 'rare': 'Редкие', 'legendary': 'Легендарные'}
+EVENT_FILTERS = tuple(EVENT_RARITY_NAMES) + ('all',)
+
+def _cached_page(key, build):
+    """Заготовка страницы из кэша (строится при первом запросе)"""
+    template = _shop_page_cache.get(key)
+    if template is None:
+        template = _shop_page_cache[key] = build()
+    return template
+
+def _overlay_page(template, candies, balance_text):
+    """Наложить на заготовку баланс и отметки доступности для игрока"""
+    parts = []
+    for part in template['parts']:
+        if part is None:
+            parts.append(balance_text)
+        elif isinstance(part, tuple):
+            cost, line = part
+            parts.append(f"{'✅' if candies >= cost else '❌'} {line}")
+        else:
+            parts.append(part)
+    kb = InlineKeyboardMarkup(row_width=1)
+    for cost, label, data in template['buttons']:
+        if candies >= cost:
+            kb.add(InlineKeyboardButton(label, callback_data=data))
+    return ''.join(parts), kb
+
+def _page_nav_row(prefix, page, pages):
+    """Кнопки листания страниц (пустой список, если страница одна)"""
+    row = []
+    if page > 1:
+        row.append(InlineKeyboardButton('◀️', callback_data=f'{prefix} {page - 1}'))
+    if page < pages:
+        row.append(InlineKeyboardButton('▶️', callback_data=f'{prefix} {page + 1}'))
+    return row
+
+def _parse_page(parts, index):
+    """Номер страницы из callback_data (по умолчанию первая)"""
+    if len(parts) > index and parts[index].isdigit():
+        return max(1, int(parts[index]))
+    return 1
+
+def _clamp_page(page, count):
+    """Номер страницы в пределах списка из count элементов"""
+    return min(page, max(1, (count + SHOP_PAGE_SIZE - 1) // SHOP_PAGE_SIZE))
+
+def _build_shop_main(offers_version):
+    from shop import get_shop_items, get_active_limited_offers
+
+    badges = get_shop_items('badge')
+    titles = get_shop_items('title')
+    cases = get_shop_items('case')
+    candies_packs = get_shop_items('candies')
+    limited_offers = get_active_limited_offers()
+
+    # Красивый дизайн магазина
+    text = "━━━━━━━━━━━━━━━━━━━━\n"
+    text += "🎄 <b>МАГАЗИН СЕВЕРНОГО ПОЛЮСА</b> 🎄\n"
+    text += "━━━━━━━━━━━━━━━━━━━━\n\n"
+    parts = [text, None]
+    text = ""
+
+    # Ограниченные предложения
+    if limited_offers:
+        text += "🔥 <b>🔥 ОГРАНИЧЕННЫЕ ПРЕДЛОЖЕНИЯ 🔥</b>\n"
+        for offer in limited_offers:
+            text += f"   • {offer.get('name', 'Предложение')}\n"
+        text += "\n"
+
+    # Бейджи
+    text += "━━━━━━━━━━━━━━━━━━━━\n"
+    text += "🎖️ <b>БЕЙДЖИ</b>\n"
+    text += "━━━━━━━━━━━━━━━━━━━━\n"
+    for badge in badges:
+        rarity_emoji = {'common': '🟢', 'rare': '🟣', 'legendary': '🟡'}.get(badge.get('rarity', 'common'), '⚪')
+        text += f"\n{rarity_emoji} {badge['icon']} <b>{badge['name']}</b>\n"
+        text += f"   {badge.get('description', '')}\n"
+        text += f"   💰 <code>{badge.get('cost_candies', 0)}</code> 🍭\n"
+        text += f"   📝 <code>/shop {badge['name']}</code>\n"
+
+    # Титулы
+    text += "\n━━━━━━━━━━━━━━━━━━━━\n"
+    text += "🎩 <b>ТИТУЛЫ</b>\n"
+    text += "━━━━━━━━━━━━━━━━━━━━\n"
+    for title in titles:
+        rarity_emoji = {'common': '🟢', 'uncommon': '🔵', 'rare': '🟣', 'legendary': '🟡'}.get(title.get('rarity', 'common'), '⚪')
+        text += f"\n{rarity_emoji} {title['icon']} <b>{title['name']}</b>\n"
+        text += f"   {title.get('description', '')}\n"
+        text += f"   💰 <code>{title.get('cost_candies', 0)}</code> 🍭\n"
+        text += f"   📝 <code>/shop {title['name']}</code>\n"
+
+    # Кейсы
+    text += "\n━━━━━━━━━━━━━━━━━━━━\n"
+    text += "📦 <b>КЕЙСЫ</b>\n"
+    text += "━━━━━━━━━━━━━━━━━━━━\n"
+    for case in cases:
+        rarity_emoji = {'common': '🟢', 'rare': '🟣', 'legendary': '🟡'}.get(case.get('rarity', 'common'), '⚪')
+        text += f"\n{rarity_emoji} {case['icon']} <b>{case['name']}</b>\n"
+        text += f"   {case.get('description', '')}\n"
+        text += f"   💰 <code>{case.get('cost_candies', 0)}</code> 🍭\n"
+        text += f"   📝 <code>/shop {case['name']}</code>\n"
+
+    # Покупка конфет за Звезды
+    text += "\n━━━━━━━━━━━━━━━━━━━━\n"
+    text += "⭐ <b>КОНФЕТЫ ЗА ЗВЕЗДЫ</b>\n"
+    text += "━━━━━━━━━━━━━━━━━━━━\n"
+    for pack in candies_packs:
+        rarity_emoji = {'common': '🟢', 'uncommon': '🔵', 'rare': '🟣'}.get(pack.get('rarity', 'common'), '⚪')
+        text += f"\n{rarity_emoji} {pack['icon']} <b>{pack['name']}</b>\n"
+        text += f"   {pack.get('description', '')}\n"
+        text += f"   💰 <code>{pack.get('cost_stars', 0)}</code> ⭐\n"
+        text += f"   📝 <code>/shop {pack['name']}</code>\n"
+
+    text += "\n━━━━━━━━━━━━━━━━━━━━\n"
+    text += "💡 <i>Для покупки используйте:</i>\n"
+    text += "<code>/shop [название товара]</code>\n"
+    text += "━━━━━━━━━━━━━━━━━━━━"
+    parts.append(text)
+
+    # Быстрые кнопки для покупки конфет за звезды (первые 3 пакета)
+    buttons = [(0, f"⭐ {pack['name']} ({pack.get('cost_stars', 0)}⭐)", f'buy_stars_{pack["id"]}')
+               for pack in candies_packs[:3]]
+    return {'parts': parts, 'buttons': buttons, 'offers_version': offers_version}
+
+def _build_shop_category(filter_type, page):
+    from shop import get_shop_items
+
+    items = get_shop_items() if filter_type == 'all' else get_shop_items(filter_type)
+    pages = max(1, (len(items) + SHOP_PAGE_SIZE - 1) // SHOP_PAGE_SIZE)
+    page = min(page, pages)
+
+    category_names = {
+        'badge': '🎖️ БЕЙДЖИ',
+        'title': '🎩 ТИТУЛЫ',
+        'case': '📦 КЕЙСЫ',
+        'candies': '🍭 КОНФЕТЫ',
+        'all': '📊 ВСЕ ТОВАРЫ'
+    }
+
+    text = "━━━━━━━━━━━━━━━━━━━━\n"
+    text += f"🎄 <b>{category_names.get(filter_type, 'МАГАЗИН')}</b> 🎄\n"
+    text += "━━━━━━━━━━━━━━━━━━━━\n\n"
+    parts = [text, None]
+    text = "━━━━━━━━━━━━━━━━━━━━\n"
+
+    for item in items[(page - 1) * SHOP_PAGE_SIZE:page * SHOP_PAGE_SIZE]:
+        cost = item.get('cost_candies') or item.get('cost_stars', 0)
+        currency = "🍭" if item.get('cost_candies') else "⭐"
+        rarity_emoji = {'common': '🟢', 'uncommon': '🔵', 'rare': '🟣', 'legendary': '🟡'}.get(item.get('rarity', 'common'), '⚪')
+
+        text += f"\n{rarity_emoji} {item['icon']} <b>{item['name']}</b>\n"
+        text += f"   {item.get('description', '')}\n"
+        text += f"   💰 <code>{cost}</code> {currency}\n"
+        text += f"   📝 <code>/shop {item['name']}</code>\n"
+
+    if pages > 1:
+        text += f"\n📄 Страница {page}/{pages}\n"
+    text += "\n━━━━━━━━━━━━━━━━━━━━\n"
+    text += "💡 <i>Для покупки используйте:</i>\n"
+    text += "<code>/shop [название товара]</code>\n"
+    text += "━━━━━━━━━━━━━━━━━━━━"
+    parts.append(text)
+    return {'parts': parts, 'buttons': [], 'page': page, 'pages': pages}
+
+def shop_filter_keyboard(kb=None):
+    """Кнопки категорий магазина (добавляются к переданной клавиатуре)"""
+    filter_kb = kb or InlineKeyboardMarkup(row_width=3)
+    filter_kb.row(
+        InlineKeyboardButton("🎖️ Бейджи", callback_data='shop_filter badge'),
+        InlineKeyboardButton("🎩 Титулы", callback_data='shop_filter title'),
+        InlineKeyboardButton("📦 Кейсы", callback_data='shop_filter case')
+    )
+    filter_kb.row(
+        InlineKeyboardButton("🍭 Конфеты", callback_data='shop_filter candies'),
+        InlineKeyboardButton("📦 Инвентарь", callback_data='shop_inventory'),
+        InlineKeyboardButton("📊 Все", callback_data='shop_filter all')
+    )
+    return filter_kb
+
+def render_shop_page(candies, filter_type=None, page=1):
+    """Страница магазина для игрока: заготовка из кэша + баланс
+
+    filter_type None — главная страница /shop, иначе категория (или 'all').
+    """
+    balance_text = f"💰 <b>Ваш баланс:</b> <code>{candies:,}</code> 🍭\n\n"
+    if filter_type is None:
+        from shop import get_offers_version
+        version = get_offers_version()
+        # Главная страница одна: пересобирается, когда меняется набор предложений
+        template = _shop_page_cache.get('shop')
+        if template is None or template['offers_version'] != version:
+            template = _shop_page_cache['shop'] = _build_shop_main(version)
+        text, buttons = _overlay_page(template, candies, balance_text)
+        kb = shop_filter_keyboard()
+        for row in buttons.keyboard:
+            kb.keyboard.append(row)
+        return text, kb
+
+    from shop import get_shop_items
+
+    if filter_type not in SHOP_FILTERS:
+        filter_type = 'all'
+    page = _clamp_page(page, len(get_shop_items(None if filter_type == 'all' else filter_type)))
+    template = _cached_page(('shop_filter', filter_type, page), lambda: _build_shop_category(filter_type, page))
+    text, kb = _overlay_page(template, candies, balance_text)
+    kb = shop_filter_keyboard(kb)
+    nav = _page_nav_row(f'shop_filter {filter_type}', template['page'], template['pages'])
+    if nav:
+        kb.row(*nav)
+    return text, kb
+
+def _event_line(event, rarity_icon=None):
+    """Строка события; с иконкой редкости — как в списке фильтра (с пометкой сезона)"""
+    if rarity_icon is None:
+        return f'{event["description"]}\n   💰 {event["cost"]} 🍭\n\n'
+    seasonal_mark = f" ({event.get('seasonal', '')})" if event.get('seasonal') else ""
+    return f'{rarity_icon} {event["description"]}{seasonal_mark}\n   💰 {event["cost"]} 🍭\n\n'
+
+def _build_events_main(season):
+    from game_events import get_available_events
+
+    parts = ['🍭 <b>Магазин событий</b>\n\n', None,
+             f'Сезон: {SEASON_NAMES.get(season, season)}\n\n']
+    buttons = []
+    # Легендарные все, редкие и обычные — первые 5
+    for rarity, limit in (('legendary', None), ('rare', 5), ('common', 5)):
+        events = get_available_events(rarity)
+        if not events:
+            continue
+        icon = EVENT_RARITY_ICONS[rarity]
+        parts.append(f'<b>{icon} {EVENT_RARITY_NAMES[rarity]}:</b>\n')
+        for event in events[:limit]:
+            parts.append((event['cost'], _event_line(event)))
+            buttons.append((event['cost'], f'{icon} Купить {event["name"]} ({event["cost"]} 🍭)', f'buy_event_{event["name"]}'))
+        if limit and len(events) > limit:
+            parts.append(f'... и еще {len(events) - limit} {"редких" if rarity == "rare" else "обычных"} событий\n\n')
+    return {'parts': parts, 'buttons': buttons}
+
+def _build_events_filter(season, filter_type, page):
+    from game_events import get_available_events
+
+    events = get_available_events(None if filter_type == 'all' else filter_type)
+    pages = max(1, (len(events) + SHOP_PAGE_SIZE - 1) // SHOP_PAGE_SIZE)
+    page = min(page, pages)
+
+    header = f'Сезон: {SEASON_NAMES.get(season, season)}\n'
+    if filter_type != 'all':
+        header += f'Фильтр: {EVENT_RARITY_ICONS.get(filter_type, "")} {EVENT_RARITY_NAMES.get(filter_type, filter_type)}\n'
+    parts = ['🍭 <b>Магазин событий</b>\n\n', None, header + '\n']
+    buttons = []
+    for event in events[(page - 1) * SHOP_PAGE_SIZE:page * SHOP_PAGE_SIZE]:
+        icon = EVENT_RARITY_ICONS.get(event.get('rarity', 'common'), '')
+        parts.append((event['cost'], _event_line(event, icon)))
+        buttons.append((event['cost'], f'{icon} Купить {event["name"]} ({event["cost"]} 🍭)', f'buy_event_{event["name"]}'))
+    if pages > 1:
+        parts.append(f'\n📄 Страница {page}/{pages}\n')
+    return {'parts': parts, 'buttons': buttons, 'page': page, 'pages': pages}
+
+def events_filter_keyboard(kb):
+    """Добавить кнопки фильтра по редкости к клавиатуре магазина событий"""
+    kb.row(
+        InlineKeyboardButton("🟢 Обычные", callback_data='events_filter common'),
+        InlineKeyboardButton("🟣 Редкие", callback_data='events_filter rare'),
+        InlineKeyboardButton("🟡 Легендарные", callback_data='events_filter legendary')
+    )
+    kb.row(InlineKeyboardButton("📊 Все", callback_data='events_filter all'))
+    return kb
+
+def render_events_page(candies, filter_type=None, page=1):
+    """Страница магазина событий для игрока: заготовка сезона из кэша + баланс и отметки"""
+    from game_events import get_available_events, get_current_season
+
+    season = get_current_season()
+    balance_text = f'У тебя: {candies} 🍭\n'
+    if filter_type is None:
+        template = _cached_page(('events', season), lambda: _build_events_main(season))
+        text, kb = _overlay_page(template, candies, balance_text)
+        if candies == 0:
+            text += '\n💡 Выиграй игру, чтобы получить 10 🍭!'
+        return text, events_filter_keyboard(kb)
+
+    if filter_type not in EVENT_FILTERS:
+        filter_type = 'all'
+    page = _clamp_page(page, len(get_available_events(None if filter_type == 'all' else filter_type)))
+    template = _cached_page(('events_filter', season, filter_type, page),
+                            lambda: _build_events_filter(season, filter_type, page))
+    text, kb = _overlay_page(template, candies, balance_text)
+    nav = _page_nav_row(f'events_filter {filter_type}', template['page'], template['pages'])
+    if nav:
+        kb.row(*nav)
+    return text, events_filter_keyboard(kb)
+
 @bot.message_handler(commands=['events', 'event'])
 def show_events_shop(message, *args, **kwargs):
     """Показать магазин событий"""
-    from game_events import get_available_events
-    
     user_id = message.from_user.id
-    stats = database.find_one('player_stats', {'user_id': user_id})
-    candies = stats.get('candies', 0) if stats else 0
+    candies = get_balance(user_id)
     
     # Проверяем, есть ли активная игра
     game = None
@@ -943,95 +1268,14 @@ def show_events_shop(message, *args, **kwargs):
         return
     
     # Показываем доступные события
-    from game_events import get_current_season
-    events = get_available_events()
-    current_season = get_current_season()
-    season_names = {'winter': '❄️ Зима', 'spring': '🌸 Весна', 'summer': '☀️ Лето', 'autumn': '🍂 Осень'}
-    
-    text = f'🍭 <b>Магазин событий</b>\n\n'
-    text += f'У тебя: {candies} 🍭\n'
-    text += f'Сезон: {season_names.get(current_season, current_season)}\n\n'
-    
-    # Группируем по редкости
-    common_events = [e for e in events if e.get('rarity') == 'common']
-    rare_events = [e for e in events if e.get('rarity') == 'rare']
-    legendary_events = [e for e in events if e.get('rarity') == 'legendary']
-    
-    rarity_icons = {'common': '🟢', 'rare': '🟣', 'legendary': '🟡'}
-    rarity_names = {'common': 'Обычные', 'rare': 'Редкие', 'legendary': 'Легендарные'}
-    
-    kb = InlineKeyboardMarkup(row_width=1)
-    
-    # Легендарные события
-    if legendary_events:
-        text += f'<b>{rarity_icons["legendary"]} {rarity_names["legendary"]}:</b>\n'
-        for event in legendary_events:
-            can_afford = candies >= event['cost']
-            status = '✅' if can_afford else '❌'
-            text += f'{status} {event["description"]}\n'
-            text += f'   💰 {event["cost"]} 🍭\n\n'
-            if can_afford:
-                kb.add(InlineKeyboardButton(
-                    f'🟡 Купить {event["name"]} ({event["cost"]} 🍭)',
-                    callback_data=f'buy_event_{event["name"]}'
-                ))
-    
-    # Редкие события
-    if rare_events:
-        text += f'<b>{rarity_icons["rare"]} {rarity_names["rare"]}:</b>\n'
-        for event in rare_events[:5]:  # Показываем первые 5
-            can_afford = candies >= event['cost']
-            status = '✅' if can_afford else '❌'
-            text += f'{status} {event["description"]}\n'
-            text += f'   💰 {event["cost"]} 🍭\n\n'
-            if can_afford:
-                kb.add(InlineKeyboardButton(
-                    f'🟣 Купить {event["name"]} ({event["cost"]} 🍭)',
-                    callback_data=f'buy_event_{event["name"]}'
-                ))
-        if len(rare_events) > 5:
-            text += f'... и еще {len(rare_events) - 5} редких событий\n\n'
-    
-    # Обычные события
-    if common_events:
-        text += f'<b>{rarity_icons["common"]} {rarity_names["common"]}:</b>\n'
-        for event in common_events[:5]:  # Показываем первые 5
-            can_afford = candies >= event['cost']
-            status = '✅' if can_afford else '❌'
-            text += f'{status} {event["description"]}\n'
-            text += f'   💰 {event["cost"]} 🍭\n\n'
-            if can_afford:
-                kb.add(InlineKeyboardButton(
-                    f'🟢 Купить {event["name"]} ({event["cost"]} 🍭)',
-                    callback_data=f'buy_event_{event["name"]}'
-                ))
-        if len(common_events) > 5:
-            text += f'... и еще {len(common_events) - 5} обычных событий\n\n'
-    
-    if candies == 0:
-        text += '\n💡 Выиграй игру, чтобы получить 10 🍭!'
-    
-    # Добавляем кнопки фильтрации
-    filter_kb = InlineKeyboardMarkup(row_width=3)
-    filter_kb.add(
-        InlineKeyboardButton("🟢 Обычные", callback_data='events_filter common'),
-        InlineKeyboardButton("🟣 Редкие", callback_data='events_filter rare'),
-        InlineKeyboardButton("🟡 Легендарные", callback_data='events_filter legendary')
-    )
-    filter_kb.add(InlineKeyboardButton("📊 Все", callback_data='events_filter all'))
-    
-    # Объединяем клавиатуры
-    if kb.keyboard:
-        for row in filter_kb.keyboard:
-            kb.keyboard.append(row)
-    
-    bot.send_message(message.chat.id, text, parse_mode='HTML', reply_markup=kb if kb.keyboard else filter_kb)
+    text, kb = render_events_page(candies)
+    bot.send_message(message.chat.id, text, parse_mode='HTML', reply_markup=kb)
 
 @bot.message_handler(commands=['shop', 'магазин'])
 def show_shop(message, *args, **kwargs):
     """Показать магазин или купить товар"""
     try:
-        from shop import get_shop_items, get_active_limited_offers, get_user_inventory, find_item_by_name, purchase_item
+        from shop import find_item_by_name, purchase_item
     except ImportError as e:
         logging.error(f"Error importing shop module: {e}", exc_info=True)
         bot.send_message(message.chat.id, f"❌ Магазин временно недоступен.\nОшибка импорта: {str(e)}")
@@ -1043,8 +1287,7 @@ def show_shop(message, *args, **kwargs):
     
     try:
         user_id = message.from_user.id
-        stats = database.find_one('player_stats', {'user_id': user_id})
-        candies = stats.get('candies', 0) if stats else 0
+        candies = get_balance(user_id)
         
         # Проверяем, есть ли аргумент (название товара для покупки)
         command_text = message.text or ''
@@ -1080,99 +1323,8 @@ def show_shop(message, *args, **kwargs):
             return
         
         # Показываем магазин
-        badges = get_shop_items('badge')
-        titles = get_shop_items('title')
-        cases = get_shop_items('case')
-        candies_packs = get_shop_items('candies')
-        limited_offers = get_active_limited_offers()
-        
-        # Красивый дизайн магазина
-        text = "━━━━━━━━━━━━━━━━━━━━\n"
-        text += "🎄 <b>МАГАЗИН СЕВЕРНОГО ПОЛЮСА</b> 🎄\n"
-        text += "━━━━━━━━━━━━━━━━━━━━\n\n"
-        
-        text += f"💰 <b>Ваш баланс:</b> <code>{candies:,}</code> 🍭\n\n"
-        
-        # Ограниченные предложения
-        if limited_offers:
-            text += "🔥 <b>🔥 ОГРАНИЧЕННЫЕ ПРЕДЛОЖЕНИЯ 🔥</b>\n"
-            for offer in limited_offers:
-                text += f"   • {offer.get('name', 'Предложение')}\n"
-            text += "\n"
-        
-        # Бейджи
-        text += "━━━━━━━━━━━━━━━━━━━━\n"
-        text += "🎖️ <b>БЕЙДЖИ</b>\n"
-        text += "━━━━━━━━━━━━━━━━━━━━\n"
-        for badge in badges:
-            rarity_emoji = {'common': '🟢', 'rare': '🟣', 'legendary': '🟡'}.get(badge.get('rarity', 'common'), '⚪')
-            text += f"\n{rarity_emoji} {badge['icon']} <b>{badge['name']}</b>\n"
-            text += f"   {badge.get('description', '')}\n"
-            text += f"   💰 <code>{badge.get('cost_candies', 0)}</code> 🍭\n"
-            text += f"   📝 <code>/shop {badge['name']}</code>\n"
-        
-        # Титулы
-        text += "\n━━━━━━━━━━━━━━━━━━━━\n"
-        text += "🎩 <b>ТИТУЛЫ</b>\n"
-        text += "━━━━━━━━━━━━━━━━━━━━\n"
-        for title in titles:
-            rarity_emoji = {'common': '🟢', 'uncommon': '🔵', 'rare': '🟣', 'legendary': '🟡'}.get(title.get('rarity', 'common'), '⚪')
-            text += f"\n{rarity_emoji} {title['icon']} <b>{title['name']}</b>\n"
-            text += f"   {title.get('description', '')}\n"
-            text += f"   💰 <code>{title.get('cost_candies', 0)}</code> 🍭\n"
-            text += f"   📝 <code>/shop {title['name']}</code>\n"
-        
-        # Кейсы
-        text += "\n━━━━━━━━━━━━━━━━━━━━\n"
-        text += "📦 <b>КЕЙСЫ</b>\n"
-        text += "━━━━━━━━━━━━━━━━━━━━\n"
-        for case in cases:
-            rarity_emoji = {'common': '🟢', 'rare': '🟣', 'legendary': '🟡'}.get(case.get('rarity', 'common'), '⚪')
-            text += f"\n{rarity_emoji} {case['icon']} <b>{case['name']}</b>\n"
-            text += f"   {case.get('description', '')}\n"
-            text += f"   💰 <code>{case.get('cost_candies', 0)}</code> 🍭\n"
-            text += f"   📝 <code>/shop {case['name']}</code>\n"
-        
-        # Покупка конфет за Звезды
-        text += "\n━━━━━━━━━━━━━━━━━━━━\n"
-        text += "⭐ <b>КОНФЕТЫ ЗА ЗВЕЗДЫ</b>\n"
-        text += "━━━━━━━━━━━━━━━━━━━━\n"
-        for pack in candies_packs:
-            rarity_emoji = {'common': '🟢', 'uncommon': '🔵', 'rare': '🟣'}.get(pack.get('rarity', 'common'), '⚪')
-            text += f"\n{rarity_emoji} {pack['icon']} <b>{pack['name']}</b>\n"
-            text += f"   {pack.get('description', '')}\n"
-            text += f"   💰 <code>{pack.get('cost_stars', 0)}</code> ⭐\n"
-            text += f"   📝 <code>/shop {pack['name']}</code>\n"
-        
-        text += "\n━━━━━━━━━━━━━━━━━━━━\n"
-        text += "💡 <i>Для покупки используйте:</i>\n"
-        text += "<code>/shop [название товара]</code>\n"
-        text += "━━━━━━━━━━━━━━━━━━━━"
-        
-        # Кнопки фильтрации и инвентаря
-        filter_kb = InlineKeyboardMarkup(row_width=3)
-        filter_kb.add(
-            InlineKeyboardButton("🎖️ Бейджи", callback_data='shop_filter badge'),
-            InlineKeyboardButton("🎩 Титулы", callback_data='shop_filter title'),
-            InlineKeyboardButton("📦 Кейсы", callback_data='shop_filter case')
-        )
-        filter_kb.add(
-            InlineKeyboardButton("🍭 Конфеты", callback_data='shop_filter candies'),
-            InlineKeyboardButton("📦 Инвентарь", callback_data='shop_inventory'),
-            InlineKeyboardButton("📊 Все", callback_data='shop_filter all')
-        )
-        
-        # Добавляем быстрые кнопки для покупки конфет за звезды в основную клавиатуру
-        if candies_packs:
-            for pack in candies_packs[:3]:  # Показываем первые 3 пакета
-                filter_kb.add(
-                    InlineKeyboardButton(
-                        f"⭐ {pack['name']} ({pack.get('cost_stars', 0)}⭐)",
-                        callback_data=f'buy_stars_{pack["id"]}'
-                    )
-                )
-        
-        bot.send_message(message.chat.id, text, parse_mode='HTML', reply_markup=filter_kb)
+        text, kb = render_shop_page(candies)
+        bot.send_message(message.chat.id, text, parse_mode='HTML', reply_markup=kb)
     except Exception as e:
         logging.error(f"Error in shop command (execution): {e}", exc_info=True)
         bot.send_message(message.chat.id, f"❌ Ошибка при выполнении команды магазина: {str(e)}")
@@ -1208,7 +1360,7 @@ def team_command(message, *args, **kwargs):
         from teams import (
             create_team, get_user_team, invite_player, get_team_stats,
             get_user_invitations, accept_invitation, reject_invitation,
-            leave_team, kick_member
+            leave_team, kick_member, get_team_leaderboard, get_team_rank
         )
     except ImportError:
         bot.send_message(message.chat.id, "❌ Система команд временно недоступна.")
@@ -1232,6 +1384,7 @@ def team_command(message, *args, **kwargs):
             "➕ <code>/team invite @username</code> - пригласить игрока\n"
             "✅ <code>/team accept &lt;ID&gt;</code> - принять приглашение\n"
             "❌ <code>/team reject &lt;ID&gt;</code> - отклонить приглашение\n"
+            "🏆 <code>/team top</code> - рейтинг команд\n"
         )
         
         # Создаем inline кнопки
@@ -1292,22 +1445,9 @@ def team_command(message, *args, **kwargs):
             bot.send_message(message.chat.id, "❌ Вы не состоите в команде. Создайте её: /team create <название>")
             return
         
-        # Пытаемся найти пользователя
+        # Пытаемся найти пользователя: ответ на сообщение или @username / имя
         username = args_list[2].replace('@', '')
-        invitee_id = None
-        
-        # Если это ответ на сообщение, берем user_id из reply
-        if message.reply_to_message:
-            invitee_id = message.reply_to_message.from_user.id
-        else:
-            # Ищем в базе по username или имени
-            all_stats = database.find('player_stats', {})
-            for stats in all_stats:
-                # Проверяем имя (может содержать username)
-                name = stats.get('name', '')
-                if username.lower() in name.lower() or name.lower().startswith('@' + username.lower()):
-                    invitee_id = stats['user_id']
-                    break
+        invitee_id = resolve_target(message, username)
         
         if not invitee_id:
             bot.send_message(message.chat.id, 
@@ -1383,6 +1523,32 @@ def team_command(message, *args, **kwargs):
         )
         bot.send_message(message.chat.id, text, parse_mode='HTML')
     
+    elif subcommand == 'top':
+        leaderboard = get_team_leaderboard(10)
+        if not leaderboard:
+            bot.send_message(message.chat.id, "📭 Пока нет ни одной команды")
+            return
+        
+        medals = {1: '🥇', 2: '🥈', 3: '🥉'}
+        text = "🏆 <b>Рейтинг команд</b>\n\n"
+        for entry in leaderboard:
+            place = medals.get(entry['position'], f"{entry['position']}.")
+            text += (
+                f"{place} <b>{html.escape(entry['name'])}</b> — ⭐ {int(entry['avg_elo'])}, "
+                f"📈 {entry['win_rate']:.1f}%, 👥 {entry['members_count']}\n"
+            )
+        
+        team = get_user_team(user_id)
+        rank = get_team_rank(team['team_id']) if team else None
+        if rank and rank['position'] > len(leaderboard):
+            text += (
+                f"\n...\n{rank['position']}. <b>{html.escape(rank['name'])}</b> — ⭐ {int(rank['avg_elo'])}, "
+                f"📈 {rank['win_rate']:.1f}%, 👥 {rank['members_count']}\n"
+            )
+        if rank:
+            text += f"\n📍 Ваша команда: {rank['position']} место из {rank['total']}"
+        bot.send_message(message.chat.id, text, parse_mode='HTML')
+    
     elif subcommand == 'invitations':
         invitations = get_user_invitations(user_id)
         if not invitations:
@@ -1465,19 +1631,9 @@ def report_command(message, *args, **kwargs):
     
     # Пытаемся найти пользователя
     target = args_list[1].replace('@', '')
-    reported_id = None
     
-    # Если это ответ на сообщение
-    if message.reply_to_message:
-        reported_id = message.reply_to_message.from_user.id
-    else:
-        # Ищем в базе
-        all_stats = database.find('player_stats', {})
-        for stats in all_stats:
-            name = stats.get('name', '')
-            if target.lower() in name.lower() or name.lower().startswith('@' + target.lower()):
-                reported_id = stats['user_id']
-                break
+    # Ответ на сообщение или username / ID / имя
+    reported_id = resolve_target(message, target)
     
     if not reported_id:
         bot.send_message(message.chat.id, 
@@ -1522,18 +1678,9 @@ def ban_command(message, *args, **kwargs):
         return
     
     target = args_list[1].replace('@', '')
-    reported_id = None
     
     # Ищем пользователя
-    if message.reply_to_message:
-        reported_id = message.reply_to_message.from_user.id
-    else:
-        all_stats = database.find('player_stats', {})
-        for stats in all_stats:
-            name = stats.get('name', '')
-            if target.lower() in name.lower():
-                reported_id = stats['user_id']
-                break
+    reported_id = resolve_target(message, target)
     
     if not reported_id:
         bot.send_message(message.chat.id, f"❌ Пользователь @{target} не найден")
@@ -1584,15 +1731,9 @@ def unban_command(message, *args, **kwargs):
         return
     
     target = args_list[1].replace('@', '')
-    reported_id = None
     
     # Ищем пользователя
-    all_stats = database.find('player_stats', {})
-    for stats in all_stats:
-        name = stats.get('name', '')
-        if target.lower() in name.lower():
-            reported_id = stats['user_id']
-            break
+    reported_id = resolve_target(message, target)
     
     if not reported_id:
         bot.send_message(message.chat.id, f"❌ Пользователь @{target} не найден")
@@ -1610,7 +1751,7 @@ def mod_command(message, *args, **kwargs):
     """Управление модераторами (только для админа)"""
     try:
         from moderation import add_moderator, remove_moderator, get_moderators, is_moderator, ADMIN_ID
-        from moderation import get_reports, get_bans, resolve_report
+        from moderation import get_reports, count_reports, get_bans, resolve_report
     except ImportError:
         bot.send_message(message.chat.id, "❌ Система модерации временно недоступна.")
         return
@@ -1628,7 +1769,7 @@ def mod_command(message, *args, **kwargs):
         text += "➕ <code>/mod add @username</code> - добавить модератора\n"
         text += "➖ <code>/mod remove @username</code> - удалить модератора\n"
         text += "📋 <code>/mod list</code> - список модераторов\n"
-        text += "📨 <code>/mod reports</code> - список жалоб\n"
+        text += "📨 <code>/mod reports [страница]</code> - список жалоб\n"
         text += "🔨 <code>/mod bans</code> - список банов\n"
         bot.send_message(message.chat.id, text, parse_mode='HTML')
         return
@@ -1641,17 +1782,7 @@ def mod_command(message, *args, **kwargs):
             return
         
         target = args_list[2].replace('@', '')
-        target_id = None
-        
-        if message.reply_to_message:
-            target_id = message.reply_to_message.from_user.id
-        else:
-            all_stats = database.find('player_stats', {})
-            for stats in all_stats:
-                name = stats.get('name', '')
-                if target.lower() in name.lower():
-                    target_id = stats['user_id']
-                    break
+        target_id = resolve_target(message, target)
         
         if not target_id:
             bot.send_message(message.chat.id, f"❌ Пользователь @{target} не найден")
@@ -1666,14 +1797,7 @@ def mod_command(message, *args, **kwargs):
             return
         
         target = args_list[2].replace('@', '')
-        target_id = None
-        
-        all_stats = database.find('player_stats', {})
-        for stats in all_stats:
-            name = stats.get('name', '')
-            if target.lower() in name.lower():
-                target_id = stats['user_id']
-                break
+        target_id = resolve_target(message, target)
         
         if not target_id:
             bot.send_message(message.chat.id, f"❌ Пользователь @{target} не найден")
@@ -1694,13 +1818,17 @@ def mod_command(message, *args, **kwargs):
         bot.send_message(message.chat.id, text, parse_mode='HTML')
     
     elif subcommand == 'reports':
-        reports = get_reports('pending', limit=10)
+        # /mod reports [страница]
+        page = int(args_list[2]) if len(args_list) > 2 and args_list[2].isdigit() and int(args_list[2]) > 0 else 1
+        reports = get_reports('pending', limit=10, offset=(page - 1) * 10)
         if not reports:
             bot.send_message(message.chat.id, "📨 Нет новых жалоб")
             return
         
-        text = "📨 <b>Последние жалобы:</b>\n\n"
-        for i, report in enumerate(reports[:10], 1):
+        total = count_reports('pending')
+        pages = (total + 9) // 10
+        text = f"📨 <b>Последние жалобы</b> (стр. {page}/{pages}, всего {total}):\n\n"
+        for i, report in enumerate(reports, (page - 1) * 10 + 1):
             text += (
                 f"{i}. {report.get('reported_name', 'Игрок')}\n"
                 f"   От: {report.get('reporter_name', 'Игрок')}\n"
@@ -2215,9 +2343,8 @@ def settings_callback_handler(call):
         
         if data == 'settings_reset':
             try:
-                from settings import DEFAULT_SETTINGS
-                for key, value in DEFAULT_SETTINGS.items():
-                    update_setting(chat_id, key, value)
+                from settings import DEFAULT_SETTINGS, update_settings
+                update_settings(chat_id, dict(DEFAULT_SETTINGS))
                 safe_answer_callback(call.id, "✅ Настройки сброшены")
                 # Обновляем сообщение
                 settings = get_settings(chat_id)
@@ -2572,67 +2699,23 @@ def candidate_callback_action(call, game):
 def achievement_filter_handler(call):
     """Обработчик фильтрации достижений"""
     try:
-        from achievements import get_player_achievements, get_achievements_by_rarity, ACHIEVEMENTS
+        import achievements
     except ImportError:
         safe_answer_callback(call.id, "Система достижений недоступна", show_alert=True)
         return
     
     user_id = call.from_user.id
     filter_type = call.data.split()[1] if len(call.data.split()) > 1 else 'all'
+    if filter_type != 'all' and filter_type not in achievements.ACHIEVEMENTS_BY_RARITY:
+        filter_type = 'all'
     
-    stats = database.find_one('player_stats', {'user_id': user_id})
-    if not stats:
+    # Страница кэшируется до следующего изменения статистики игрока
+    text = cached_render(user_id, ('achievements', filter_type), lambda: _render_achievements_page(user_id, filter_type))
+    if not text:
         safe_answer_callback(call.id, "У вас нет достижений", show_alert=True)
         return
     
-    player_achievements = get_player_achievements(user_id)
-    player_ach_ids = {a['id'] for a in player_achievements}
-    
-    # Фильтруем достижения
-    if filter_type == 'all':
-        achievements_to_show = list(ACHIEVEMENTS.values())
-    else:
-        achievements_to_show = get_achievements_by_rarity(filter_type)
-    
-    # Сортируем: сначала разблокированные, потом заблокированные
-    achievements_to_show.sort(key=lambda x: (x['id'] not in player_ach_ids, x['rarity']))
-    
-    # Формируем текст
-    rarity_names = {
-        'common': '🟢 Обычные',
-        'uncommon': '🔵 Необычные',
-        'rare': '🟣 Редкие',
-        'epic': '🟠 Эпические',
-        'legendary': '🟡 Легендарные',
-        'all': '📊 Все достижения'
-    }
-    
-    text = f"🏆 <b>{rarity_names.get(filter_type, 'Достижения')}</b>\n\n"
-    
-    for ach in achievements_to_show[:20]:  # Показываем до 20
-        is_unlocked = ach['id'] in player_ach_ids
-        icon = "✅" if is_unlocked else "🔒"
-        reward = f" (+{ach.get('reward_candies', 0)}🍭)" if not is_unlocked else ""
-        text += f"{icon} {ach['icon']} <b>{ach['name']}</b>{reward}\n"
-        text += f"   {ach['description']}\n\n"
-    
-    if len(achievements_to_show) > 20:
-        text += f"\n... и еще {len(achievements_to_show) - 20} достижений"
-    
-    # Кнопки для фильтрации
-    kb = InlineKeyboardMarkup(row_width=2)
-    kb.add(
-        InlineKeyboardButton("🟢 Обычные", callback_data='ach_filter common'),
-        InlineKeyboardButton("🔵 Необычные", callback_data='ach_filter uncommon')
-    )
-    kb.add(
-        InlineKeyboardButton("🟣 Редкие", callback_data='ach_filter rare'),
-        InlineKeyboardButton("🟠 Эпические", callback_data='ach_filter epic')
-    )
-    kb.add(
-        InlineKeyboardButton("🟡 Легендарные", callback_data='ach_filter legendary'),
-        InlineKeyboardButton("📊 Все", callback_data='ach_filter all')
-    )
+    kb = achievements_filter_keyboard()
     
     try:
         bot.edit_message_text(text, call.message.chat.id, call.message.message_id, parse_mode='HTML', reply_markup=kb)
@@ -2894,160 +2977,7 @@ def buy_stars_callback_handler(call):
 def shop_callback_handler(call):
     """Обработчик callback-запросов для магазина"""
     try:
-        from shop import purchase_item, get_shop_items, get_user_inventory, SHOP_ITEMS
-    except ImportError:
-        safe_answer_callback(call.id, "Магазин недоступен", show_alert=True)
-        return
-    
-    user_id = call.from_user.id
-    action = call.data
-    
-    if action.startswith('shop_buy_'):
-        # Устаревший способ покупки - теперь используется /shop [название]
-        safe_answer_callback(call.id, "💡 Используйте команду /shop [название товара] для покупки", show_alert=True)
-    
-    elif action.startswith('shop_filter'):
-        # Фильтрация по категории
-        filter_type = action.split()[-1] if ' ' in action else 'all'
-        
-        stats = database.find_one('player_stats', {'user_id': user_id})
-        candies = stats.get('candies', 0) if stats else 0
-        
-        if filter_type == 'all':
-            items = get_shop_items()
-        else:
-            items = get_shop_items(filter_type)
-        
-        category_names = {
-            'badge': '🎖️ БЕЙДЖИ',
-            'title': '🎩 ТИТУЛЫ',
-            'case': '📦 КЕЙСЫ',
-            'candies': '🍭 КОНФЕТЫ',
-            'all': '📊 ВСЕ ТОВАРЫ'
-        }
-        
-        text = "━━━━━━━━━━━━━━━━━━━━\n"
-        text += f"🎄 <b>{category_names.get(filter_type, 'МАГАЗИН')}</b> 🎄\n"
-        text += "━━━━━━━━━━━━━━━━━━━━\n\n"
-        text += f"💰 <b>Ваш баланс:</b> <code>{candies:,}</code> 🍭\n\n"
-        text += "━━━━━━━━━━━━━━━━━━━━\n"
-        
-        # Добавляем товары
-        for item in items[:15]:
-            cost = item.get('cost_candies') or item.get('cost_stars', 0)
-            currency = "🍭" if item.get('cost_candies') else "⭐"
-            rarity_emoji = {'common': '🟢', 'uncommon': '🔵', 'rare': '🟣', 'legendary': '🟡'}.get(item.get('rarity', 'common'), '⚪')
-            
-            text += f"\n{rarity_emoji} {item['icon']} <b>{item['name']}</b>\n"
-            text += f"   {item.get('description', '')}\n"
-            text += f"   💰 <code>{cost}</code> {currency}\n"
-            text += f"   📝 <code>/shop {item['name']}</code>\n"
-        
-        text += "\n━━━━━━━━━━━━━━━━━━━━\n"
-        text += "💡 <i>Для покупки используйте:</i>\n"
-        text += "<code>/shop [название товара]</code>\n"
-        text += "━━━━━━━━━━━━━━━━━━━━"
-        
-        filter_kb = InlineKeyboardMarkup(row_width=3)
-        filter_kb.add(
-            InlineKeyboardButton("🎖️ Бейджи", callback_data='shop_filter badge'),
-            InlineKeyboardButton("🎩 Титулы", callback_data='shop_filter title'),
-            InlineKeyboardButton("📦 Кейсы", callback_data='shop_filter case')
-        )
-        filter_kb.add(
-            InlineKeyboardButton("🍭 Конфеты", callback_data='shop_filter candies'),
-            InlineKeyboardButton("📦 Инвентарь", callback_data='shop_inventory'),
-            InlineKeyboardButton("📊 Все", callback_data='shop_filter all')
-        )
-        
-        try:
-            bot.edit_message_text(text, call.message.chat.id, call.message.message_id, parse_mode='HTML', reply_markup=filter_kb)
-        except:
-            pass
-        safe_answer_callback(call.id)
-    
-    elif action == 'shop_inventory':
-        # Показываем инвентарь
-        inventory = get_user_inventory(user_id)
-        
-        text = "━━━━━━━━━━━━━━━━━━━━\n"
-        text += "📦 <b>ВАШ ИНВЕНТАРЬ</b>\n"
-        text += "━━━━━━━━━━━━━━━━━━━━\n\n"
-        
-        # Бейджи
-        badges = inventory.get('badges', [])
-        if badges:
-            text += "🎖️ <b>Бейджи:</b>\n"
-            for badge_id in badges:
-                if badge_id in SHOP_ITEMS:
-                    badge = SHOP_ITEMS[badge_id]
-                    text += f"   {badge['icon']} {badge['name']}\n"
-            text += "\n"
-        else:
-            text += "🎖️ <b>Бейджи:</b> <i>Нет</i>\n\n"
-        
-        # Титулы
-        titles = inventory.get('titles', [])
-        if titles:
-            text += "🎩 <b>Титулы:</b>\n"
-            for title_id in titles:
-                if title_id in SHOP_ITEMS:
-                    title = SHOP_ITEMS[title_id]
-                    text += f"   {title['icon']} {title['name']}\n"
-            text += "\n"
-        else:
-            text += "🎩 <b>Титулы:</b> <i>Нет</i>\n\n"
-        
-        # События
-        events = inventory.get('events', [])
-        if events:
-            text += "🎁 <b>Купленные события:</b>\n"
-            for event in events[-10:]:  # Последние 10
-                text += f"   {event.get('event_name', 'Событие')}\n"
-        else:
-            text += "🎁 <b>Купленные события:</b> <i>Нет</i>\n"
-        
-        text += "\n━━━━━━━━━━━━━━━━━━━━"
-        
-        kb = InlineKeyboardMarkup()
-        kb.add(InlineKeyboardButton("◀️ Назад в магазин", callback_data='shop_filter all'))
-        
-        try:
-            bot.edit_message_text(text, call.message.chat.id, call.message.message_id, parse_mode='HTML', reply_markup=kb)
-        except:
-            bot.send_message(call.message.chat.id, text, parse_mode='HTML', reply_markup=kb)
-        safe_answer_callback(call.id)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith('buy_stars_'))
-def buy_stars_callback_handler(call):
-    """Обработчик быстрой покупки конфет за звезды"""
-    try:
-        from shop import SHOP_ITEMS
-    except ImportError:
-        safe_answer_callback(call.id, "Магазин недоступен", show_alert=True)
-        return
-    
-    user_id = call.from_user.id
-    item_id = call.data.replace('buy_stars_', '')
-    
-    if item_id not in SHOP_ITEMS:
-        safe_answer_callback(call.id, "❌ Товар не найден", show_alert=True)
-        return
-    
-    item = SHOP_ITEMS[item_id]
-    if item.get('type') != 'candies' or not item.get('cost_stars'):
-        safe_answer_callback(call.id, "❌ Этот товар нельзя купить за звезды", show_alert=True)
-        return
-    
-    # Отправляем invoice
-    send_stars_invoice(call.message.chat.id, user_id, item)
-    safe_answer_callback(call.id)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith('shop_'))
-def shop_callback_handler(call):
-    """Обработчик callback-запросов для магазина"""
-    try:
-        from shop import purchase_item, get_shop_items, get_user_inventory, SHOP_ITEMS
+        from shop import get_user_inventory, SHOP_ITEMS
     except ImportError:
         safe_answer_callback(call.id, "Магазин недоступен", show_alert=True)
         return
@@ -3060,58 +2990,13 @@ def shop_callback_handler(call):
         safe_answer_callback(call.id, "💡 Используйте команду /shop [название товара] для покупки", show_alert=True)
     
     elif action.startswith('shop_filter'):
-        # Фильтрация по категории
-        filter_type = action.split()[-1] if ' ' in action else 'all'
+        # Фильтрация по категории: shop_filter <категория> [страница]
+        parts = action.split()
+        filter_type = parts[1] if len(parts) > 1 else 'all'
+        page = _parse_page(parts, 2)
         
-        stats = database.find_one('player_stats', {'user_id': user_id})
-        candies = stats.get('candies', 0) if stats else 0
-        
-        if filter_type == 'all':
-            items = get_shop_items()
-        else:
-            items = get_shop_items(filter_type)
-        
-        category_names = {
-            'badge': '🎖️ БЕЙДЖИ',
-            'title': '🎩 ТИТУЛЫ',
-            'case': '📦 КЕЙСЫ',
-            'candies': '🍭 КОНФЕТЫ',
-            'all': '📊 ВСЕ ТОВАРЫ'
-        }
-        
-        text = "━━━━━━━━━━━━━━━━━━━━\n"
-        text += f"🎄 <b>{category_names.get(filter_type, 'МАГАЗИН')}</b> 🎄\n"
-        text += "━━━━━━━━━━━━━━━━━━━━\n\n"
-        text += f"💰 <b>Ваш баланс:</b> <code>{candies:,}</code> 🍭\n\n"
-        text += "━━━━━━━━━━━━━━━━━━━━\n"
-        
-        # Добавляем товары в текст
-        for item in items[:15]:  # Показываем до 15 товаров
-            cost = item.get('cost_candies') or item.get('cost_stars', 0)
-            currency = "🍭" if item.get('cost_candies') else "⭐"
-            rarity_emoji = {'common': '🟢', 'uncommon': '🔵', 'rare': '🟣', 'legendary': '🟡'}.get(item.get('rarity', 'common'), '⚪')
-            
-            text += f"\n{rarity_emoji} {item['icon']} <b>{item['name']}</b>\n"
-            text += f"   {item.get('description', '')}\n"
-            text += f"   💰 <code>{cost}</code> {currency}\n"
-            text += f"   📝 <code>/shop {item['name']}</code>\n"
-        
-        text += "\n━━━━━━━━━━━━━━━━━━━━\n"
-        text += "💡 <i>Для покупки используйте:</i>\n"
-        text += "<code>/shop [название товара]</code>\n"
-        text += "━━━━━━━━━━━━━━━━━━━━"
-        
-        filter_kb = InlineKeyboardMarkup(row_width=3)
-        filter_kb.add(
-            InlineKeyboardButton("🎖️ Бейджи", callback_data='shop_filter badge'),
-            InlineKeyboardButton("🎩 Титулы", callback_data='shop_filter title'),
-            InlineKeyboardButton("📦 Кейсы", callback_data='shop_filter case')
-        )
-        filter_kb.add(
-            InlineKeyboardButton("🍭 Конфеты", callback_data='shop_filter candies'),
-            InlineKeyboardButton("📦 Инвентарь", callback_data='shop_inventory'),
-            InlineKeyboardButton("📊 Все", callback_data='shop_filter all')
-        )
+        candies = get_balance(user_id)
+        text, filter_kb = render_shop_page(candies, filter_type, page)
         
         try:
             bot.edit_message_text(text, call.message.chat.id, call.message.message_id, parse_mode='HTML', reply_markup=filter_kb)
@@ -3174,74 +3059,21 @@ def shop_callback_handler(call):
 @bot.callback_query_handler(func=lambda call: call.data.startswith('events_filter'))
 def events_filter_handler(call):
     """Обработчик фильтрации событий по редкости"""
+    # events_filter <редкость> [страница]
+    parts = call.data.split()
+    filter_type = parts[1] if len(parts) > 1 else 'all'
+    page = _parse_page(parts, 2)
+    
+    candies = get_balance(call.from_user.id)
     try:
-        from game_events import get_available_events, get_current_season
+        text, kb = render_events_page(candies, filter_type, page)
     except ImportError:
         safe_answer_callback(call.id, "Система событий недоступна", show_alert=True)
         return
     
-    filter_type = call.data.split()[1] if len(call.data.split()) > 1 else 'all'
-    user_id = call.from_user.id
-    
-    stats = database.find_one('player_stats', {'user_id': user_id})
-    candies = stats.get('candies', 0) if stats else 0
-    
-    events = get_available_events()
-    current_season = get_current_season()
-    season_names = {'winter': '❄️ Зима', 'spring': '🌸 Весна', 'summer': '☀️ Лето', 'autumn': '🍂 Осень'}
-    
-    # Фильтруем по редкости
-    if filter_type == 'all':
-        filtered_events = events
-    else:
-        filtered_events = [e for e in events if e.get('rarity') == filter_type]
-    
-    rarity_icons = {'common': '🟢', 'rare': '🟣', 'legendary': '🟡'}
-    rarity_names = {'common': 'Обычные', 'rare': 'Редкие', 'legendary': 'Легендарные'}
-    
-    text = f'🍭 <b>Магазин событий</b>\n\n'
-    text += f'У тебя: {candies} 🍭\n'
-    text += f'Сезон: {season_names.get(current_season, current_season)}\n'
-    if filter_type != 'all':
-        text += f'Фильтр: {rarity_icons.get(filter_type, "")} {rarity_names.get(filter_type, filter_type)}\n'
-    text += '\n'
-    
-    kb = InlineKeyboardMarkup(row_width=1)
-    
-    for event in filtered_events[:15]:  # Показываем до 15 событий
-        can_afford = candies >= event['cost']
-        status = '✅' if can_afford else '❌'
-        rarity_icon = rarity_icons.get(event.get('rarity', 'common'), '')
-        seasonal_mark = f" ({event.get('seasonal', '')})" if event.get('seasonal') else ""
-        text += f'{status} {rarity_icon} {event["description"]}{seasonal_mark}\n'
-        text += f'   💰 {event["cost"]} 🍭\n\n'
-        
-        if can_afford:
-            kb.add(InlineKeyboardButton(
-                f'{rarity_icon} Купить {event["name"]} ({event["cost"]} 🍭)',
-                callback_data=f'buy_event_{event["name"]}'
-            ))
-    
-    if len(filtered_events) > 15:
-        text += f'\n... и еще {len(filtered_events) - 15} событий\n'
-    
-    # Кнопки фильтрации
-    filter_kb = InlineKeyboardMarkup(row_width=3)
-    filter_kb.add(
-        InlineKeyboardButton("🟢 Обычные", callback_data='events_filter common'),
-        InlineKeyboardButton("🟣 Редкие", callback_data='events_filter rare'),
-        InlineKeyboardButton("🟡 Легендарные", callback_data='events_filter legendary')
-    )
-    filter_kb.add(InlineKeyboardButton("📊 Все", callback_data='events_filter all'))
-    
-    # Объединяем клавиатуры
-    if kb.keyboard:
-        for row in filter_kb.keyboard:
-            kb.keyboard.append(row)
-    
     try:
         bot.edit_message_text(text, call.message.chat.id, call.message.message_id, 
-                            parse_mode='HTML', reply_markup=kb if kb.keyboard else filter_kb)
+                            parse_mode='HTML', reply_markup=kb)
     except:
         pass
     safe_answer_callback(call.id)
@@ -3249,18 +3081,12 @@ def events_filter_handler(call):
 @bot.callback_query_handler(func=lambda call: call.data.startswith('buy_event_'))
 def buy_event_handler(call):
     """Обработка покупки события"""
-    from game_events import get_event_by_name, get_available_events
+    from game_events import get_event_by_name, get_available_events, commit_patch
     
     user_id = call.from_user.id
     event_name = call.data.replace('buy_event_', '')
     
-    # Получаем статистику игрока
-    stats = database.find_one('player_stats', {'user_id': user_id})
-    if not stats:
-        stats = {'user_id': user_id, 'candies': 0}
-        database.insert_one('player_stats', stats)
-    
-    candies = stats.get('candies', 0)
+    candies = get_balance(user_id)
     
     # Находим событие
     events = get_available_events()
@@ -3301,23 +3127,24 @@ def buy_event_handler(call):
         safe_answer_callback(call.id, "Ошибка создания события", show_alert=True)
         return
     
-    # Применяем событие
-    effect_result = event.apply_effect(game)
+    # Списываем конфеты (атомарно, с проверкой баланса)
+    if not debit(user_id, event_info['cost'], f'event:{event_name}'):
+        safe_answer_callback(call.id, f"Недостаточно конфет! Нужно {event_info['cost']} 🍭", show_alert=True)
+        return
+    new_candies = get_balance(user_id)
     
-    # Списываем конфеты
-    new_candies = candies - event_info['cost']
-    database.update_one('player_stats', {'user_id': user_id}, {'$set': {'candies': new_candies}})
+    # Применяем событие (пока только в памяти)
+    effect_result = event.apply_effect(game)
     
-    # Сохраняем событие в игру
-    if 'purchased_events' not in game:
-        game['purchased_events'] = []
-    game['purchased_events'].append({
+    # Сохраняем событие в игру вместе с патчем эффекта одной записью. $push, а не $set
+    # списка: параллельная покупка другого игрока не потеряется
+    purchase = {
         'name': event_name,
         'player_id': user_id,
         'player_name': player.get('name', 'Игрок'),
         'timestamp': time()
-    })
-    database.update_one('games', {'_id': game['_id']}, {'$set': {'purchased_events': game['purchased_events']}})
+    }
+    commit_patch(game, event.patch, extra_push={'purchased_events': purchase})
     
     # Отправляем сообщение в группу
     try:
@@ -3928,6 +3755,119 @@ def commissar_kill_action(call, game):
 
 # --- MINI GAMES ---
 
+@bot.message_handler(func=lambda message: message.from_user.id == config.ADMIN_ID, commands=['balance'])
+def balance_command(message, *args, **kwargs):
+    """Отчёт о балансе ролей по завершённым играм (только для админа)"""
+    try:
+        from analytics import build_balance_report, format_balance_report
+        text = format_balance_report(build_balance_report())
+    except Exception as e:
+        logging.error(f"Error building balance report: {e}", exc_info=True)
+        text = '❌ Не удалось построить отчёт о балансе.'
+    bot.send_message(message.chat.id, text, parse_mode='HTML')
+
+@bot.message_handler(func=lambda message: message.from_user.id == config.ADMIN_ID, commands=['backfill_achievements'])
+def backfill_achievements_command(message, *args, **kwargs):
+    """Выдать достижения всем, кто уже выполнил условия (только для админа)"""
+    from threading import Thread
+    from time import time
+    try:
+        from backfill import BackfillRunningError, is_backfill_running, run_achievement_backfill
+    except ImportError:
+        bot.send_message(message.chat.id, '❌ Модуль backfill недоступен.')
+        return
+    if is_backfill_running():
+        bot.send_message(message.chat.id, '⏳ Выдача достижений уже идёт, дождись её окончания.')
+        return
+    
+    restart = 'restart' in (message.text or '').split()
+    status = bot.send_message(message.chat.id, '⏳ Выдача достижений запущена...')
+    last_edit = [0.0]
+    
+    def report(state):
+        # Не чаще раза в 5 секунд, чтобы не упираться в лимиты API
+        if time() - last_edit[0] < 5:
+            return
+        last_edit[0] = time()
+        try:
+            bot.edit_message_text(
+                f"⏳ Проверено {state['processed']}/{state['total']} игроков "
+                f"({state['rate']:.0f}/с), выдано достижений: {state['awarded']}",
+                message.chat.id, status.message_id
+            )
+        except:
+            pass
+    
+    def run():
+        try:
+            state = run_achievement_backfill(progress=report, restart=restart)
+            text = (f"✅ Готово: проверено {state['processed']} игроков, "
+                    f"награждено {state['players']}, выдано достижений: {state['awarded']}")
+        except BackfillRunningError:
+            text = '⏳ Выдача достижений уже идёт, дождись её окончания.'
+        except Exception as e:
+            logging.error(f"Achievement backfill failed: {e}", exc_info=True)
+            text = '❌ Выдача прервана с ошибкой. Повторный запуск продолжит с места остановки.'
+        try:
+            bot.edit_message_text(text, message.chat.id, status.message_id)
+        except:
+            bot.send_message(message.chat.id, text)
+    
+    Thread(target=run, name='Achievement Backfill', daemon=True).start()
+
+@bot.message_handler(func=lambda message: message.from_user.id == config.ADMIN_ID, commands=['reconcile_candies'])
+def reconcile_candies_command(message, *args, **kwargs):
+    """Сверка балансов конфет с журналом; с аргументом fix — исправление (только для админа)"""
+    from candies import reconcile_balances
+
+    fix = 'fix' in (message.text or '').split()
+    try:
+        result = reconcile_balances(fix=fix)
+    except Exception as e:
+        logging.error(f"Candy reconciliation failed: {e}", exc_info=True)
+        bot.send_message(message.chat.id, '❌ Не удалось сверить балансы.')
+        return
+
+    lines = [f"🍭 Проверено балансов: {result['checked']}, расхождений: {len(result['mismatches'])}"]
+    for row in result['mismatches'][:20]:
+        lines.append(f"{row['user_id']}: баланс {row['balance']}, журнал {row['ledger']}")
+    if len(result['mismatches']) > 20:
+        lines.append(f"... и еще {len(result['mismatches']) - 20}")
+    if fix:
+        lines.append(f"Исправлено: {result['fixed']}")
+    bot.send_message(message.chat.id, '\n'.join(lines))
+
+@bot.message_handler(func=lambda message: message.from_user.id == config.ADMIN_ID, commands=['revenue'])
+def revenue_command(message, *args, **kwargs):
+    """Выручка за период: /revenue [дней|all] (только для админа)"""
+    from payments import revenue_report, format_revenue_report
+    
+    args = (message.text or '').split()[1:]
+    days = 30
+    if args:
+        days = None if args[0] == 'all' else (int(args[0]) if args[0].isdigit() and int(args[0]) > 0 else 30)
+    bot.send_message(message.chat.id, format_revenue_report(revenue_report(days), days), parse_mode='HTML')
+
+@bot.message_handler(func=lambda message: message.from_user.id == config.ADMIN_ID, commands=['flood'])
+def flood_command(message, *args, **kwargs):
+    """Счётчики антифлуда (только для админа)"""
+    dropped = bot.flood_guard.stats()
+    text = (
+        "<b>🚧 Антифлуд: отброшено обновлений</b>\n\n"
+        f"Сообщения пользователей: {dropped['user_messages']}\n"
+        f"Нажатия кнопок: {dropped['user_callbacks']}\n"
+        f"Сообщения в чатах: {dropped['chat_messages']}\n\n"
+        f"Лимиты за {config.FLOOD_WINDOW} с: {config.FLOOD_USER_MESSAGES} сообщений и "
+        f"{config.FLOOD_USER_CALLBACKS} нажатий на пользователя, {config.FLOOD_CHAT_MESSAGES} сообщений на чат"
+    )
+    bot.send_message(message.chat.id, text, parse_mode='HTML')
+
+@bot.message_handler(func=lambda message: message.from_user.id == config.ADMIN_ID, commands=['hooks'])
+def hooks_command(message, *args, **kwargs):
+    """Время хуков событий по точкам стадий (только для админа)"""
+    from game_events import hook_cost_report
+    bot.send_message(message.chat.id, hook_cost_report(), parse_mode='HTML')
+
 @bot.message_handler(func=lambda message: message.from_user.id == config.ADMIN_ID, regexp=command_regexp('reset'))
 def reset(message, *args, **kwargs):
     database.delete_many('games', {})
@@ -4085,39 +4025,26 @@ def handle_successful_payment(message):
         item = SHOP_ITEMS[item_id]
         candies_amount = item.get('amount', 0)
         
-        # Сохраняем информацию о платеже
-        payment_data = {
-            'user_id': user_id,
-            'item_id': item_id,
-            'amount': total_amount,
-            'currency': currency,
-            'candies_received': candies_amount,
-            'payment_date': message.date,
-            'invoice_payload': invoice_payload
-        }
-        
-        # Сохраняем в базу данных (можно создать коллекцию payments)
-        try:
-            database.insert_one('payments', payment_data)
-        except:
-            pass  # Если коллекция не существует, пропускаем
-        
-        # Начисляем конфеты
+        # Заводим статистику, если игрок еще не играл
         stats = database.find_one('player_stats', {'user_id': user_id})
         if not stats:
             # Создаем новую запись статистики
             database.insert_one('player_stats', {
                 'user_id': user_id,
-                'candies': candies_amount,
+                'candies': 0,
                 'games_played': 0,
                 'games_won': 0
             })
-        else:
-            # Добавляем конфеты к существующим
-            current_candies = stats.get('candies', 0)
-            database.update_one('player_stats', {'user_id': user_id}, {
-                '$set': {'candies': current_candies + candies_amount}
-            })
+        
+        # Записываем платеж и начисляем конфеты ровно один раз на charge id
+        from payments import record_payment
+        credited = record_payment(
+            user_id, payment.telegram_payment_charge_id, item_id, total_amount, currency,
+            candies_amount, message.date, invoice_payload, payment.provider_payment_charge_id
+        )
+        if not credited:
+            logging.info(f"Duplicate payment update ignored: {payment.telegram_payment_charge_id}")
+            return
         
         # Отправляем подтверждение
         bot.send_message(
@@ -39,6 +39,28 @@ class GameMetrics:
         except Exception as e:
             logger.error(f"Error in metrics: {str(e)}")
 
+    def observe(self, metric, value, tags=None):
+        """Учесть измерение (например, длительность): число вызовов, сумма и максимум по тегам"""
+        try:
+            tag_key = tuple(sorted(tags.items())) if tags else 'default'
+            series = self._instance.metrics.setdefault(metric, {})
+            stats = series.get(tag_key)
+            if stats is None:
+                stats = series[tag_key] = {'count': 0, 'total': 0.0, 'max': 0.0}
+            stats['count'] += 1
+            stats['total'] += value
+            if value > stats['max']:
+                stats['max'] = value
+        except Exception as e:
+            logger.error(f"Error in metrics: {str(e)}")
+
+    def series(self, metric):
+        """Измерения observe по тегам: [(теги, {'count', 'total', 'max'})]"""
+        return [
+            (dict(tag_key) if tag_key != 'default' else {}, dict(stats))
+            for tag_key, stats in self._instance.metrics.get(metric, {}).items()
+        ]
+
     def _log_game_start(self, tags):
         game_info = {
             'mode': tags.get('mode', 'unknown'),
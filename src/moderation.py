@@ -3,8 +3,11 @@
 Система модерации и жалоб для игры в мафию
 """
 import database
+import heapq
+from bisect import bisect_left, insort
+import threading
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Set, Tuple
 # Получаем ID администратора из конфига
 try:
     import config
@@ -13,6 +16,149 @@ except:
     # Если config не найден, используем значение по умолчанию
     ADMIN_ID = None
 
+# Реестр банов в памяти: все изменения банов идут через этот модуль под _bans_lock.
+# _banned — множество забаненных, _ban_expiry — куча (время окончания, user_id)
+# временных банов; истёкшие снимает sweep_expired_bans() из фонового потока.
+_bans_lock = threading.Lock()
+_bans_loaded = False
+_bans: Dict[int, Dict] = {}
+_banned: Set[int] = set()
+_ban_ends: Dict[int, Optional[float]] = {}
+_ban_expiry: List[Tuple[float, int]] = []
+
+def _ban_expires_at(ban: Dict) -> Optional[float]:
+    """Время окончания бана (timestamp) или None для постоянного"""
+    if ban.get('is_permanent', False) or not ban.get('ban_until'):
+        return None
+    try:
+        return datetime.fromisoformat(ban['ban_until']).timestamp()
+    except (TypeError, ValueError):
+        return None  # При ошибке считаем бан постоянным
+
+def _register_ban(ban: Dict):
+    user_id = ban['user_id']
+    _bans[user_id] = ban
+    _banned.add(user_id)
+    expires_at = _ban_ends[user_id] = _ban_expires_at(ban)
+    if expires_at is not None:
+        heapq.heappush(_ban_expiry, (expires_at, user_id))
+
+def _unregister_ban(user_id: int):
+    # Запись в куче остаётся и отбрасывается при снятии с вершины
+    _bans.pop(user_id, None)
+    _banned.discard(user_id)
+    _ban_ends.pop(user_id, None)
+
+def load_bans() -> int:
+    """
+    Загрузить баны в память (при старте; повторный вызов ничего не делает)
+    
+    Returns:
+        Количество загруженных банов
+    """
+    global _bans_loaded
+    if _bans_loaded:
+        return len(_bans)
+    docs = database.find('bans', {})
+    with _bans_lock:
+        if not _bans_loaded:
+            # Если на игрока несколько записей, действует последняя
+            for ban in sorted(docs, key=lambda b: b.get('banned_at', '')):
+                _register_ban(ban)
+            _bans_loaded = True
+        return len(_bans)
+
+def sweep_expired_bans() -> int:
+    """
+    Снять истёкшие временные баны (удаляет их из базы одной операцией)
+    
+    Returns:
+        Количество снятых банов
+    """
+    load_bans()
+    now = datetime.now().timestamp()
+    expired = []
+    with _bans_lock:
+        while _ban_expiry and _ban_expiry[0][0] <= now:
+            expires_at, user_id = heapq.heappop(_ban_expiry)
+            # Пропускаем устаревшие записи кучи (бан снят или заменён)
+            if user_id in _banned and _ban_ends.get(user_id) == expires_at:
+                _unregister_ban(user_id)
+                expired.append(user_id)
+        # Удаляем под блокировкой: иначе новый бан, выданный в промежутке, удалится из базы
+        if expired:
+            database.delete_many('bans', {'user_id': {'$in': expired}})
+    return len(expired)
+
+# Жалобы для автомодерации: разные жалобщики за последние сутки
+REPORT_WINDOW = timedelta(hours=24)
+AUTO_BAN_REPORTS = 3
+
+# Индекс жалоб в памяти (все изменения жалоб идут через этот модуль под _reports_lock):
+# _reports — {_id: жалоба}, _reports_by_status — {статус: [(created_at, _id)]} по времени,
+# _reports_by_target — {reported_id: [_id]}, _pending_reporters — {reported_id: {reporter_id: created_at}}
+# (последняя необработанная жалоба каждого жалобщика, чтобы один игрок не набрал порог сам)
+_reports_lock = threading.RLock()
+_reports_loaded = False
+_reports: Dict[str, Dict] = {}
+_reports_by_status: Dict[str, List[Tuple[str, str]]] = {}
+_reports_by_target: Dict[int, List[str]] = {}
+_pending_reporters: Dict[int, Dict[int, str]] = {}
+_report_by_created: Dict[str, str] = {}  # created_at служит модераторам ID жалобы
+
+def _index_report(report: Dict):
+    report_id = report['_id']
+    _reports[report_id] = report
+    _report_by_created.setdefault(report.get('created_at', ''), report_id)
+    insort(_reports_by_status.setdefault(report.get('status', 'pending'), []), (report.get('created_at', ''), report_id))
+    _reports_by_target.setdefault(report.get('reported_id'), []).append(report_id)
+    if report.get('status', 'pending') == 'pending':
+        reporters = _pending_reporters.setdefault(report.get('reported_id'), {})
+        reporters[report.get('reporter_id')] = max(reporters.get(report.get('reporter_id'), ''), report.get('created_at', ''))
+
+def _set_report_status(report_id: str, status: str):
+    """Перенести жалобу в другой статус в индексах"""
+    report = _reports[report_id]
+    old_status = report.get('status', 'pending')
+    entries = _reports_by_status.get(old_status, [])
+    key = (report.get('created_at', ''), report_id)
+    i = bisect_left(entries, key)
+    if i < len(entries) and entries[i] == key:
+        del entries[i]
+    report['status'] = status
+    insort(_reports_by_status.setdefault(status, []), key)
+    if old_status == 'pending':
+        # Пересчитываем жалобщиков из оставшихся необработанных жалоб на игрока
+        target = report.get('reported_id')
+        reporters = {}
+        for other_id in _reports_by_target.get(target, []):
+            other = _reports[other_id]
+            if other.get('status', 'pending') == 'pending':
+                reporters[other.get('reporter_id')] = max(reporters.get(other.get('reporter_id'), ''), other.get('created_at', ''))
+        if reporters:
+            _pending_reporters[target] = reporters
+        else:
+            _pending_reporters.pop(target, None)
+
+def _load_reports():
+    """Построить индекс жалоб при первом обращении (одно чтение коллекции)"""
+    global _reports_loaded
+    if _reports_loaded:
+        return
+    with _reports_lock:
+        if _reports_loaded:
+            return
+        for report in database.find('reports', {}):
+            _index_report(report)
+        _reports_loaded = True
+
+def count_recent_reporters(reported_id: int) -> int:
+    """Сколько разных игроков пожаловались на игрока за REPORT_WINDOW (по необработанным жалобам)"""
+    _load_reports()
+    since = (datetime.now() - REPORT_WINDOW).isoformat()
+    with _reports_lock:
+        return sum(1 for created_at in _pending_reporters.get(reported_id, {}).values() if created_at >= since)
+
 def is_moderator(user_id: int) -> bool:
     """Проверить, является ли пользователь модератором"""
     if user_id == ADMIN_ID:
@@ -99,14 +245,17 @@ def report_player(reporter_id: int, reported_id: int, reason: str) -> Tuple[bool
         'status': 'pending'  # pending, reviewed, resolved
     }
     
-    database.insert_one('reports', report)
-    
-    # Проверяем количество жалоб на этого игрока
-    all_reports = database.find('reports', {'reported_id': reported_id, 'status': 'pending'})
-    report_count = len(all_reports)
-    
-    # Автомодерация: если 3+ жалобы, автоматически баним на 24 часа
-    if report_count >= 3:
+    _load_reports()
+    with _reports_lock:
+        # Одна необработанная жалоба от игрока на одного нарушителя
+        if reporter_id in _pending_reporters.get(reported_id, {}):
+            return False, "Вы уже пожаловались на этого игрока, жалоба ожидает рассмотрения"
+        report['_id'] = database.insert_one('reports', report)
+        _index_report(report)
+    
+    # Автомодерация: жалобы от AUTO_BAN_REPORTS разных игроков за сутки — бан на 24 часа
+    report_count = count_recent_reporters(reported_id)
+    if report_count >= AUTO_BAN_REPORTS:
         ban_until = datetime.now() + timedelta(hours=24)
         ban_player(reported_id, ADMIN_ID or 0, f"Автомодерация: {report_count} жалоб", ban_until)
         return True, f"Жалоба отправлена. Игрок автоматически забанен на 24 часа ({report_count} жалоб)"
@@ -128,11 +277,6 @@ def ban_player(user_id: int, moderator_id: int, reason: str, ban_until: Optional
     if not is_moderator(moderator_id):
         return False, "Только модераторы могут банить игроков"
     
-    # Проверяем, не забанен ли уже
-    existing_ban = get_ban(user_id)
-    if existing_ban and is_banned(user_id):
-        return False, "Игрок уже забанен"
-    
     # Получаем информацию о пользователе
     user_stats = database.find_one('player_stats', {'user_id': user_id})
     user_name = user_stats.get('name', 'Игрок') if user_stats else 'Игрок'
@@ -152,15 +296,26 @@ def ban_player(user_id: int, moderator_id: int, reason: str, ban_until: Optional
         'is_permanent': ban_until is None
     }
     
-    database.insert_one('bans', ban)
-    
-    # Помечаем все жалобы на этого игрока как resolved
-    # Обновляем все документы в цикле, так как update_one обновляет только первый
-    all_reports = database.find('reports', {'reported_id': user_id, 'status': 'pending'})
-    for report in all_reports:
-        report_id = report.get('_id') or report.get('id')
-        if report_id:
-            database.update_one('reports', {'_id': report_id}, {'$set': {'status': 'resolved'}})
+    load_bans()
+    with _bans_lock:
+        # Проверка под блокировкой: два модератора одновременно не забанят дважды
+        if _ban_active(user_id):
+            return False, "Игрок уже забанен"
+        # Истёкший, но ещё не снятый бан заменяется новым
+        if user_id in _bans:
+            database.delete_many('bans', {'user_id': user_id})
+        database.insert_one('bans', ban)
+        _register_ban(ban)
+    
+    # Помечаем все жалобы на этого игрока как resolved одной записью
+    _load_reports()
+    with _reports_lock:
+        pending = [report_id for report_id in _reports_by_target.get(user_id, [])
+                   if _reports[report_id].get('status', 'pending') == 'pending']
+        if pending:
+            database.bulk_update('reports', {report_id: {'$set': {'status': 'resolved'}} for report_id in pending})
+            for report_id in pending:
+                _set_report_status(report_id, 'resolved')
     
     ban_type = "постоянный" if ban_until is None else f"до {ban_until.strftime('%d.%m.%Y %H:%M')}"
     return True, f"Игрок {user_name} забанен ({ban_type})"
@@ -179,57 +334,58 @@ def unban_player(user_id: int, moderator_id: int) -> Tuple[bool, str]:
     if not ban:
         return False, "Игрок не забанен"
     
-    database.delete_one('bans', {'user_id': user_id})
+    with _bans_lock:
+        database.delete_many('bans', {'user_id': user_id})
+        _unregister_ban(user_id)
     
     user_name = ban.get('user_name', 'Игрок')
     return True, f"Игрок {user_name} разбанен"
 
 def get_ban(user_id: int) -> Optional[Dict]:
     """Получить информацию о бане игрока"""
-    return database.find_one('bans', {'user_id': user_id})
+    load_bans()
+    return _bans.get(user_id)
 
 def is_banned(user_id: int) -> bool:
-    """Проверить, забанен ли игрок"""
-    ban = get_ban(user_id)
-    if not ban:
+    """Проверить, забанен ли игрок (без обращения к базе)"""
+    load_bans()
+    return _ban_active(user_id)
+
+def _ban_active(user_id: int) -> bool:
+    """Действует ли бан игрока (реестр уже загружен)"""
+    if user_id not in _banned:
         return False
-    
-    # Если бан постоянный
-    if ban.get('is_permanent', False):
-        return True
-    
-    # Если бан временный, проверяем срок
-    ban_until_str = ban.get('ban_until')
-    if not ban_until_str:
-        return True  # Если нет даты окончания, считаем постоянным
-    
-    try:
-        ban_until = datetime.fromisoformat(ban_until_str)
-        if datetime.now() < ban_until:
-            return True  # Бан еще действует
-        else:
-            # Бан истек, удаляем его
-            database.delete_one('bans', {'user_id': user_id})
-            return False
-    except:
-        return True  # При ошибке считаем забаненным
+    # Бан мог истечь до очередного прохода sweep_expired_bans
+    expires_at = _ban_ends.get(user_id)
+    return expires_at is None or datetime.now().timestamp() < expires_at
 
-def get_reports(status: str = 'pending', limit: int = 20) -> List[Dict]:
+def get_reports(status: str = 'pending', limit: int = 20, offset: int = 0) -> List[Dict]:
     """
-    Получить список жалоб
+    Получить список жалоб (новые первые)
     
     Args:
         status: pending, reviewed, resolved
         limit: Максимальное количество жалоб
+        offset: Сколько самых новых жалоб пропустить (для постраничного вывода)
     """
-    all_reports = database.find('reports', {'status': status})
-    # Сортируем по дате (новые первые)
-    sorted_reports = sorted(all_reports, key=lambda x: x.get('created_at', ''), reverse=True)
-    return sorted_reports[:limit]
+    _load_reports()
+    with _reports_lock:
+        entries = _reports_by_status.get(status, [])
+        end = max(len(entries) - offset, 0)
+        page = entries[max(end - limit, 0):end]
+        return [dict(_reports[report_id]) for _, report_id in reversed(page)]
+
+def count_reports(status: str = 'pending') -> int:
+    """Количество жалоб со статусом"""
+    _load_reports()
+    with _reports_lock:
+        return len(_reports_by_status.get(status, []))
 
 def get_user_reports(user_id: int) -> List[Dict]:
     """Получить все жалобы на конкретного игрока"""
-    return database.find('reports', {'reported_id': user_id})
+    _load_reports()
+    with _reports_lock:
+        return [dict(_reports[report_id]) for report_id in _reports_by_target.get(user_id, [])]
 
 def resolve_report(report_id: str, moderator_id: int, action: str = 'resolved') -> Tuple[bool, str]:
     """
@@ -247,13 +403,17 @@ def resolve_report(report_id: str, moderator_id: int, action: str = 'resolved')
         return False, "Только модераторы могут обрабатывать жалобы"
     
     # Ищем жалобу по created_at (используем как ID)
-    report = database.find_one('reports', {'created_at': report_id})
-    if not report:
-        return False, "Жалоба не найдена"
-    
-    database.update_one('reports', {'created_at': report_id}, 
-                       {'$set': {'status': action, 'resolved_by': moderator_id, 
-                                'resolved_at': datetime.now().isoformat()}})
+    _load_reports()
+    with _reports_lock:
+        doc_id = _report_by_created.get(report_id)
+        report = _reports.get(doc_id) if doc_id else None
+        if not report:
+            return False, "Жалоба не найдена"
+        
+        resolved = {'status': action, 'resolved_by': moderator_id, 'resolved_at': datetime.now().isoformat()}
+        database.update_one('reports', {'_id': report['_id']}, {'$set': resolved})
+        _set_report_status(report['_id'], action)
+        report.update(resolved)
     
     return True, "Жалоба обработана"
 
@@ -262,16 +422,9 @@ def get_moderators() -> List[Dict]:
     return database.find('moderators', {})
 
 def get_bans(limit: int = 50) -> List[Dict]:
-    """Получить список всех банов"""
-    all_bans = database.find('bans', {})
-    # Фильтруем истекшие баны
-    active_bans = []
-    for ban in all_bans:
-        if is_banned(ban['user_id']):
-            active_bans.append(ban)
-        else:
-            # Удаляем истекший бан
-            database.delete_one('bans', {'user_id': ban['user_id']})
-    
+    """Получить список действующих банов"""
+    load_bans()
+    with _bans_lock:
+        bans = list(_bans.values())
+    active_bans = [ban for ban in bans if is_banned(ban['user_id'])]
     return active_bans[:limit]
-
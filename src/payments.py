@@ -0,0 +1,198 @@
+# payments.py
+"""
+Приём платежей Telegram Stars и отчёт о выручке.
+
+Платёж идентифицируется telegram_payment_charge_id: повторная доставка того же
+обновления не создаёт второй записи и не начисляет конфеты повторно. Индексы
+по id платежа, пользователю и дате, а также агрегаты выручки по дням живут в
+памяти и обновляются при каждой записи в коллекцию payments, поэтому отчёты и
+история платежей не перечитывают коллекцию.
+"""
+import threading
+from bisect import bisect_left, insort
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import database
+from candies import credit
+
+# Индексы защищает отдельная блокировка, которая никогда не держится во время
+# обращения к базе (обработчик записи вызывается под блокировкой коллекции)
+_index_lock = threading.Lock()
+_loaded = False
+_pending: List[Dict] = []
+
+# {telegram_payment_charge_id: _id}
+_by_charge_id: Dict[str, str] = {}
+
+# {user_id: [_id, ...]} в порядке поступления
+_by_user: Dict[int, List[str]] = {}
+
+# [(payment_date, _id)], отсортирован по дате
+_by_date: List[Tuple[int, str]] = []
+
+# {_id: платёж}
+_payments: Dict[str, Dict] = {}
+
+# {'YYYY-MM-DD': {currency: {'amount': int, 'count': int, 'candies': int}}}
+_revenue_by_day: Dict[str, Dict[str, Dict[str, int]]] = {}
+
+def _payment_day(payment: Dict) -> str:
+    return datetime.fromtimestamp(payment.get('payment_date', 0)).date().isoformat()
+
+def _index_payment(payment: Dict):
+    """Добавить платёж в индексы и агрегаты (платежи только добавляются)"""
+    doc_id = payment['_id']
+    if doc_id in _payments:
+        return
+    _payments[doc_id] = payment
+    if payment.get('telegram_payment_charge_id'):
+        _by_charge_id[payment['telegram_payment_charge_id']] = doc_id
+    _by_user.setdefault(payment.get('user_id'), []).append(doc_id)
+    insort(_by_date, (payment.get('payment_date', 0), doc_id))
+
+    day = _revenue_by_day.setdefault(_payment_day(payment), {})
+    totals = day.setdefault(payment.get('currency', 'XTR'), {'amount': 0, 'count': 0, 'candies': 0})
+    totals['amount'] += payment.get('amount', 0)
+    totals['count'] += 1
+    totals['candies'] += payment.get('candies_received', 0)
+
+def _on_payment_write(doc: Dict):
+    with _index_lock:
+        if _loaded:
+            _index_payment(doc)
+        else:
+            _pending.append(doc)
+
+def _ensure_indexes():
+    """Построить индексы при первом обращении (одно чтение коллекции)"""
+    global _loaded
+    if _loaded:
+        return
+    docs = database.find('payments', {})
+    with _index_lock:
+        if _loaded:
+            return
+        for doc in docs + _pending:
+            _index_payment(doc)
+        _pending.clear()
+        _loaded = True
+
+def get_payment_by_charge_id(charge_id: str) -> Optional[Dict]:
+    """Платёж по telegram_payment_charge_id"""
+    _ensure_indexes()
+    with _index_lock:
+        doc_id = _by_charge_id.get(charge_id)
+        return dict(_payments[doc_id]) if doc_id else None
+
+def get_user_payments(user_id: int) -> List[Dict]:
+    """Платежи пользователя в порядке поступления"""
+    _ensure_indexes()
+    with _index_lock:
+        return [dict(_payments[doc_id]) for doc_id in _by_user.get(user_id, [])]
+
+def get_payments_between(since: int, until: Optional[int] = None) -> List[Dict]:
+    """
+    Платежи за период по индексу дат
+
+    Args:
+        since: Начало периода (unix, включительно)
+        until: Конец периода (unix, не включительно; None — до текущего момента)
+
+    Returns:
+        Платежи в порядке payment_date
+    """
+    _ensure_indexes()
+    with _index_lock:
+        start = bisect_left(_by_date, (since,))
+        end = bisect_left(_by_date, (until,)) if until is not None else len(_by_date)
+        return [dict(_payments[doc_id]) for _, doc_id in _by_date[start:end]]
+
+def record_payment(user_id: int, charge_id: str, item_id: str, amount: int, currency: str,
+                   candies_amount: int, payment_date: int, invoice_payload: str,
+                   provider_charge_id: Optional[str] = None) -> bool:
+    """
+    Записать платёж и начислить конфеты ровно один раз
+
+    Args:
+        user_id: ID пользователя
+        charge_id: telegram_payment_charge_id (уникальный ключ платежа)
+        item_id: ID товара
+        amount: Сумма платежа
+        currency: Валюта
+        candies_amount: Сколько конфет начислить
+        payment_date: Время платежа (unix)
+        invoice_payload: Payload счёта
+        provider_charge_id: provider_payment_charge_id
+
+    Returns:
+        True если платёж новый и конфеты начислены, False для повторной доставки
+    """
+    _ensure_indexes()
+    with _index_lock:
+        is_new = charge_id not in _by_charge_id
+        # Резервируем ключ до вставки, чтобы параллельная доставка его увидела
+        if is_new:
+            _by_charge_id[charge_id] = None
+    if is_new:
+        try:
+            database.insert_one('payments', {
+                'user_id': user_id,
+                'item_id': item_id,
+                'amount': amount,
+                'currency': currency,
+                'candies_received': candies_amount,
+                'payment_date': payment_date,
+                'invoice_payload': invoice_payload,
+                'telegram_payment_charge_id': charge_id,
+                'provider_payment_charge_id': provider_charge_id
+            })
+        except Exception:
+            # Снимаем резерв: иначе повторная доставка начислит конфеты без записи платежа
+            with _index_lock:
+                if _by_charge_id.get(charge_id) is None:
+                    _by_charge_id.pop(charge_id, None)
+            raise
+    # Начисление идемпотентно по ключу платежа: если процесс упал после записи
+    # платежа, повторная доставка досчитает конфеты, но не дважды
+    return credit(user_id, candies_amount, f'payment:{item_id}', key=f'payment:{charge_id}')
+
+def revenue_report(days: Optional[int] = 30) -> Dict:
+    """
+    Выручка из агрегатов по дням
+
+    Args:
+        days: За сколько последних дней (None — за всё время)
+
+    Returns:
+        {'total': {currency: {amount, count, candies}}, 'by_day': [(день, {currency: {...}})]}
+    """
+    _ensure_indexes()
+    since = (date.today() - timedelta(days=days - 1)).isoformat() if days else ''
+    with _index_lock:
+        by_day = [(day, {cur: dict(t) for cur, t in totals.items()})
+                  for day, totals in sorted(_revenue_by_day.items()) if day >= since]
+    total: Dict[str, Dict[str, int]] = {}
+    for _, totals in by_day:
+        for currency, t in totals.items():
+            acc = total.setdefault(currency, {'amount': 0, 'count': 0, 'candies': 0})
+            for field in acc:
+                acc[field] += t[field]
+    return {'total': total, 'by_day': by_day}
+
+def format_revenue_report(report: Dict, days: Optional[int] = 30) -> str:
+    """Текст отчёта о выручке для админа"""
+    period = f'за {days} дн.' if days else 'за всё время'
+    lines = [f'<b>💰 Выручка {period}</b>', '']
+    if not report['total']:
+        lines.append('Платежей нет.')
+        return '\n'.join(lines)
+    for currency, t in report['total'].items():
+        lines.append(f"{t['amount']} {currency} — {t['count']} платежей, выдано {t['candies']} 🍭")
+    lines.append('')
+    for day, totals in report['by_day'][-7:]:
+        parts = [f"{t['amount']} {currency} ({t['count']})" for currency, t in totals.items()]
+        lines.append(f"{day}: {', '.join(parts)}")
+    return '\n'.join(lines)
+
+database.on_write('payments', _on_payment_write)
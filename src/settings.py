@@ -2,6 +2,9 @@
 Модуль настроек игры с интерактивными кнопками
 """
 import database
+import threading
+from collections import OrderedDict
+from time import monotonic
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 # Настройки по умолчанию для каждой группы
@@ -16,37 +19,71 @@ DEFAULT_SETTINGS = {
     'events_enabled': True,  # Включены ли события (метель, костёр и т.д.)
 }
 
-# Кэш настроек для быстрого доступа
-_settings_cache = {}
+# Кэш настроек: {chat_id: (документ, версия, время проверки)} в порядке последнего
+# обращения (LRU). В этом процессе запись сбрасывает запись кэша сразу; изменения
+# из других процессов видны после SETTINGS_CACHE_TTL, когда запись сверяется с
+# полем version документа в базе.
+SETTINGS_CACHE_SIZE = 1024
+SETTINGS_CACHE_TTL = 30  # секунд
+
+_settings_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+# Счётчик записей: чтение из базы, начатое до записи, не попадает в кэш после неё
+_writes = 0
+
+def _on_settings_write(doc):
+    global _writes
+    with _cache_lock:
+        _writes += 1
+        _settings_cache.pop(doc.get('chat_id'), None)
+
+def _cache_put(chat_id, settings):
+    _settings_cache[chat_id] = (settings, settings.get('version', 0), monotonic())
+    _settings_cache.move_to_end(chat_id)
+    while len(_settings_cache) > SETTINGS_CACHE_SIZE:
+        _settings_cache.popitem(last=False)
 
 def get_settings(chat_id):
-    """Получить настройки для чата (с кэшированием)"""
-    # Проверяем кэш
-    if chat_id in _settings_cache:
-        return _settings_cache[chat_id]
+    """Получить настройки для чата (с кэшированием; возвращается копия)"""
+    with _cache_lock:
+        cached = _settings_cache.get(chat_id)
+        if cached and monotonic() - cached[2] < SETTINGS_CACHE_TTL:
+            _settings_cache.move_to_end(chat_id)
+            return dict(cached[0])
+        writes = _writes
     
     settings = database.find_one('settings', {'chat_id': chat_id})
     if not settings:
-        settings = {'chat_id': chat_id, **DEFAULT_SETTINGS}
-        database.insert_one('settings', settings)
+        settings = {'chat_id': chat_id, **DEFAULT_SETTINGS, 'version': 0}
+        database.insert_one('settings', dict(settings))
+        # Своя вставка тоже проходит через обработчик записи
+        writes += 1
     
-    # Сохраняем в кэш
-    _settings_cache[chat_id] = settings
-    return settings
+    with _cache_lock:
+        if writes == _writes:
+            if cached and cached[1] == settings.get('version', 0):
+                # Версия в базе не менялась: продлеваем запись без замены
+                settings = cached[0]
+            _cache_put(chat_id, settings)
+    return dict(settings)
 
 def clear_settings_cache(chat_id=None):
     """Очистить кэш настроек"""
-    global _settings_cache
-    if chat_id:
-        _settings_cache.pop(chat_id, None)
-    else:
-        _settings_cache.clear()
+    with _cache_lock:
+        if chat_id:
+            _settings_cache.pop(chat_id, None)
+        else:
+            _settings_cache.clear()
+
+def update_settings(chat_id, values):
+    """Обновить несколько настроек одной записью"""
+    database.update_one('settings', {'chat_id': chat_id}, {'$set': values, '$inc': {'version': 1}}, upsert=True)
+    # Кэш этого чата сбрасывает обработчик записи
 
 def update_setting(chat_id, key, value):
     """Обновить настройку"""
-    database.update_one('settings', {'chat_id': chat_id}, {'$set': {key: value}}, upsert=True)
-    # Очищаем кэш для этого чата
-    clear_settings_cache(chat_id)
+    update_settings(chat_id, {key: value})
 
 def get_settings_keyboard(chat_id):
     """Создать клавиатуру настроек"""
@@ -173,3 +210,4 @@ def get_max_players_keyboard(chat_id):
     kb.add(InlineKeyboardButton("◀️ Назад", callback_data='settings_back'))
     return kb
 
+database.on_write('settings', _on_settings_write)
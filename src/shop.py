@@ -3,9 +3,12 @@
 Система магазина для игры в мафию
 """
 import database
+from candies import credit, debit, get_balance
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Tuple
+import heapq
 import random
+import threading
 
 # Определение товаров магазина
 SHOP_ITEMS = {
@@ -209,11 +212,9 @@ def purchase_item(user_id: int, item_id: str, payment_type: str = 'candies') ->
         if candies < cost:
             return False, f"❌ Недостаточно конфет. Нужно: {cost} 🍭, у вас: {candies} 🍭", None
         
-        # Списываем конфеты
-        new_candies = candies - cost
-        database.update_one('player_stats', {'user_id': user_id}, {
-            '$set': {'candies': new_candies}
-        })
+        # Списываем конфеты (атомарно: при параллельной покупке баланс не уйдет в минус)
+        if not debit(user_id, cost, f'shop:{item_id}'):
+            return False, f"❌ Недостаточно конфет. Нужно: {cost} 🍭, у вас: {get_balance(user_id)} 🍭", None
         
     elif payment_type == 'stars':
         if item.get('cost_stars') is None:
@@ -255,14 +256,13 @@ def purchase_item(user_id: int, item_id: str, payment_type: str = 'candies') ->
         # Открываем кейс и выдаем случайное событие
         try:
             from game_events import get_available_events
-            events = get_available_events()
             event_rarity = item.get('event_rarity', 'common')
             
-            # Фильтруем события по редкости
-            filtered_events = [e for e in events if e.get('rarity') == event_rarity]
+            # События нужной редкости для текущего сезона
+            filtered_events = get_available_events(event_rarity)
             if not filtered_events:
                 # Если нет событий нужной редкости, берем любые
-                filtered_events = events
+                filtered_events = get_available_events()
             
             if filtered_events:
                 random_event = random.choice(filtered_events)
@@ -290,11 +290,8 @@ def purchase_item(user_id: int, item_id: str, payment_type: str = 'candies') ->
     elif item['type'] == 'candies':
         # Выдаем конфеты
         amount = item.get('amount', 0)
-        current_candies = stats.get('candies', 0)
-        new_candies = current_candies + amount
-        database.update_one('player_stats', {'user_id': user_id}, {
-            '$set': {'candies': new_candies}
-        })
+        credit(user_id, amount, f'shop:{item_id}')
+        new_candies = get_balance(user_id)
         return True, f"Вы получили {amount} 🍭 конфет! Теперь у вас: {new_candies} 🍭", item
     
     return False, "❌ Неизвестный тип товара", None
@@ -342,22 +339,95 @@ def create_limited_offer(offer_id: str, duration_hours: int = 24) -> bool:
     
     return True
 
+# Активные предложения из shop_offers: {offer_id: предложение} и куча (valid_until, offer_id)
+# для снятия истёкших по порядку. Загружаются один раз, дальше обновляются при записи.
+_offers_lock = threading.Lock()
+_offers_loaded = False
+_offers: Dict[str, Dict] = {}
+_offers_expiry: List[Tuple[str, str]] = []
+_offers_version = 0
+# До загрузки записи не копятся (загрузка их прочитает); копятся только пришедшие во
+# время чтения коллекции — последнее состояние на предложение: {offer_id: (документ, удалён)}
+_offers_loading = False
+_offers_pending: Dict[str, Tuple[Dict, bool]] = {}
+
+def _cache_offer(offer: Dict):
+    """Положить предложение в кэш (устаревшие записи кучи отбрасываются при чтении)"""
+    global _offers_version
+    valid_until = offer.get('valid_until')
+    if not valid_until:
+        return
+    try:
+        datetime.fromisoformat(valid_until)
+    except (TypeError, ValueError):
+        return
+    _offers[offer['offer_id']] = offer
+    heapq.heappush(_offers_expiry, (valid_until, offer['offer_id']))
+    _offers_version += 1
+
+def _uncache_offer(offer: Dict):
+    """Убрать удалённое предложение (его запись в куче отбрасывается при снятии)"""
+    global _offers_version
+    if _offers.pop(offer['offer_id'], None) is not None:
+        _offers_version += 1
+
+def _on_offer_write(doc: Dict):
+    if not doc.get('offer_id'):
+        return
+    with _offers_lock:
+        if _offers_loaded:
+            _cache_offer(doc)
+        elif _offers_loading:
+            _offers_pending[doc['offer_id']] = (doc, False)
+
+def _on_offer_delete(doc: Dict):
+    if not doc.get('offer_id'):
+        return
+    with _offers_lock:
+        if _offers_loaded:
+            _uncache_offer(doc)
+        elif _offers_loading:
+            _offers_pending[doc['offer_id']] = (doc, True)
+
+def _load_offers():
+    global _offers_loaded, _offers_loading
+    with _offers_lock:
+        _offers_loading = True
+    docs = database.find('shop_offers', {})
+    with _offers_lock:
+        if _offers_loaded:
+            return
+        for doc, deleted in [(doc, False) for doc in docs] + list(_offers_pending.values()):
+            if not doc.get('offer_id'):
+                continue
+            if deleted:
+                _uncache_offer(doc)
+            else:
+                _cache_offer(doc)
+        _offers_pending.clear()
+        _offers_loaded = True
+        _offers_loading = False
+
 def get_active_limited_offers() -> List[Dict]:
-    """Получить активные ограниченные предложения из базы данных"""
-    offers = database.find('shop_offers', {})
-    active_offers = []
-    
-    for offer in offers:
-        valid_until = offer.get('valid_until')
-        if valid_until:
-            try:
-                valid_until_dt = datetime.fromisoformat(valid_until)
-                if datetime.now() < valid_until_dt:
-                    active_offers.append(offer)
-            except:
-                pass
-    
-    return active_offers
+    """Получить активные ограниченные предложения (в порядке истечения)"""
+    global _offers_version
+    if not _offers_loaded:
+        _load_offers()
+    now = datetime.now().isoformat()
+    with _offers_lock:
+        # Снимаем истёкшие предложения с вершины кучи
+        while _offers_expiry and _offers_expiry[0][0] <= now:
+            valid_until, offer_id = heapq.heappop(_offers_expiry)
+            offer = _offers.get(offer_id)
+            if offer and offer.get('valid_until') == valid_until:
+                del _offers[offer_id]
+                _offers_version += 1
+        return sorted(_offers.values(), key=lambda offer: offer['valid_until'])
+
+def get_offers_version() -> int:
+    """Версия набора активных предложений (меняется при добавлении и истечении)"""
+    get_active_limited_offers()
+    return _offers_version
 
 def find_item_by_name(item_name: str) -> Optional[Dict]:
     """Найти товар по названию (частичное совпадение)"""
@@ -375,3 +445,5 @@ def find_item_by_name(item_name: str) -> Optional[Dict]:
     
     return None
 
+database.on_write('shop_offers', _on_offer_write)
+database.on_delete('shop_offers', _on_offer_delete)
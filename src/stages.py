@@ -8,6 +8,7 @@ from collections import Counter
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 from telebot.apihelper import ApiException
 from settings import get_settings
+from game_events import run_hooks
 
 stages = {}
 
@@ -589,18 +590,16 @@ def go_to_next_stage(game, inc=1, max_recursion=10):
             # Обновляем игру после cleanup
             game = database.find_one('games', {'_id': game['_id']})
     
+    # Изменения от хуков событий пишутся вместе с переходом одной записью
+    event_updates = {}
+    
     # Получаем время из настроек для соответствующих стадий
     settings = get_settings(game['chat'])
     if stage_number == 0:
-        # Обсуждение
-        discussion_time = settings.get('discussion_time', 300)
-        # Применяем множитель времени, если есть событие замедления времени
-        multiplier = game.get('day_duration_multiplier', 1)
-        discussion_time = int(discussion_time * multiplier)
-        # Сбрасываем множитель после использования
-        if multiplier > 1:
-            database.update_one('games', {'_id': game['_id']}, {'$set': {'day_duration_multiplier': 1}})
-        stage['time'] = discussion_time
+        # Обсуждение (события могут изменить длительность дня)
+        day_ctx = {'duration': settings.get('discussion_time', 300)}
+        event_updates.update(run_hooks(game, 'on_day_start', day_ctx))
+        stage['time'] = day_ctx['duration']
     # Стадия 1 (голосование) больше не используется - голосуем во время обсуждения
     elif stage_number in [4, 5, 6, 7, 8, 9, 10, 11]:
         # Ночные действия (мафия, дон, комиссар, доктор, маньяк, любовница, адвокат, бомж)
@@ -615,30 +614,19 @@ def go_to_next_stage(game, inc=1, max_recursion=10):
         'next_stage_time': time() + duration,
         'played': []
     }
+    updates.update(event_updates)
     
     # Сброс ночных действий
     if stage_number == 3:  # Начало ночи
-        # Применяем блокировки от метели
-        blizzard_blocked = game.get('blizzard_blocked', [])
-        if blizzard_blocked:
-            # Добавляем заблокированных игроков в blocks
-            current_blocks = game.get('blocks', [])
-            for blocked_id in blizzard_blocked:
-                if blocked_id not in current_blocks:
-                    current_blocks.append(blocked_id)
-            updates['blocks'] = current_blocks
-            # Очищаем список заблокированных метелью
-            updates['blizzard_blocked'] = []
-        else:
-            # Если нет блокировок от метели, сбрасываем blocks
-            updates['blocks'] = []
-        
         updates.update({
+            'blocks': [],
             'shots': [], 'heals': [], 'played': [],
             'commissar_action': None, 'commissar_target': None,
             'don_check': None, 'lawyer_client': None,
             'bum_witness': None, 'maniac_shot': None
         })
+        # События могут добавить блокировки и прочие изменения ночи
+        updates.update(run_hooks(game, 'on_night_start', updates))
     
     database.update_one('games', {'_id': game['_id']}, {'$set': updates})
     new_game = database.find_one('games', {'_id': game['_id']})
@@ -789,6 +777,11 @@ def vote_results(game):
         if target_idx >= 0 and target_idx < len(game['players']):
             vote_counts[target_idx] = vote_counts.get(target_idx, 0) + 1
     
+    # События могут изменить подсчет (например, иммунитет)
+    hook_updates = run_hooks(game, 'on_vote_tally', {'vote_counts': vote_counts})
+    if hook_updates:
+        database.update_one('games', {'_id': game['_id']}, {'$set': hook_updates})
+    
     if not vote_counts:
         bot.send_message(game['chat'], lang.vote_result_nobody, parse_mode='HTML')
         go_to_next_stage(game)
@@ -1038,13 +1031,19 @@ def morning_results(game):
             dead.append(maniac_target)
     
     # Убийство комиссара
+    kill_target = None
     if game.get('commissar_action') == 'kill' and game.get('commissar_target') is not None:
         kill_target = int(game['commissar_target'])
         is_healed = kill_target in [int(x) for x in game.get('heals', [])]
         if not is_healed:
             dead.append(kill_target)
-            kill_target_pos = game['players'][kill_target].get('position', kill_target + 1)
-            bot.send_message(game['chat'], lang.commissar_kill_result.format(target_num=kill_target_pos), parse_mode='HTML')
+    
+    # События могут изменить исход ночи (например, защита) — до объявления смертей
+    hook_updates = run_hooks(game, 'on_night_resolve', {'dead': dead})
+    
+    if kill_target is not None and kill_target in dead:
+        kill_target_pos = game['players'][kill_target].get('position', kill_target + 1)
+        bot.send_message(game['chat'], lang.commissar_kill_result.format(target_num=kill_target_pos), parse_mode='HTML')
     
     # Обрабатываем смерти
     for idx in set(dead):
@@ -1097,7 +1096,7 @@ def morning_results(game):
                 target_num=target_pos
             ), parse_mode='HTML')
     
-    database.update_one('games', {'_id': game['_id']}, {'$set': {'players': game['players']}})
+    database.update_one('games', {'_id': game['_id']}, {'$set': {'players': game['players'], **hook_updates}})
     
     # Проверка победы
     alive = [p for p in game['players'] if p['alive']]
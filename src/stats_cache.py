@@ -0,0 +1,62 @@
+# stats_cache.py
+"""
+Кэш отрисованных карточек по статистике игроков.
+
+Каждая запись в player_stats увеличивает версию статистики пользователя,
+поэтому закэшированный текст живёт ровно до следующего изменения документа.
+Кэш ограничен RENDER_CACHE_SIZE записями: при переполнении вытесняются давно
+не запрошенные.
+"""
+import database
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Tuple
+
+RENDER_CACHE_SIZE = 2048
+
+# {user_id: версия статистики}
+_stats_versions: Dict[int, int] = {}
+
+# {(user_id, ключ): (версия, готовый текст)} в порядке последнего обращения
+_render_cache: Dict[Tuple[int, Hashable], Tuple[int, str]] = OrderedDict()
+_cache_lock = threading.Lock()
+
+def get_stats_version(user_id: int) -> int:
+    """Текущая версия статистики пользователя"""
+    return _stats_versions.get(user_id, 0)
+
+def _on_stats_write(doc: Dict):
+    """Увеличить версию при любой записи в документ игрока"""
+    user_id = doc.get('user_id')
+    if user_id is not None:
+        _stats_versions[user_id] = _stats_versions.get(user_id, 0) + 1
+
+def cached_render(user_id: int, key: Hashable, render: Callable[[], str]) -> str:
+    """
+    Вернуть закэшированный текст или отрисовать и запомнить его
+
+    Args:
+        user_id: ID пользователя, от статистики которого зависит текст
+        key: Вариант отрисовки (например, обычная/детальная статистика)
+        render: Функция, строящая текст
+
+    Returns:
+        Готовый текст
+    """
+    # Версию берём до отрисовки: если статистика изменится во время рендера,
+    # запись окажется устаревшей и будет перестроена при следующем запросе
+    version = get_stats_version(user_id)
+    with _cache_lock:
+        cached = _render_cache.get((user_id, key))
+        if cached and cached[0] == version:
+            _render_cache.move_to_end((user_id, key))
+            return cached[1]
+    text = render()
+    with _cache_lock:
+        _render_cache[(user_id, key)] = (version, text)
+        _render_cache.move_to_end((user_id, key))
+        while len(_render_cache) > RENDER_CACHE_SIZE:
+            _render_cache.popitem(last=False)
+    return text
+
+database.on_write('player_stats', _on_stats_write)
@@ -3,14 +3,141 @@
 Система команд для игры в мафию
 """
 import database
+import copy
+import threading
+from bisect import bisect_left, insort
 from datetime import datetime
 from typing import Dict, List, Optional, Tuple
 import random
 import string
 
+# Все изменения команд идут через этот модуль под _teams_lock: проверка и запись
+# не перемежаются между потоками, а индексы обновляются вместе с записью в базу.
+_teams_lock = threading.RLock()
+_index_loaded = False
+
+# {team_id: команда}
+_teams: Dict[str, Dict] = {}
+
+# {user_id: team_id}
+_team_by_user: Dict[int, str] = {}
+
+# {user_id: {team_id: приглашение}} — приглашения в порядке получения
+_invitations_by_user: Dict[int, Dict[str, Dict]] = {}
+
+# Рейтинг команд: [(-средний ELO, -винрейт, team_id)] по возрастанию, т.е. лучшие первыми,
+# и текущий ключ каждой команды, чтобы убрать его при изменении агрегатов
+_ranking: List[Tuple[float, float, str]] = []
+_rank_keys: Dict[str, Tuple[float, float, str]] = {}
+
+def _rank_key(team: Dict) -> Tuple[float, float, str]:
+    aggregates = team.get('aggregates') or _new_aggregates()
+    avg_elo = aggregates['elo_sum'] / aggregates['elo_count'] if aggregates['elo_count'] else 1000
+    win_rate = aggregates['wins'] / aggregates['games'] * 100 if aggregates['games'] else 0
+    return (-avg_elo, -win_rate, team['team_id'])
+
+def _unrank_team(team_id: str):
+    key = _rank_keys.pop(team_id, None)
+    if key is not None:
+        del _ranking[bisect_left(_ranking, key)]
+
+def _rerank_team(team_id: str):
+    """Переставить команду в рейтинге после изменения агрегатов"""
+    _unrank_team(team_id)
+    team = _teams.get(team_id)
+    if team and team.get('members'):
+        key = _rank_key(team)
+        _rank_keys[team_id] = key
+        insort(_ranking, key)
+
+def _unindex_team(team_id: str):
+    """Убрать команду из индексов"""
+    _unrank_team(team_id)
+    team = _teams.pop(team_id, None)
+    if not team:
+        return
+    for member in team.get('members', []):
+        if _team_by_user.get(member['user_id']) == team_id:
+            del _team_by_user[member['user_id']]
+    for inv in team.get('invitations', []):
+        pending = _invitations_by_user.get(inv['user_id'])
+        if pending is not None:
+            pending.pop(team_id, None)
+            if not pending:
+                del _invitations_by_user[inv['user_id']]
+
+def _index_team(team: Dict):
+    """Положить команду в индексы (заменяет прежнее состояние этой команды)"""
+    team_id = team['team_id']
+    _unindex_team(team_id)
+    _teams[team_id] = copy.deepcopy(team)
+    for member in team.get('members', []):
+        _team_by_user[member['user_id']] = team_id
+    for inv in team.get('invitations', []):
+        _invitations_by_user.setdefault(inv['user_id'], {})[team_id] = inv
+    _rerank_team(team_id)
+
+def _ensure_index():
+    """Построить индексы при первом обращении (одно чтение коллекции)"""
+    global _index_loaded
+    if _index_loaded:
+        return
+    with _teams_lock:
+        if _index_loaded:
+            return
+        for team in database.find('teams', {}):
+            if team.get('team_id'):
+                _index_team(team)
+        _index_loaded = True
+
+def _save_team(team: Dict):
+    """Записать изменённую команду и обновить индексы"""
+    database.update_one('teams', {'team_id': team['team_id']}, {'$set': team})
+    _index_team(team)
+
+def _member_contribution(stats: Optional[Dict]) -> Dict:
+    """Вклад игрока в агрегаты команды"""
+    stats = stats or {}
+    return {
+        'games': stats.get('games_played', 0),
+        'wins': stats.get('games_won', 0),
+        'losses': stats.get('games_lost', 0),
+        'candies': stats.get('candies', 0),
+        'elo': stats.get('elo_rating', 1000)
+    }
+
+def _new_aggregates() -> Dict:
+    # members: {str(user_id): вклад} — чтобы при уходе вычесть ровно то, что было добавлено
+    return {'games': 0, 'wins': 0, 'losses': 0, 'candies': 0, 'elo_sum': 0, 'elo_count': 0, 'members': {}}
+
+def _add_member_aggregates(team: Dict, user_id: int, stats: Optional[Dict]):
+    """Добавить вклад участника в агрегаты команды"""
+    aggregates = team.setdefault('aggregates', _new_aggregates())
+    contribution = _member_contribution(stats)
+    aggregates['members'][str(user_id)] = contribution
+    for field in ('games', 'wins', 'losses', 'candies'):
+        aggregates[field] += contribution[field]
+    aggregates['elo_sum'] += contribution['elo']
+    aggregates['elo_count'] += 1
+
+def _remove_member_aggregates(team: Dict, user_id: int):
+    """Вычесть вклад участника из агрегатов команды"""
+    aggregates = team.get('aggregates')
+    contribution = aggregates and aggregates['members'].pop(str(user_id), None)
+    if not contribution:
+        return
+    for field in ('games', 'wins', 'losses', 'candies'):
+        aggregates[field] -= contribution[field]
+    aggregates['elo_sum'] -= contribution['elo']
+    aggregates['elo_count'] -= 1
+
 def generate_team_id() -> str:
     """Генерировать уникальный ID команды"""
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
+    _ensure_index()
+    while True:
+        team_id = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
+        if team_id not in _teams:
+            return team_id
 
 def create_team(creator_id: int, team_name: str) -> Optional[Dict]:
     """
@@ -19,6 +146,10 @@ def create_team(creator_id: int, team_name: str) -> Optional[Dict]:
     Returns:
         Словарь с данными команды или None при ошибке
     """
+    with _teams_lock:
+        return _create_team(creator_id, team_name)
+
+def _create_team(creator_id: int, team_name: str) -> Optional[Dict]:
     # Проверяем, не состоит ли создатель уже в команде
     existing_team = get_user_team(creator_id)
     if existing_team:
@@ -46,29 +177,27 @@ def create_team(creator_id: int, team_name: str) -> Optional[Dict]:
         }],
         'invitations': [],  # Список приглашений
         'created_at': datetime.now().isoformat(),
-        'stats': {
-            'total_games': 0,
-            'total_wins': 0,
-            'total_losses': 0,
-            'avg_elo': 1000,
-            'total_candies': 0
-        }
+        'aggregates': _new_aggregates()
     }
+    _add_member_aggregates(team, creator_id, creator_stats)
     
     database.insert_one('teams', team)
+    _index_team(team)
     return team
 
 def get_team(team_id: str) -> Optional[Dict]:
     """Получить команду по ID"""
-    return database.find_one('teams', {'team_id': team_id})
+    _ensure_index()
+    with _teams_lock:
+        team = _teams.get(team_id)
+        return copy.deepcopy(team) if team else None
 
 def get_user_team(user_id: int) -> Optional[Dict]:
     """Получить команду, в которой состоит пользователь"""
-    all_teams = database.find('teams', {})
-    for team in all_teams:
-        if any(member['user_id'] == user_id for member in team.get('members', [])):
-            return team
-    return None
+    _ensure_index()
+    with _teams_lock:
+        team_id = _team_by_user.get(user_id)
+        return get_team(team_id) if team_id else None
 
 def invite_player(team_id: str, inviter_id: int, invitee_id: int) -> Tuple[bool, str]:
     """
@@ -77,6 +206,10 @@ def invite_player(team_id: str, inviter_id: int, invitee_id: int) -> Tuple[bool,
     Returns:
         (success: bool, message: str)
     """
+    with _teams_lock:
+        return _invite_player(team_id, inviter_id, invitee_id)
+
+def _invite_player(team_id: str, inviter_id: int, invitee_id: int) -> Tuple[bool, str]:
     team = get_team(team_id)
     if not team:
         return False, "Команда не найдена"
@@ -115,7 +248,7 @@ def invite_player(team_id: str, inviter_id: int, invitee_id: int) -> Tuple[bool,
     team['invitations'] = team.get('invitations', [])
     team['invitations'].append(invitation)
     
-    database.update_one('teams', {'team_id': team_id}, {'$set': team})
+    _save_team(team)
     
     return True, f"Игрок {invitee_stats.get('name', 'Игрок')} приглашен в команду"
 
@@ -126,6 +259,10 @@ def accept_invitation(team_id: str, user_id: int) -> Tuple[bool, str]:
     Returns:
         (success: bool, message: str)
     """
+    with _teams_lock:
+        return _accept_invitation(team_id, user_id)
+
+def _accept_invitation(team_id: str, user_id: int) -> Tuple[bool, str]:
     team = get_team(team_id)
     if not team:
         return False, "Команда не найдена"
@@ -139,6 +276,10 @@ def accept_invitation(team_id: str, user_id: int) -> Tuple[bool, str]:
     if any(m['user_id'] == user_id for m in team.get('members', [])):
         return False, "Вы уже состоите в этой команде"
     
+    # Игрок состоит не больше чем в одной команде
+    if user_id in _team_by_user:
+        return False, "Вы уже состоите в другой команде"
+    
     # Получаем информацию о пользователе
     user_stats = database.find_one('player_stats', {'user_id': user_id})
     if not user_stats:
@@ -153,11 +294,12 @@ def accept_invitation(team_id: str, user_id: int) -> Tuple[bool, str]:
     }
     
     team['members'].append(new_member)
+    _add_member_aggregates(team, user_id, user_stats)
     
     # Удаляем приглашение
     team['invitations'] = [inv for inv in team.get('invitations', []) if inv['user_id'] != user_id]
     
-    database.update_one('teams', {'team_id': team_id}, {'$set': team})
+    _save_team(team)
     
     return True, f"Вы присоединились к команде {team['name']}"
 
@@ -168,6 +310,10 @@ def reject_invitation(team_id: str, user_id: int) -> Tuple[bool, str]:
     Returns:
         (success: bool, message: str)
     """
+    with _teams_lock:
+        return _reject_invitation(team_id, user_id)
+
+def _reject_invitation(team_id: str, user_id: int) -> Tuple[bool, str]:
     team = get_team(team_id)
     if not team:
         return False, "Команда не найдена"
@@ -175,7 +321,7 @@ def reject_invitation(team_id: str, user_id: int) -> Tuple[bool, str]:
     # Удаляем приглашение
     team['invitations'] = [inv for inv in team.get('invitations', []) if inv['user_id'] != user_id]
     
-    database.update_one('teams', {'team_id': team_id}, {'$set': team})
+    _save_team(team)
     
     return True, "Приглашение отклонено"
 
@@ -186,6 +332,10 @@ def leave_team(user_id: int) -> Tuple[bool, str]:
     Returns:
         (success: bool, message: str)
     """
+    with _teams_lock:
+        return _leave_team(user_id)
+
+def _leave_team(user_id: int) -> Tuple[bool, str]:
     team = get_user_team(user_id)
     if not team:
         return False, "Вы не состоите в команде"
@@ -202,13 +352,15 @@ def leave_team(user_id: int) -> Tuple[bool, str]:
     
     # Удаляем участника
     team['members'] = [m for m in team['members'] if m['user_id'] != user_id]
+    _remove_member_aggregates(team, user_id)
     
     # Если команда пуста, удаляем её
     if len(team['members']) == 0:
         database.delete_one('teams', {'team_id': team['team_id']})
+        _unindex_team(team['team_id'])
         return True, "Команда распущена"
     
-    database.update_one('teams', {'team_id': team['team_id']}, {'$set': team})
+    _save_team(team)
     return True, "Вы покинули команду"
 
 def kick_member(team_id: str, leader_id: int, member_id: int) -> Tuple[bool, str]:
@@ -218,6 +370,10 @@ def kick_member(team_id: str, leader_id: int, member_id: int) -> Tuple[bool, str
     Returns:
         (success: bool, message: str)
     """
+    with _teams_lock:
+        return _kick_member(team_id, leader_id, member_id)
+
+def _kick_member(team_id: str, leader_id: int, member_id: int) -> Tuple[bool, str]:
     team = get_team(team_id)
     if not team:
         return False, "Команда не найдена"
@@ -233,78 +389,170 @@ def kick_member(team_id: str, leader_id: int, member_id: int) -> Tuple[bool, str
     
     # Удаляем участника
     team['members'] = [m for m in team['members'] if m['user_id'] != member_id]
+    _remove_member_aggregates(team, member_id)
     
-    database.update_one('teams', {'team_id': team_id}, {'$set': team})
+    _save_team(team)
     
     return True, "Участник исключен из команды"
 
 def get_team_stats(team_id: str) -> Dict:
     """
-    Получить статистику команды
+    Получить статистику команды из агрегатов (без чтения статистики участников)
     
     Returns:
         Словарь со статистикой команды
     """
-    team = get_team(team_id)
-    if not team:
-        return {}
-    
-    members_ids = [m['user_id'] for m in team.get('members', [])]
-    
-    # Собираем статистику всех участников
-    total_games = 0
-    total_wins = 0
-    total_losses = 0
-    total_candies = 0
-    elo_ratings = []
-    
-    for user_id in members_ids:
-        stats = database.find_one('player_stats', {'user_id': user_id})
-        if stats:
-            total_games += stats.get('games_played', 0)
-            total_wins += stats.get('games_won', 0)
-            total_losses += stats.get('games_lost', 0)
-            total_candies += stats.get('candies', 0)
-            elo_ratings.append(stats.get('elo_rating', 1000))
-    
-    avg_elo = sum(elo_ratings) / len(elo_ratings) if elo_ratings else 1000
-    win_rate = (total_wins / total_games * 100) if total_games > 0 else 0
-    
-    team_stats = {
+    _ensure_index()
+    with _teams_lock:
+        team = _teams.get(team_id)
+        if not team:
+            return {}
+        aggregates = team.get('aggregates') or _new_aggregates()
+        members_count = len(team.get('members', []))
+    
+    total_games = aggregates['games']
+    return {
         'total_games': total_games,
-        'total_wins': total_wins,
-        'total_losses': total_losses,
-        'win_rate': win_rate,
-        'avg_elo': avg_elo,
-        'total_candies': total_candies,
-        'members_count': len(members_ids)
+        'total_wins': aggregates['wins'],
+        'total_losses': aggregates['losses'],
+        'win_rate': (aggregates['wins'] / total_games * 100) if total_games > 0 else 0,
+        'avg_elo': aggregates['elo_sum'] / aggregates['elo_count'] if aggregates['elo_count'] else 1000,
+        'total_candies': aggregates['candies'],
+        'members_count': members_count
+    }
+
+def apply_game_results(results: Dict[int, Dict]) -> int:
+    """
+    Применить итоги игры к агрегатам команд игроков одной записью коллекции
+    
+    Args:
+        results: {user_id: {'won': bool, 'elo': рейтинг после игры, 'candies': баланс после игры}}
+    
+    Returns:
+        Количество обновлённых команд
+    """
+    _ensure_index()
+    with _teams_lock:
+        updates = {}
+        for user_id, result in results.items():
+            team_id = _team_by_user.get(user_id)
+            aggregates = _teams[team_id].get('aggregates') if team_id else None
+            contribution = aggregates and aggregates['members'].get(str(user_id))
+            if not contribution:
+                continue
+            
+            delta = {
+                'games': 1,
+                'wins': 1 if result['won'] else 0,
+                'losses': 0 if result['won'] else 1,
+                # Конфеты и рейтинг меняются не только в играх: берём разницу с последним вкладом
+                'candies': result['candies'] - contribution['candies'],
+                'elo_sum': result['elo'] - contribution['elo']
+            }
+            update = updates.setdefault(team_id, {'$inc': {}, '$set': {}})
+            for field, value in delta.items():
+                aggregates[field] += value
+                update['$inc'][f'aggregates.{field}'] = update['$inc'].get(f'aggregates.{field}', 0) + value
+            for field in ('games', 'wins', 'losses'):
+                contribution[field] += delta[field]
+            contribution['candies'] = result['candies']
+            contribution['elo'] = result['elo']
+            update['$set'][f'aggregates.members.{user_id}'] = dict(contribution)
+        
+        if updates:
+            database.bulk_update('teams', updates, key='team_id')
+            for team_id in updates:
+                _rerank_team(team_id)
+    return len(updates)
+
+def _ranking_entry(position: int, key: Tuple[float, float, str]) -> Dict:
+    team = _teams[key[2]]
+    return {
+        'position': position,
+        'team_id': key[2],
+        'name': team['name'],
+        'avg_elo': -key[0],
+        'win_rate': -key[1],
+        'members_count': len(team.get('members', []))
     }
+
+def get_team_leaderboard(limit: int = 10, offset: int = 0) -> List[Dict]:
+    """
+    Лучшие команды по среднему ELO (при равенстве — по винрейту)
     
-    # Обновляем статистику в команде
-    team['stats'] = team_stats
-    database.update_one('teams', {'team_id': team_id}, {'$set': team})
+    Args:
+        limit: Сколько команд вернуть
+        offset: Сколько лучших команд пропустить
     
-    return team_stats
+    Returns:
+        [{'position', 'team_id', 'name', 'avg_elo', 'win_rate', 'members_count'}]
+    """
+    _ensure_index()
+    with _teams_lock:
+        return [_ranking_entry(offset + i + 1, key) for i, key in enumerate(_ranking[offset:offset + limit])]
+
+def get_team_rank(team_id: str) -> Optional[Dict]:
+    """
+    Место команды в рейтинге (поиск делением пополам)
+    
+    Returns:
+        Запись рейтинга как в get_team_leaderboard плюс 'total', или None
+    """
+    _ensure_index()
+    with _teams_lock:
+        key = _rank_keys.get(team_id)
+        if key is None:
+            return None
+        entry = _ranking_entry(bisect_left(_ranking, key) + 1, key)
+        entry['total'] = len(_ranking)
+        return entry
+
+def migrate_team_aggregates() -> int:
+    """Однократно посчитать агрегаты для команд, созданных до их появления
+    
+    Returns:
+        Количество обновлённых команд (0, если миграция уже применялась)
+    """
+    if database.find_one('migrations', {'name': 'team_aggregates'}):
+        return 0
+    _ensure_index()
+    with _teams_lock:
+        pending = [team for team in _teams.values() if 'aggregates' not in team]
+        member_ids = [m['user_id'] for team in pending for m in team.get('members', [])]
+        stats_by_user = {stats['user_id']: stats for stats in database.find('player_stats', {'user_id': {'$in': member_ids}})}
+        
+        updates = {}
+        for team in pending:
+            team['aggregates'] = _new_aggregates()
+            for member in team.get('members', []):
+                _add_member_aggregates(team, member['user_id'], stats_by_user.get(member['user_id']))
+            updates[team['team_id']] = {'$set': {'aggregates': team['aggregates']}}
+            _rerank_team(team['team_id'])
+        if updates:
+            database.bulk_update('teams', updates, key='team_id')
+        database.insert_one('migrations', {'name': 'team_aggregates', 'applied_at': datetime.now().isoformat(),
+                                           'documents': len(updates)})
+    return len(updates)
 
 def get_user_invitations(user_id: int) -> List[Dict]:
     """Получить все приглашения пользователя"""
-    all_teams = database.find('teams', {})
-    invitations = []
+    _ensure_index()
+    with _teams_lock:
+        pending = [(team_id, dict(inv)) for team_id, inv in _invitations_by_user.get(user_id, {}).items()]
+        team_names = {team_id: _teams[team_id]['name'] for team_id, _ in pending}
     
-    for team in all_teams:
-        for inv in team.get('invitations', []):
-            if inv['user_id'] == user_id:
-                invitation_info = {
-                    'team_id': team['team_id'],
-                    'team_name': team['name'],
-                    'invited_by': inv.get('invited_by'),
-                    'invited_at': inv.get('invited_at')
-                }
-                # Получаем имя пригласившего
-                inviter_stats = database.find_one('player_stats', {'user_id': inv.get('invited_by')})
-                if inviter_stats:
-                    invitation_info['inviter_name'] = inviter_stats.get('name', 'Игрок')
-                invitations.append(invitation_info)
+    invitations = []
+    for team_id, inv in pending:
+        invitation_info = {
+            'team_id': team_id,
+            'team_name': team_names[team_id],
+            'invited_by': inv.get('invited_by'),
+            'invited_at': inv.get('invited_at')
+        }
+        # Получаем имя пригласившего
+        inviter_stats = database.find_one('player_stats', {'user_id': inv.get('invited_by')})
+        if inviter_stats:
+            invitation_info['inviter_name'] = inviter_stats.get('name', 'Игрок')
+        invitations.append(invitation_info)
     
     return invitations
-
@@ -0,0 +1,176 @@
+# users.py
+"""
+Поиск игроков по @username и отображаемому имени.
+
+Индекс строится из player_stats при первом обращении и дальше пополняется из
+двух источников: записей в player_stats (имя после игры) и remember_user(),
+которую вызывает handlers.user_object при каждом взаимодействии с ботом.
+Точное совпадение username ищется в словаре, поиск по началу имени — делением
+пополам в отсортированном списке имён.
+"""
+import html
+import threading
+from bisect import bisect_left, insort
+from typing import Dict, List, Optional, Tuple
+
+import database
+
+# Индекс защищает отдельная блокировка, которая никогда не держится во время
+# обращения к базе (обработчик записи вызывается под блокировкой коллекции).
+# До загрузки записи не копятся (загрузка их прочитает); копятся только те, что
+# пришли во время чтения коллекции — по одной, последней, на пользователя.
+_index_lock = threading.Lock()
+_loaded = False
+_loading = False
+_pending: Dict[int, Tuple[int, Optional[str], Optional[str]]] = {}
+
+# {username в нижнем регистре: user_id}
+_by_username: Dict[str, int] = {}
+
+# {user_id: (username в нижнем регистре или None, отображаемое имя или None)}
+_users: Dict[int, Tuple[Optional[str], Optional[str]]] = {}
+
+# [(username или имя в нижнем регистре, user_id)], отсортирован для поиска по префиксу
+_names: List[Tuple[str, int]] = []
+
+def _fold(text: str) -> str:
+    return html.unescape(text).strip().lstrip('@').casefold()
+
+def _apply(user_id: int, username: Optional[str], name: Optional[str], from_stats: bool = False):
+    """Обновить записи пользователя в индексах
+
+    from_stats: запись из player_stats только дополняет индекс — username берётся,
+    лишь если пользователь ещё не известен, имя — если прежнего нет. Менять их
+    может только remember_user(), которая знает актуальные данные Telegram.
+    """
+    old_username, old_name = _users.get(user_id, (None, None))
+    username = _fold(username) if username else None
+    name = _fold(name) if name else None
+    if from_stats:
+        if user_id in _users:
+            username = old_username
+        name = old_name or name
+
+    if old_username != username:
+        if old_username and _by_username.get(old_username) == user_id:
+            del _by_username[old_username]
+    if username:
+        # Username в Telegram уникален: последний владелец вытесняет прежнего
+        _by_username[username] = user_id
+
+    old_keys = {k for k in (old_username, old_name) if k}
+    new_keys = {k for k in (username, name) if k}
+    for key in old_keys - new_keys:
+        i = bisect_left(_names, (key, user_id))
+        if i < len(_names) and _names[i] == (key, user_id):
+            del _names[i]
+    for key in new_keys - old_keys:
+        insort(_names, (key, user_id))
+
+    _users[user_id] = (username, name)
+
+def _from_stats(doc: Dict) -> Optional[Tuple[int, Optional[str], Optional[str]]]:
+    """Запись индекса из документа player_stats (name — '@username' или имя)"""
+    user_id = doc.get('user_id')
+    name = doc.get('name')
+    if user_id is None or not name:
+        return None
+    if name.startswith('@'):
+        return user_id, name, None
+    return user_id, None, name
+
+def _on_stats_write(doc: Dict):
+    entry = _from_stats(doc)
+    if entry is None:
+        return
+    with _index_lock:
+        if _loaded:
+            _apply(*entry, from_stats=True)
+        elif _loading:
+            _pending[entry[0]] = entry
+
+def _ensure_index():
+    """Построить индекс при первом обращении (одно чтение коллекции)"""
+    global _loaded, _loading
+    if _loaded:
+        return
+    with _index_lock:
+        _loading = True
+    docs = database.find('player_stats', {})
+    with _index_lock:
+        if _loaded:
+            return
+        entries = [_from_stats(doc) for doc in docs]
+        for entry in [e for e in entries if e] + list(_pending.values()):
+            _apply(*entry, from_stats=True)
+        _pending.clear()
+        _loaded = True
+        _loading = False
+
+def remember_user(user_id: int, username: Optional[str], full_name: Optional[str]):
+    """
+    Запомнить пользователя Telegram, который обратился к боту
+
+    Args:
+        user_id: ID пользователя
+        username: Username без @ (None, если его нет)
+        full_name: Имя и фамилия
+    """
+    _ensure_index()
+    with _index_lock:
+        _apply(user_id, username, full_name)
+
+def search_users(prefix: str, limit: int = 5) -> List[int]:
+    """
+    Пользователи, у которых username или имя начинается с prefix
+
+    Returns:
+        ID пользователей (сначала точное совпадение username, затем по алфавиту имён)
+    """
+    _ensure_index()
+    prefix = _fold(prefix)
+    if not prefix:
+        return []
+    with _index_lock:
+        found = []
+        exact = _by_username.get(prefix)
+        if exact is not None:
+            found.append(exact)
+        i = bisect_left(_names, (prefix,))
+        while i < len(_names) and len(found) < limit and _names[i][0].startswith(prefix):
+            if _names[i][1] not in found:
+                found.append(_names[i][1])
+            i += 1
+        return found
+
+def resolve_user(target: str) -> Optional[int]:
+    """
+    Найти пользователя по '@username', ID или имени
+
+    Совпадение по началу имени засчитывается, только если оно однозначно.
+
+    Returns:
+        ID пользователя или None
+    """
+    _ensure_index()
+    key = _fold(target)
+    if not key:
+        return None
+    if key.isdigit() and int(key) in _users:
+        return int(key)
+    with _index_lock:
+        user_id = _by_username.get(key)
+        if user_id is not None:
+            return user_id
+        # Полные совпадения имени стоят в списке раньше совпадений по началу
+        i = bisect_left(_names, (key,))
+        exact, matches = set(), set()
+        while i < len(_names) and _names[i][0].startswith(key) and len(matches) < 2:
+            if _names[i][0] == key:
+                exact.add(_names[i][1])
+            matches.add(_names[i][1])
+            i += 1
+    candidates = exact or matches
+    return candidates.pop() if len(candidates) == 1 else None
+
+database.on_write('player_stats', _on_stats_write)